@@ -0,0 +1,93 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure the latency of the encoding service with and without micro-batching, under concurrent requests.
+
+Run it with `python benchmarks/encoding_service.py`. The pages are synthetic and OCR is replaced by the deterministic
+stand-in of `document_tools.bench`, so only the processor of the target model has to be reachable from the Hub or
+already be in the local cache of 🤗 Transformers.
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from document_tools import TARGET_MODELS, EncodingService
+from document_tools.bench import generate_documents, synthetic_ocr
+from document_tools.encoders import CallableOCR
+
+
+async def run_clients(service: EncodingService, images: list, concurrency: int) -> List[float]:
+    """Send the images from `concurrency` clients, each waiting for its response before its next request."""
+    latencies: List[float] = []
+
+    async def client(offset: int):
+        for image in images[offset::concurrency]:
+            start = time.perf_counter()
+            await service.encode_async(image)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client(offset) for offset in range(concurrency)))
+    return latencies
+
+
+def measure(service: EncodingService, images: list, concurrency: int) -> Dict[str, float]:
+    """Return the latency percentiles in milliseconds and the throughput of `concurrency` clients."""
+    start = time.perf_counter()
+    latencies = asyncio.run(run_clients(service, images, concurrency))
+    seconds = time.perf_counter() - start
+    return {
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "documents_per_second": len(images) / seconds,
+    }
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target-model", default="layoutlmv3", choices=list(TARGET_MODELS))
+    parser.add_argument("--num-requests", type=int, default=128)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--max-batch-sizes", nargs="+", type=int, default=[1, 8, 16])
+    parser.add_argument("--max-wait", type=float, default=0.005)
+    parser.add_argument("--fast-image-processing", action="store_true")
+    args = parser.parse_args()
+
+    images = generate_documents(args.num_requests)["image"]
+    results = {}
+    for max_batch_size in args.max_batch_sizes:
+        service = EncodingService.from_target_model(
+            args.target_model,
+            max_batch_size=max_batch_size,
+            max_wait=args.max_wait,
+            ocr_backend=CallableOCR(synthetic_ocr, name="synthetic"),
+            fast_image_processing=args.fast_image_processing,
+        )
+        with service:
+            # Warm the processor up, the first call of the image processor and the tokenizer is slower.
+            service.encode(images[0])
+            results[f"max_batch_size={max_batch_size}"] = {
+                f"concurrency={concurrency}": measure(service, images, concurrency) for concurrency in args.concurrency
+            }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
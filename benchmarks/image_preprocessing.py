@@ -0,0 +1,111 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare the fast image processing path of the encoders with the image processors of 🤗 Transformers.
+
+Run it with `python benchmarks/image_preprocessing.py`. The images are synthetic scans at 300 DPI, encoded in JPEG,
+so the image processors are built with their default settings and nothing is downloaded from the Hub.
+"""
+import argparse
+import io
+import json
+import time
+
+import numpy as np
+from PIL import Image
+from transformers import LayoutLMv2ImageProcessor, LayoutLMv3ImageProcessor
+
+from document_tools.encoders.images import batch_pixel_values
+
+IMAGE_PROCESSORS = {
+    "layoutlmv2": (LayoutLMv2ImageProcessor, True),
+    "layoutlmv3": (LayoutLMv3ImageProcessor, False),
+}
+
+
+def scans(num_images: int, width: int, height: int) -> list:
+    """Encode synthetic scans with lines of dark blocks on a white page, in JPEG."""
+    rng = np.random.default_rng(0)
+    images = []
+    for _ in range(num_images):
+        pixels = np.full((height, width, 3), 255, dtype=np.uint8)
+        for top in range(100, height - 100, 60):
+            for left in rng.integers(100, width - 200, size=20):
+                pixels[top : top + 30, left : left + rng.integers(40, 160)] = rng.integers(0, 80)
+        output = io.BytesIO()
+        Image.fromarray(pixels).save(output, format="JPEG", quality=90)
+        images.append(output.getvalue())
+    return images
+
+
+def measure(function, repeat: int) -> float:
+    """Return the median wall time in seconds of `repeat` calls of `function`."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target-models", nargs="+", default=list(IMAGE_PROCESSORS), choices=list(IMAGE_PROCESSORS))
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--width", type=int, default=2550)
+    parser.add_argument("--height", type=int, default=3300)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    encoded = scans(args.batch_size, args.width, args.height)
+
+    def decoded():
+        """Decode the images at full resolution, as `datasets` does."""
+        images = [Image.open(io.BytesIO(data)) for data in encoded]
+        for image in images:
+            image.load()
+        return images
+
+    results = {}
+    for target_model in args.target_models:
+        processor_class, flip_channel_order = IMAGE_PROCESSORS[target_model]
+        image_processor = processor_class(apply_ocr=False)
+
+        def current(images):
+            return np.stack(image_processor(images=[image.convert("RGB") for image in images])["pixel_values"])
+
+        def fast(images):
+            return batch_pixel_values(images, image_processor, flip_channel_order)
+
+        reference = current(decoded())
+        undecoded = [{"bytes": data, "path": None} for data in encoded]
+        timings = {
+            "current_seconds": measure(lambda: current(decoded()), args.repeat),
+            "fast_decoded_seconds": measure(lambda: fast(decoded()), args.repeat),
+            "fast_undecoded_seconds": measure(lambda: fast(undecoded), args.repeat),
+        }
+        results[target_model] = {
+            **timings,
+            "decoded_speedup": timings["current_seconds"] / timings["fast_decoded_seconds"],
+            "undecoded_speedup": timings["current_seconds"] / timings["fast_undecoded_seconds"],
+            "mean_abs_difference": float(np.abs(fast(undecoded).astype(np.float32) - reference).mean()),
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compare `_get_label_list` with the chunked `_get_label_list_from_dataset` on a large label column.
+
+Run it with `python benchmarks/label_discovery.py --num-tokens 10000000`.
+"""
+import argparse
+import json
+import time
+import tracemalloc
+
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+
+from document_tools.utils import _get_label_list, _get_label_list_from_dataset
+
+
+def build_dataset(num_tokens: int, tokens_per_row: int, num_labels: int) -> Dataset:
+    """Build a dataset whose `label` column holds `num_tokens` labels split in rows of `tokens_per_row` labels."""
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, num_labels, size=num_tokens, dtype=np.int64)
+    offsets = np.append(np.arange(0, num_tokens, tokens_per_row, dtype=np.int32), np.int32(num_tokens))
+    labels = pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))
+    return Dataset(pa.table({"label": labels}))
+
+
+def measure(function, *args, **kwargs):
+    """Return the wall time in seconds and the peak of Python allocations in bytes of a call."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--num-tokens", type=int, default=10_000_000)
+    parser.add_argument("--tokens-per-row", type=int, default=512)
+    parser.add_argument("--num-labels", type=int, default=50)
+    parser.add_argument("--chunk-size", type=int, default=100_000)
+    args = parser.parse_args()
+
+    dataset = build_dataset(args.num_tokens, args.tokens_per_row, args.num_labels)
+
+    current, current_time, current_peak = measure(lambda: _get_label_list(dataset["label"]))
+    chunked, chunked_time, chunked_peak = measure(
+        _get_label_list_from_dataset, dataset, "label", chunk_size=args.chunk_size
+    )
+    assert current == chunked, "Both implementations must return the same labels."
+
+    print(
+        json.dumps(
+            {
+                "num_tokens": args.num_tokens,
+                "num_rows": len(dataset),
+                "_get_label_list": {"seconds": current_time, "peak_python_bytes": current_peak},
+                "_get_label_list_from_dataset": {"seconds": chunked_time, "peak_python_bytes": chunked_peak},
+                "speedup": current_time / chunked_time,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
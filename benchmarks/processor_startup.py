@@ -0,0 +1,72 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure the startup latency of the encoders with a cold and a warm processor registry.
+
+Run it with `python benchmarks/processor_startup.py`. The pretrained processors must be reachable from the Hub or
+already be in the local cache of 🤗 Transformers.
+"""
+import argparse
+import json
+import pickle
+import time
+
+from document_tools import TARGET_MODELS
+from document_tools.encoders.encoders import clear_processor_cache
+
+
+def measure(function, repeat: int) -> float:
+    """Return the median wall time in seconds of `repeat` calls of `function`."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+def main():
+    """Run the benchmark and print the results as JSON."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target-models", nargs="+", default=list(TARGET_MODELS), choices=list(TARGET_MODELS))
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for target_model in args.target_models:
+        encoder_class = TARGET_MODELS[target_model]
+
+        def cold():
+            clear_processor_cache()
+            encoder_class(labels=[0, 1])
+
+        cold_seconds = measure(cold, args.repeat)
+        encoder = encoder_class(labels=[0, 1])
+        warm_seconds = measure(lambda: encoder_class(labels=[0, 1]), args.repeat)
+        unpickle_seconds = measure(lambda: pickle.loads(pickle.dumps(encoder)), args.repeat)
+
+        results[target_model] = {
+            "cold_seconds": cold_seconds,
+            "warm_seconds": warm_seconds,
+            "warm_unpickle_seconds": unpickle_seconds,
+            "pickled_bytes": len(pickle.dumps(encoder)),
+            "speedup": cold_seconds / warm_seconds,
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
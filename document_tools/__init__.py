@@ -6,6 +6,22 @@ __version__ = "0.1.2"
 
 
 from .encoders import TARGET_MODELS, LayoutLMv2Encoder, LayoutLMv3Encoder, LayoutXLMEncoder
+from .incremental import load_incremental
+from .ingest import ingest_directory
+from .instrumentation import EncodingStats
+from .serving import EncodingService
+from .sharding import merge_shards
 from .tokenize import tokenize_dataset
 
-__all__ = ["LayoutLMv2Encoder", "LayoutLMv3Encoder", "LayoutXLMEncoder", "TARGET_MODELS", "tokenize_dataset"]
+__all__ = [
+    "EncodingService",
+    "EncodingStats",
+    "LayoutLMv2Encoder",
+    "LayoutLMv3Encoder",
+    "LayoutXLMEncoder",
+    "TARGET_MODELS",
+    "ingest_directory",
+    "load_incremental",
+    "merge_shards",
+    "tokenize_dataset",
+]
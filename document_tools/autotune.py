@@ -0,0 +1,157 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""autotune.py picks the batch size of the encoders from measurements on the first rows of a dataset."""
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import numpy as np
+from datasets import Dataset, IterableDataset
+
+from .utils import _call_measuring_rss, _current_rss
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZES = (1, 2, 4, 8, 16, 32, 64)
+DEFAULT_WRITE_BUFFER_SIZE = 64 * 1024**2
+
+
+@dataclass
+class BatchSizeTuning:
+    """
+    Result of the batch size tuning.
+
+    Attributes
+    ----------
+    batch_size : int
+        Batch size with the best throughput within the memory ceiling.
+    writer_batch_size : int
+        Number of rows buffered before each Arrow write, a multiple of `batch_size`.
+    pages_per_second : Dict[int, float]
+        Measured throughput of each tried batch size.
+    peak_memory : Dict[int, int]
+        Measured peak growth of the resident memory while encoding a batch, in bytes, for each tried batch size.
+    row_size : int
+        Measured size of an encoded row in bytes.
+    """
+
+    batch_size: int
+    writer_batch_size: int
+    pages_per_second: Dict[int, float] = field(default_factory=dict)
+    peak_memory: Dict[int, int] = field(default_factory=dict)
+    row_size: int = 0
+
+
+def _take_rows(dataset: Union[Dataset, IterableDataset], num_rows: int) -> Dict[str, List[Any]]:
+    """Read the first rows of a dataset as a batch."""
+    if isinstance(dataset, Dataset):
+        return dataset[: min(num_rows, len(dataset))]
+    rows = list(dataset.take(num_rows))
+    return {column: [row[column] for row in rows] for column in (rows[0] if rows else {})}
+
+
+def _encoded_size(encoded: Dict[str, Any]) -> int:
+    """Size in bytes of an encoded batch once converted to arrays."""
+    size = 0
+    for value in encoded.values():
+        try:
+            size += np.asarray(value).nbytes
+        except ValueError:
+            size += sum(np.asarray(item).nbytes for item in value)
+    return size
+
+
+def find_batch_size(
+    encoder: Callable[[Dict[str, List[Any]]], Dict[str, Any]],
+    dataset: Union[Dataset, IterableDataset],
+    batch_sizes: Sequence[int] = DEFAULT_BATCH_SIZES,
+    max_rss: Optional[int] = None,
+    num_proc: Optional[int] = None,
+    write_buffer_size: int = DEFAULT_WRITE_BUFFER_SIZE,
+) -> BatchSizeTuning:
+    """
+    Find the batch size that maximizes the throughput of an encoder within a memory ceiling.
+
+    Batches of growing size are taken from the first rows of the dataset and encoded once each, after a warm-up batch
+    of one row. The throughput and the peak growth of the resident memory, sampled in a thread so that it includes the
+    image buffers and the allocations of the tokenizers outside of the Python heap, are measured for each batch, and
+    the tuning stops at the first batch size that would exceed `max_rss`.
+
+    Parameters
+    ----------
+    encoder : Callable
+        Encoder called on the batches, as in `datasets.map`.
+    dataset : Dataset or IterableDataset
+        Dataset whose first rows are encoded to take the measurements.
+    batch_sizes : Sequence[int] (default=(1, 2, 4, 8, 16, 32, 64))
+        Batch sizes to try, in increasing order.
+    max_rss : int, optional (default=None)
+        Ceiling of the resident memory of all the encoding processes together, in bytes. Each of the `num_proc`
+        processes is assumed to use the resident memory before a batch plus its peak growth while encoding the batch.
+    num_proc : int, optional (default=None)
+        Number of processes that will encode the dataset.
+    write_buffer_size : int (default=64MiB)
+        Target size of the encoded rows buffered before each Arrow write, used to pick the writer batch size.
+
+    Returns
+    -------
+    BatchSizeTuning
+        The chosen batch and writer batch sizes, and the measurements.
+    """
+    batch_sizes = sorted(batch_sizes)
+    if not batch_sizes or batch_sizes[0] < 1:
+        raise ValueError(f"The batch sizes to try must be positive integers, not {batch_sizes}")
+
+    rows = _take_rows(dataset, batch_sizes[-1])
+    num_rows = len(next(iter(rows.values()), []))
+    if num_rows == 0:
+        raise ValueError("The dataset is empty, the batch size can't be tuned.")
+
+    encoder({column: values[:1] for column, values in rows.items()})
+    num_workers = max(num_proc or 1, 1)
+    tuning = BatchSizeTuning(batch_size=1, writer_batch_size=1)
+    best_throughput = 0.0
+
+    for batch_size in batch_sizes:
+        if batch_size > num_rows:
+            break
+        batch = {column: values[:batch_size] for column, values in rows.items()}
+
+        rss = _current_rss()
+        start = time.perf_counter()
+        encoded, peak = _call_measuring_rss(encoder, batch)
+        elapsed = time.perf_counter() - start
+
+        if max_rss is not None and batch_size > batch_sizes[0] and (rss + peak) * num_workers > max_rss:
+            logger.info(f"Batch size {batch_size} would exceed the memory ceiling of {max_rss} bytes.")
+            break
+
+        throughput = batch_size / max(elapsed, 1e-9)
+        tuning.pages_per_second[batch_size] = throughput
+        tuning.peak_memory[batch_size] = peak
+        if throughput > best_throughput:
+            best_throughput = throughput
+            tuning.batch_size = batch_size
+            tuning.row_size = max(_encoded_size(encoded) // batch_size, 1)
+
+    rows_per_write = max(write_buffer_size // max(tuning.row_size, 1), 1)
+    tuning.writer_batch_size = max(rows_per_write // tuning.batch_size, 1) * tuning.batch_size
+    logger.info(
+        f"Chose a batch size of {tuning.batch_size} and a writer batch size of {tuning.writer_batch_size}. Measured "
+        f"pages per second: {tuning.pages_per_second}, peak memory per batch: {tuning.peak_memory}."
+    )
+    return tuning
@@ -0,0 +1,291 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+bench.py measures the throughput of `tokenize_dataset` on synthetic documents.
+
+Run it with `python -m document_tools.bench --help`. The documents are generated locally and OCR is replaced by a
+deterministic stand-in, so the benchmark runs offline as long as the processors of the target models are in the local
+cache of 🤗 Transformers. Each configuration runs in a fresh process, and the results are printed as JSON.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing
+import random
+import resource
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from queue import Empty
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from datasets import Dataset, Features, Image
+from datasets import Sequence as SequenceFeature
+from datasets import Value
+from PIL import Image as PILImage
+from PIL import ImageDraw
+
+from .encoders import TARGET_MODELS, CallableOCR
+from .instrumentation import EncodingStats
+from .tokenize import tokenize_dataset
+
+VOCABULARY = (
+    "invoice total amount date due customer address payment tax number quantity price description order reference bank "
+    "account balance item receipt"
+).split()
+
+
+@dataclass
+class BenchmarkConfig:
+    """Configuration of a benchmark run."""
+
+    target_model: str
+    batch_size: int
+    num_proc: Optional[int]
+    num_pages: int = 32
+    page_size: Tuple[int, int] = (850, 1100)
+    words_per_page: int = 100
+    seed: int = 0
+
+
+@dataclass
+class BenchmarkResult:
+    """Measurements of a benchmark run."""
+
+    config: BenchmarkConfig
+    seconds: float
+    pages_per_second: float
+    peak_rss: int
+    bytes_written: int
+    stages: Dict[str, Dict[str, float]] = field(default_factory=dict)
+
+
+def generate_documents(
+    num_pages: int, page_size: Tuple[int, int] = (850, 1100), words_per_page: int = 100, seed: int = 0
+) -> Dataset:
+    """
+    Generate a dataset of synthetic document images, with text drawn on a white page.
+
+    Parameters
+    ----------
+    num_pages : int
+        Number of pages.
+    page_size : Tuple[int, int] (default=(850, 1100))
+        Width and height of the pages in pixels.
+    words_per_page : int (default=100)
+        Number of words drawn on each page.
+    seed : int (default=0)
+        Seed of the generator, the same seed always generates the same documents.
+
+    Returns
+    -------
+    Dataset
+        Dataset with an `image` column and a `label` column of lists with one label.
+    """
+    rng = random.Random(seed)
+    width, height = page_size
+    images, labels = [], []
+    for _ in range(num_pages):
+        image = PILImage.new("RGB", page_size, "white")
+        draw = ImageDraw.Draw(image)
+        for _ in range(words_per_page):
+            draw.text(
+                (rng.randrange(0, max(width - 80, 1)), rng.randrange(0, max(height - 12, 1))),
+                rng.choice(VOCABULARY),
+                fill="black",
+            )
+        images.append(image)
+        labels.append([rng.randrange(0, 4)])
+
+    features = Features({"image": Image(), "label": SequenceFeature(Value(dtype="int64"))})
+    return Dataset.from_dict({"image": images, "label": labels}, features=features)
+
+
+def synthetic_ocr(image: PILImage.Image) -> Tuple[List[str], List[List[int]]]:
+    """
+    Deterministic stand-in for Tesseract, returning pseudo-random words and boxes seeded by the image content.
+
+    The number of words grows with the number of dark pixels of the page, so denser pages produce longer sequences.
+    """
+    grayscale = image.convert("L")
+    histogram = grayscale.histogram()
+    num_words = min(sum(histogram[:128]) // 200, 512)
+    rng = random.Random(hashlib.sha256(grayscale.tobytes()).digest())
+
+    words, boxes = [], []
+    for _ in range(num_words):
+        left, top = rng.randrange(0, 950), rng.randrange(0, 980)
+        words.append(rng.choice(VOCABULARY))
+        boxes.append([left, top, left + 50, top + 20])
+    return words, boxes
+
+
+def _peak_rss() -> int:
+    """Peak resident memory of the process and of its finished children, in bytes."""
+    scale = 1 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale
+
+
+def run_configuration(config: BenchmarkConfig) -> BenchmarkResult:
+    """
+    Run a benchmark configuration in the current process.
+
+    Parameters
+    ----------
+    config : BenchmarkConfig
+        Configuration of the run.
+
+    Returns
+    -------
+    BenchmarkResult
+        The measurements of the run. The peak resident memory includes everything the current process did before.
+    """
+    dataset = generate_documents(config.num_pages, config.page_size, config.words_per_page, config.seed)
+    stats = EncodingStats()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_dir = Path(tmp_dir)
+        start = time.perf_counter()
+        tokenize_dataset(
+            dataset,
+            target_model=config.target_model,
+            batch_size=config.batch_size,
+            num_proc=config.num_proc,
+            separate_ocr=True,
+            ocr_num_proc=config.num_proc,
+            ocr_cache_file_names={"train": str(cache_dir / "ocr.arrow")},
+            cache_file_names={"train": str(cache_dir / "encoded.arrow")},
+            stats=stats,
+            ocr_backend=CallableOCR(synthetic_ocr, name="synthetic"),
+        )
+        seconds = time.perf_counter() - start
+        bytes_written = sum(path.stat().st_size for path in cache_dir.rglob("*") if path.is_file())
+
+    return BenchmarkResult(
+        config=config,
+        seconds=seconds,
+        pages_per_second=config.num_pages / seconds,
+        peak_rss=_peak_rss(),
+        bytes_written=bytes_written,
+        stages=stats.summary(),
+    )
+
+
+def _run_in_process(config: BenchmarkConfig, results: Any):
+    """Run a configuration and send its result through a queue."""
+    results.put(asdict(run_configuration(config)))
+
+
+def _receive_result(config: BenchmarkConfig, process: Any, results: Any) -> Dict[str, Any]:
+    """Wait for the result of a configuration, or raise an error if its process exits without sending it."""
+    while True:
+        try:
+            return results.get(timeout=1)
+        except Empty:
+            if process.is_alive():
+                continue
+        # The result may have been flushed just before the process exited.
+        try:
+            return results.get(timeout=1)
+        except Empty:
+            process.join()
+            raise RuntimeError(f"The benchmark of {config} failed with exit code {process.exitcode}.")
+
+
+def run_benchmark(configs: Sequence[BenchmarkConfig]) -> List[Dict[str, Any]]:
+    """
+    Run benchmark configurations, each one in a fresh process so that their peak resident memory is isolated.
+
+    Parameters
+    ----------
+    configs : Sequence[BenchmarkConfig]
+        Configurations to run.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        The measurements of each configuration, as dictionaries that can be serialized to JSON.
+    """
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for config in configs:
+        queue = context.Queue()
+        process = context.Process(target=_run_in_process, args=(config, queue))
+        process.start()
+        # The result is read before joining the process: a process that put a large result in a queue does not exit
+        # until it is consumed.
+        results.append(_receive_result(config, process, queue))
+        process.join()
+    return results
+
+
+def _environment() -> Dict[str, str]:
+    """Versions of the software the benchmark ran with."""
+    import datasets
+    import transformers
+
+    from . import __version__
+
+    return {
+        "document_tools": __version__,
+        "datasets": datasets.__version__,
+        "transformers": transformers.__version__,
+        "python": sys.version.split()[0],
+        "platform": sys.platform,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def main(args: Optional[Sequence[str]] = None):
+    """Parse the command line, run the benchmark grid and print the results as JSON."""
+    parser = argparse.ArgumentParser(prog="python -m document_tools.bench", description=__doc__)
+    parser.add_argument("--target-models", nargs="+", default=list(TARGET_MODELS), choices=list(TARGET_MODELS))
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[2, 8])
+    parser.add_argument("--num-procs", nargs="+", type=int, default=[1], help="0 runs without worker processes.")
+    parser.add_argument("--num-pages", type=int, default=32)
+    parser.add_argument("--page-size", nargs=2, type=int, default=[850, 1100], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--words-per-page", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=None, help="File where the JSON results are written.")
+    parsed = parser.parse_args(args)
+
+    configs = [
+        BenchmarkConfig(
+            target_model=target_model,
+            batch_size=batch_size,
+            num_proc=num_proc or None,
+            num_pages=parsed.num_pages,
+            page_size=tuple(parsed.page_size),
+            words_per_page=parsed.words_per_page,
+            seed=parsed.seed,
+        )
+        for target_model, batch_size, num_proc in itertools.product(
+            parsed.target_models, parsed.batch_sizes, parsed.num_procs
+        )
+    ]
+    report = json.dumps({"environment": _environment(), "results": run_benchmark(configs)}, indent=2)
+    if parsed.output is not None:
+        parsed.output.write_text(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""checkpoint.py writes the encoded dataset shard by shard, so that an interrupted run resumes from the last shard."""
+import json
+import logging
+import os
+import shutil
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+from datasets import Dataset, DatasetDict, Features, concatenate_datasets, config, load_from_disk
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_FILE_NAME = "tokenize_progress.json"
+SHARDS_DIR_NAME = "shards"
+
+EncodeShard = Callable[[DatasetDict, Dict[str, str]], DatasetDict]
+
+
+def _write_json(path: Path, value: Any):
+    """Write a JSON file atomically, so that a crash never leaves it half written."""
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    tmp_path.write_text(json.dumps(value))
+    os.replace(tmp_path, path)
+
+
+class ShardedOutput:
+    """
+    ShardedOutput encodes each split in contiguous shards, each one saved in `save_path` as soon as it is encoded.
+
+    The `num_proc` workers of the encoder write the Arrow files of a shard in parallel, and the shard is saved as a
+    dataset in the `shards` directory of `save_path`. A progress file records the finished shards. When the run is
+    interrupted, the next run with the same dataset and configuration skips the finished shards. Once all the shards
+    are saved, each split is built by concatenating its shards and saved with `save_to_disk`, so that the output can be
+    loaded with `datasets.load_from_disk`, and the shards are removed.
+    """
+
+    def __init__(self, save_path: str, num_shards: int, key: str):
+        """
+        Initialize the sharded output.
+
+        Parameters
+        ----------
+        save_path : str
+            Directory where the encoded dataset is saved.
+        num_shards : int
+            Number of shards of each split. Splits with less rows than shards have one shard per row.
+        key : str
+            Fingerprint of the dataset and of the encoder configuration. The progress of a previous run is only
+            resumed if it has the same key.
+        """
+        if num_shards < 1:
+            raise ValueError(f"The number of output shards must be a positive integer, not {num_shards}.")
+        self.save_path = Path(save_path)
+        self.shards_path = self.save_path / SHARDS_DIR_NAME
+        self.num_shards = num_shards
+        self.key = key
+        self.progress: Dict[str, List[int]] = {}
+        self.complete = False
+
+        progress_path = self.save_path / PROGRESS_FILE_NAME
+        if progress_path.is_file():
+            progress = json.loads(progress_path.read_text())
+            if progress["key"] == key:
+                self.progress = progress["shards"]
+                # The shards are removed once the output is saved, so a removed output is encoded again.
+                self.complete = progress["complete"] and (self.save_path / config.DATASETDICT_JSON_FILENAME).is_file()
+                if progress["complete"] and not self.complete:
+                    self.progress = {}
+            else:
+                logger.warning(
+                    f"The shards saved in {save_path} are for another dataset or configuration, replacing them."
+                )
+                shutil.rmtree(self.shards_path, ignore_errors=True)
+
+    def _save_progress(self):
+        """Record the finished shards, and whether the output is complete."""
+        _write_json(
+            self.save_path / PROGRESS_FILE_NAME, {"key": self.key, "shards": self.progress, "complete": self.complete}
+        )
+
+    def encode(self, dataset: DatasetDict, encode_shard: EncodeShard, features: Features) -> DatasetDict:
+        """
+        Encode and save the shards of each split that are not finished yet, then save the whole encoded dataset.
+
+        Parameters
+        ----------
+        dataset : DatasetDict
+            Dataset to encode.
+        encode_shard : Callable[[DatasetDict, Dict[str, str]], DatasetDict]
+            Function encoding a dataset with one split into the given cache file of the split.
+        features : Features
+            Features of the encoded dataset.
+
+        Returns
+        -------
+        DatasetDict
+            The encoded dataset, loaded from `save_path`.
+        """
+        if self.complete:
+            return load_from_disk(str(self.save_path))
+
+        self.save_path.mkdir(parents=True, exist_ok=True)
+        shard_paths = {
+            split: self._encode_split(split, split_dataset, encode_shard, features)
+            for split, split_dataset in dataset.items()
+        }
+
+        DatasetDict(
+            {
+                split: concatenate_datasets([load_from_disk(str(path)) for path in paths])
+                for split, paths in shard_paths.items()
+            }
+        ).save_to_disk(str(self.save_path))
+        self.complete = True
+        self._save_progress()
+        shutil.rmtree(self.shards_path)
+        return load_from_disk(str(self.save_path))
+
+    def _encode_split(
+        self, split: str, split_dataset: Dataset, encode_shard: EncodeShard, features: Features
+    ) -> List[Path]:
+        """Encode and save the shards of a split that are not finished yet, and return the directories of them all."""
+        split_path = self.shards_path / split
+        split_path.mkdir(parents=True, exist_ok=True)
+        finished = self.progress.setdefault(split, [])
+        num_shards = max(min(self.num_shards, len(split_dataset)), 1)
+
+        shard_paths = []
+        for index in range(num_shards):
+            shard_path = split_path / f"{index:05d}-of-{num_shards:05d}"
+            shard_paths.append(shard_path)
+            if index in finished:
+                continue
+            # Remove what an interrupted run left of the shard.
+            shutil.rmtree(shard_path, ignore_errors=True)
+            for stale_file in split_path.glob(f"{shard_path.name}*.arrow"):
+                stale_file.unlink()
+
+            shard = split_dataset.shard(num_shards, index, contiguous=True)
+            if len(shard) > 0:
+                encoded = encode_shard(
+                    DatasetDict({split: shard}), {split: str(split_path / f"{shard_path.name}.arrow")}
+                )
+                encoded[split].save_to_disk(str(shard_path))
+                for cache_file in encoded[split].cache_files:
+                    Path(cache_file["filename"]).unlink()
+            else:
+                Dataset.from_dict({column: [] for column in features}, features=features).save_to_disk(str(shard_path))
+
+            finished.append(index)
+            self._save_progress()
+            logger.info(f"Wrote shard {index + 1}/{num_shards} of the {split} split.")
+        return shard_paths
@@ -0,0 +1,249 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""collate.py groups the functions used to turn encoded rows into training batches."""
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+import pyarrow.compute as pc
+from datasets import Dataset
+
+# Columns with one value per token, padded on the right to the longest row of a batch, with the shape of one value.
+TOKEN_COLUMNS = {"input_ids": (), "attention_mask": (), "token_type_ids": (), "bbox": (4,)}
+
+
+def _widen(value: Any) -> Any:
+    """Widen an integer array, or a list of integer arrays, to int64."""
+    if isinstance(value, np.ndarray):
+        if value.dtype.kind in "iu" and value.dtype != np.int64:
+            return value.astype(np.int64)
+        if value.dtype == object:
+            widened = np.empty(len(value), dtype=object)
+            for index, item in enumerate(value):
+                widened[index] = _widen(item)
+            return widened
+        return value
+    if isinstance(value, list):
+        return [_widen(item) for item in value]
+    return value
+
+
+def widen_batch(batch: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Widen the integer columns of a batch stored with compact dtypes back to int64.
+
+    Datasets encoded with `compact_features=True` store pixels as uint8, boxes as int16, ids as int32 and masks as
+    int8. Widening them lazily, when a batch is loaded or collated, keeps the data small on disk and in the Arrow cache
+    while the model still receives int64 tensors. Note that the `torch` format of 🤗 Datasets already widens integer
+    columns to int64.
+
+    Parameters
+    ----------
+    batch : Dict[str, Any]
+        Batch in the `numpy` format, for example `dataset.with_format("numpy")[:8]`.
+
+    Returns
+    -------
+    Dict[str, Any]
+        The batch with its integer arrays cast to int64, the other values are left untouched.
+    """
+    return {column: _widen(value) for column, value in batch.items()}
+
+
+def sequence_lengths(dataset: Dataset, column: str = "input_ids", chunk_size: int = 10_000) -> np.ndarray:
+    """
+    Get the number of tokens of each row of a dataset encoded with `variable_length=True`.
+
+    The lengths are read from the offsets of the Arrow lists, in chunks, so the tokens themselves are never decoded.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Encoded dataset.
+    column : str (default="input_ids")
+        Column with one value per token.
+    chunk_size : int (default=10_000)
+        Number of rows read at once.
+
+    Returns
+    -------
+    np.ndarray
+        Number of tokens of each row.
+    """
+    arrow_dataset = dataset.select_columns([column]).with_format("arrow")
+    lengths = [
+        pc.list_value_length(arrow_dataset[start : start + chunk_size].column(column)).to_numpy(zero_copy_only=False)
+        for start in range(0, len(dataset), chunk_size)
+    ]
+    return np.concatenate(lengths).astype(np.int64) if lengths else np.zeros(0, dtype=np.int64)
+
+
+def _pad(values: List[Any], length: int, pad_value: int, value_shape: tuple) -> np.ndarray:
+    """Pad the token values of each row on the right to `length`, in an int64 array."""
+    padded = np.full((len(values), length) + value_shape, pad_value, dtype=np.int64)
+    for row, value in enumerate(values):
+        value = np.asarray(value, dtype=np.int64).reshape((-1,) + value_shape)
+        padded[row, : len(value)] = value
+    return padded
+
+
+@dataclass
+class PaddingCollator:
+    """
+    PaddingCollator pads the rows of a batch to its longest row, for datasets encoded with `variable_length=True`.
+
+    The ids are padded with `pad_token_id`, the masks and token types with 0 and the boxes with `[0, 0, 0, 0]`, on the
+    right, as the LayoutLM tokenizers do. The other numeric columns, such as the pixel values and the labels, are
+    stacked. All the integer columns are returned in int64, including the ones stored with compact dtypes.
+
+    Attributes
+    ----------
+    pad_token_id : int (default=0)
+        Id of the padding token of the tokenizer, `processor.tokenizer.pad_token_id`. 0 for LayoutLMv2, 1 for
+        LayoutLMv3 and LayoutXLM.
+    pad_to_multiple_of : int, optional (default=None)
+        Round the padded length up to a multiple of this value, which helps the tensor cores of recent GPUs.
+    return_tensors : str (default="np")
+        Type of the returned arrays, "np" for numpy arrays or "pt" for torch tensors.
+    """
+
+    pad_token_id: int = 0
+    pad_to_multiple_of: Optional[int] = None
+    return_tensors: str = "np"
+
+    def __call__(self, rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Collate a list of rows into a batch.
+
+        Parameters
+        ----------
+        rows : List[Dict[str, Any]]
+            Rows of the encoded dataset, in the python or numpy format.
+
+        Returns
+        -------
+        Dict[str, Any]
+            Batch of arrays of shape (batch, length, ...) for the token columns, and stacked arrays for the others.
+        """
+        length = max(len(row["input_ids"]) for row in rows)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+
+        batch: Dict[str, Any] = {}
+        for column in rows[0]:
+            values = [row[column] for row in rows]
+            if column in TOKEN_COLUMNS:
+                pad_value = self.pad_token_id if column == "input_ids" else 0
+                batch[column] = _pad(values, length, pad_value, TOKEN_COLUMNS[column])
+                continue
+            stacked = np.stack([np.asarray(value) for value in values])
+            if stacked.dtype.kind in "biuf":
+                batch[column] = _widen(stacked)
+            else:
+                batch[column] = values
+
+        if self.return_tensors == "pt":
+            import torch
+
+            return {
+                column: torch.from_numpy(value) if isinstance(value, np.ndarray) else value
+                for column, value in batch.items()
+            }
+        return batch
+
+
+class LengthBucketSampler:
+    """
+    LengthBucketSampler groups rows of similar lengths into the same batches, so that little padding is needed.
+
+    The rows are shuffled, then split into buckets of `bucket_size` batches. The rows of each bucket are sorted by
+    length and cut into batches, and the order of all the batches is shuffled. The batches are random from one epoch
+    to the next, while the rows of a batch have close lengths. It can be used as the `batch_sampler` of a PyTorch
+    `DataLoader`, with a `PaddingCollator` as its `collate_fn`.
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[int],
+        batch_size: int,
+        bucket_size: int = 100,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+    ):
+        """
+        Initialize the sampler.
+
+        Parameters
+        ----------
+        lengths : Sequence[int]
+            Number of tokens of each row, for example `sequence_lengths(dataset)`.
+        batch_size : int
+            Number of rows of each batch.
+        bucket_size : int (default=100)
+            Number of batches of each bucket. Larger buckets give batches of closer lengths, but less random.
+        shuffle : bool (default=True)
+            Whether to shuffle the rows and the batches. If False, the rows are sorted by length within each bucket of
+            consecutive rows, and the batches are in order.
+        drop_last : bool (default=False)
+            Whether to drop the batches with less than `batch_size` rows.
+        seed : int (default=0)
+            Seed of the shuffling, combined with the epoch set with `set_epoch`.
+        """
+        if batch_size < 1 or bucket_size < 1:
+            raise ValueError(f"The batch size and bucket size must be positive, not {batch_size} and {bucket_size}.")
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch, so that each epoch has different batches."""
+        self.epoch = epoch
+
+    def _batches(self) -> List[np.ndarray]:
+        """Split the indices of the rows into batches."""
+        rng = np.random.default_rng([self.seed, self.epoch])
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        rows_per_bucket = self.batch_size * self.bucket_size
+
+        batches: List[np.ndarray] = []
+        for start in range(0, len(indices), rows_per_bucket):
+            bucket = indices[start : start + rows_per_bucket]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches.extend(
+                bucket[offset : offset + self.batch_size] for offset in range(0, len(bucket), self.batch_size)
+            )
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[index] for index in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        """Iterate over the batches of row indices."""
+        for batch in self._batches():
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        """Return the number of batches."""
+        # The buckets are made of whole batches, so only the last batch can be smaller.
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return -(-len(self.lengths) // self.batch_size)
@@ -0,0 +1,412 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""dedup.py finds the duplicate pages of a dataset, so that each unique page is only encoded once."""
+import hashlib
+import io
+import json
+import logging
+import time
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from datasets import Dataset, DatasetDict, Features, Image, Value
+from PIL import Image as PILImage
+
+from .encoders.images import open_image, reduce_image
+from .incremental import _value_bytes
+from .instrumentation import EncodingStats
+
+logger = logging.getLogger(__name__)
+
+# The perceptual hash compares the brightness of neighbouring cells of a (HASH_SIZE + 1, HASH_SIZE) grid over the page,
+# which gives HASH_SIZE ** 2 bits. Pages are much more alike than photos, so the hash is larger than the usual 8. The
+# brightness of a cell is the mean of BLOCK_SIZE * BLOCK_SIZE pixels, in floating point: mostly white pages have many
+# neighbouring cells of the same rounded brightness, whose bits flip as soon as the page is re-encoded.
+HASH_SIZE = 16
+BLOCK_SIZE = 8
+# Re-encoded or rescaled pages differ in a few bits, different pages in several dozens. Pages filled from the same
+# template can be as close as re-encoded pages, so the near duplicates are confirmed by comparing their thumbnails.
+NEAR_DUPLICATE_DISTANCE = 12
+# Re-encoded or rescaled pages differ by a few levels of grey in each pixel of their thumbnails, a single filled field
+# by several dozens in the pixels it covers.
+THUMBNAIL_SIZE = (48, 64)
+MAX_PIXEL_DIFFERENCE = 16
+
+HASH_FEATURES = Features({"exact_hash": Value(dtype="string"), "perceptual_hash": Value(dtype="string")})
+
+
+def perceptual_hash(image: PILImage.Image, hash_size: int = HASH_SIZE) -> int:
+    """
+    Compute the difference hash of an image, which changes little when the image is re-encoded, rescaled or noisy.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image
+        Image of the page, decoded or not.
+    hash_size : int (default=16)
+        Number of rows of the grid over the page, the hash has `hash_size ** 2` bits.
+
+    Returns
+    -------
+    int
+        The hash, whose bit `i` is set if the cell `i` of the grid is brighter than its right neighbour.
+    """
+    size = ((hash_size + 1) * BLOCK_SIZE, hash_size * BLOCK_SIZE)
+    pixels = np.asarray(reduce_image(image, size).convert("L"), dtype=np.float32)
+    cells = pixels.reshape(hash_size, BLOCK_SIZE, hash_size + 1, BLOCK_SIZE).mean(axis=(1, 3))
+    bits = (cells[:, :-1] > cells[:, 1:]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def thumbnail(image: PILImage.Image) -> np.ndarray:
+    """
+    Shrink an image to a grayscale thumbnail of `THUMBNAIL_SIZE`, to confirm that two pages are near duplicates.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image
+        Image of the page, decoded or not.
+
+    Returns
+    -------
+    np.ndarray
+        The levels of grey of the thumbnail, as float32.
+    """
+    return np.asarray(reduce_image(image, THUMBNAIL_SIZE).convert("L"), dtype=np.float32)
+
+
+def _open_value(value: Any) -> PILImage.Image:
+    """Open an image stored as bytes, or as a value of the `Image` feature of `datasets`."""
+    return PILImage.open(io.BytesIO(value)) if isinstance(value, bytes) else open_image(value)
+
+
+def _hash_images(batch: Dict[str, List], image_column: str) -> Dict[str, List]:
+    """Compute the exact hash of the stored bytes and the perceptual hash of each image of a batch."""
+    exact_hashes: List[str] = []
+    perceptual_hashes: List[Optional[str]] = []
+    for value in batch[image_column]:
+        exact_hashes.append(hashlib.blake2b(_value_bytes(value), digest_size=16).hexdigest())
+        try:
+            with _open_value(value) as image:
+                perceptual_hashes.append(f"{perceptual_hash(image):x}")
+        except Exception:
+            # Without a perceptual hash, the image is only compared by its bytes.
+            perceptual_hashes.append(None)
+    return {"exact_hash": exact_hashes, "perceptual_hash": perceptual_hashes}
+
+
+class PerceptualIndex:
+    """
+    PerceptualIndex finds a hash within a Hamming distance of the hashes added to it, without comparing all of them.
+
+    The bits of the hashes are split into `max_distance + 1` bands. Two hashes that differ in at most `max_distance`
+    bits have at least one identical band, so only the hashes sharing a band with the query are compared.
+    """
+
+    def __init__(self, max_distance: int, num_bits: int = HASH_SIZE**2):
+        """
+        Initialize an empty index.
+
+        Parameters
+        ----------
+        max_distance : int
+            Maximum number of different bits between two hashes of near-duplicate images.
+        num_bits : int (default=256)
+            Number of bits of the hashes.
+        """
+        if not 0 <= max_distance < num_bits:
+            raise ValueError(f"`max_distance` must be between 0 and {num_bits - 1} bits, not {max_distance}.")
+        self.max_distance = max_distance
+        boundaries = np.linspace(0, num_bits, max_distance + 2).astype(int)
+        self._bands = [(int(start), int(end - start)) for start, end in zip(boundaries[:-1], boundaries[1:])]
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in self._bands]
+        self._hashes: List[int] = []
+        self._rows: List[int] = []
+
+    def __len__(self) -> int:
+        """Return the number of hashes in the index."""
+        return len(self._hashes)
+
+    def _band_keys(self, value: int) -> List[int]:
+        """Split a hash into its bands."""
+        return [(value >> start) & ((1 << width) - 1) for start, width in self._bands]
+
+    def find(self, value: int, accept: Optional[Callable[[int], bool]] = None) -> Optional[int]:
+        """
+        Find the row of the first hash added within `max_distance` bits of a hash.
+
+        Parameters
+        ----------
+        value : int
+            Hash to look up.
+        accept : Callable[[int], bool], optional (default=None)
+            Function confirming each row found within `max_distance` bits. The rows it rejects are skipped.
+
+        Returns
+        -------
+        int, optional
+            The row of the hash found, or None if there is none.
+        """
+        rejected = set()
+        for band, key in enumerate(self._band_keys(value)):
+            for entry in self._buckets[band].get(key, ()):
+                if entry in rejected or bin(self._hashes[entry] ^ value).count("1") > self.max_distance:
+                    continue
+                if accept is None or accept(self._rows[entry]):
+                    return self._rows[entry]
+                rejected.add(entry)
+        return None
+
+    def add(self, value: int, row: int):
+        """
+        Add the hash of a row to the index.
+
+        Parameters
+        ----------
+        value : int
+            Hash of the row.
+        row : int
+            Row returned by `find` for the hashes close to this one.
+        """
+        entry = len(self._hashes)
+        self._hashes.append(value)
+        self._rows.append(row)
+        for band, key in enumerate(self._band_keys(value)):
+            self._buckets[band].setdefault(key, []).append(entry)
+
+
+def find_duplicates(
+    exact_hashes: List[str],
+    perceptual_hashes: List[Optional[str]],
+    labels: List[Any],
+    max_distance: Optional[int] = None,
+    confirm: Optional[Callable[[int, int], bool]] = None,
+) -> List[int]:
+    """
+    Find the first row each row duplicates, among the rows with the same label.
+
+    A row duplicates a previous row if the stored bytes of their images are identical, or if the perceptual hashes of
+    their images differ in at most `max_distance` bits and `confirm` accepts them. The rows with different labels are
+    never duplicates, so that the encoded rows keep their own labels.
+
+    Parameters
+    ----------
+    exact_hashes : List[str]
+        Hash of the stored bytes of the image of each row.
+    perceptual_hashes : List[str, optional]
+        Hexadecimal perceptual hash of the image of each row, or None if it can't be decoded.
+    labels : List[Any]
+        Label of each row.
+    max_distance : int, optional (default=None)
+        Maximum number of different bits between the perceptual hashes of near-duplicate images. If None, only the
+        exact duplicates are found.
+    confirm : Callable[[int, int], bool], optional (default=None)
+        Function called with a row and a previous row whose perceptual hashes are close, returning whether they are
+        near duplicates. If None, the rows with close perceptual hashes are near duplicates.
+
+    Returns
+    -------
+    List[int]
+        For each row, the index of the first row with the same image, which is the row itself if it is unique.
+    """
+    exact_rows: Dict[Tuple[str, str], int] = {}
+    indexes: Dict[str, PerceptualIndex] = {}
+    representatives = []
+    for row, (exact_hash, hex_hash, label) in enumerate(zip(exact_hashes, perceptual_hashes, labels)):
+        label_key = json.dumps(label, sort_keys=True, default=repr)
+        representative = exact_rows.get((label_key, exact_hash))
+        if representative is None and max_distance is not None and hex_hash is not None:
+            index = indexes.setdefault(label_key, PerceptualIndex(max_distance))
+            accept = partial(confirm, row) if confirm is not None else None
+            representative = index.find(int(hex_hash, 16), accept)
+            if representative is None:
+                index.add(int(hex_hash, 16), row)
+        if representative is None:
+            representative = row
+        exact_rows.setdefault((label_key, exact_hash), representative)
+        representatives.append(representative)
+    return representatives
+
+
+class _ThumbnailComparison:
+    """Confirm that two rows of a split are near duplicates by comparing the thumbnails of their images."""
+
+    def __init__(self, images: Dataset, image_column: str):
+        self.images = images
+        self.image_column = image_column
+        self._thumbnails: Dict[int, Optional[np.ndarray]] = {}
+
+    def _thumbnail(self, row: int) -> Optional[np.ndarray]:
+        """Get the thumbnail of the image of a row, computed once, or None if it can't be decoded."""
+        if row not in self._thumbnails:
+            try:
+                with _open_value(self.images[row][self.image_column]) as image:
+                    self._thumbnails[row] = thumbnail(image)
+            except Exception:
+                self._thumbnails[row] = None
+        return self._thumbnails[row]
+
+    def __call__(self, row: int, previous_row: int) -> bool:
+        """Return whether no pixel of the thumbnails of the two rows differs by more than `MAX_PIXEL_DIFFERENCE`."""
+        first, second = self._thumbnail(row), self._thumbnail(previous_row)
+        if first is None or second is None:
+            return False
+        return bool(np.abs(first - second).max() <= MAX_PIXEL_DIFFERENCE)
+
+
+class Deduplication:
+    """
+    Deduplication encodes each unique page of a dataset once, and fans the encoded rows out to all the duplicate rows.
+
+    The exact and perceptual hashes of the images are computed with `datasets.map` in `num_proc` processes, from the
+    stored bytes of the images, and cached by `datasets`. Then the duplicates are found with `find_duplicates`, only
+    the first row of each group of duplicates is selected to be encoded, and the encoded rows are selected back in the
+    order of the input dataset. The near duplicates are confirmed by comparing the thumbnails of their images, which
+    are only computed for the rows whose perceptual hashes are close.
+    """
+
+    def __init__(
+        self,
+        max_distance: Optional[int] = None,
+        num_proc: Optional[int] = None,
+        stats: Optional[EncodingStats] = None,
+    ):
+        """
+        Initialize the deduplication.
+
+        Parameters
+        ----------
+        max_distance : int, optional (default=None)
+            Maximum number of different bits between the perceptual hashes of near-duplicate images, out of 256, for
+            example `NEAR_DUPLICATE_DISTANCE`. If None, only the images with identical bytes are duplicates.
+        num_proc : int, optional (default=None)
+            Number of processes hashing the images.
+        stats : EncodingStats, optional (default=None)
+            Stats in which the wall time of the `dedup` stage and the number of pages skipped, as the items of the
+            `dedup_skipped` stage, are recorded.
+        """
+        if max_distance is not None:
+            PerceptualIndex(max_distance)
+        self.max_distance = max_distance
+        self.num_proc = num_proc
+        self.stats = stats
+        self.representatives: Dict[str, List[int]] = {}
+        self.unique_rows: Dict[str, List[int]] = {}
+
+    @property
+    def num_skipped(self) -> int:
+        """Number of duplicate rows that are not encoded."""
+        return sum(len(rows) - len(self.unique_rows[split]) for split, rows in self.representatives.items())
+
+    @staticmethod
+    def _undecoded_images(dataset: Dataset, image_column: str) -> Dataset:
+        """Select the images of a split, without decoding the images stored as bytes with `datasets`."""
+        images = dataset.select_columns([image_column])
+        if isinstance(images.features[image_column], Image):
+            images = images.cast_column(image_column, Image(decode=False))
+        return images
+
+    def _hash_split(self, images: Dataset, image_column: str) -> Dataset:
+        """Hash the undecoded images of a split."""
+        return images.map(
+            _hash_images,
+            fn_kwargs={"image_column": image_column},
+            batched=True,
+            num_proc=self.num_proc,
+            remove_columns=[image_column],
+            features=HASH_FEATURES,
+            desc="Hashing the images",
+        )
+
+    def select_unique_rows(self, dataset: DatasetDict, image_column: str, label_column: str) -> DatasetDict:
+        """
+        Find the duplicates of each split and select the first row of each group of duplicates.
+
+        Parameters
+        ----------
+        dataset : DatasetDict
+            Dataset to encode.
+        image_column : str
+            Name of the column containing the image.
+        label_column : str
+            Name of the column containing the label.
+
+        Returns
+        -------
+        DatasetDict
+            The unique rows of each split, in their order.
+
+        Raises
+        ------
+        ValueError
+            If the dataset is iterable, the duplicates can only be found in the whole dataset.
+        """
+        if not isinstance(dataset, DatasetDict):
+            raise ValueError(
+                "The duplicates are found in the whole dataset, they can't be removed from an iterable one."
+            )
+
+        start = time.perf_counter()
+        unique = DatasetDict()
+        for split, split_dataset in dataset.items():
+            images = self._undecoded_images(split_dataset, image_column)
+            hashes = self._hash_split(images, image_column)
+            labels = split_dataset.select_columns([label_column]).with_format("arrow")[:].column(0).to_pylist()
+            representatives = find_duplicates(
+                hashes["exact_hash"],
+                hashes["perceptual_hash"],
+                labels,
+                max_distance=self.max_distance,
+                confirm=_ThumbnailComparison(images, image_column),
+            )
+            self.representatives[split] = representatives
+            self.unique_rows[split] = [
+                row for row, representative in enumerate(representatives) if row == representative
+            ]
+            unique[split] = split_dataset
+            if len(self.unique_rows[split]) < len(split_dataset):
+                unique[split] = split_dataset.select(self.unique_rows[split])
+
+        num_rows = sum(len(rows) for rows in self.representatives.values())
+        logger.info(f"Deduplication skips {self.num_skipped} duplicate pages of {num_rows}.")
+        if self.stats is not None:
+            self.stats.record("dedup", time.perf_counter() - start, items=num_rows)
+            self.stats.record("dedup_skipped", 0.0, items=self.num_skipped)
+        return unique
+
+    def fan_out(self, encoded: DatasetDict) -> DatasetDict:
+        """
+        Give each duplicate row the encoded row of the first row of its group, in the order of the input dataset.
+
+        Parameters
+        ----------
+        encoded : DatasetDict
+            The unique rows selected by `select_unique_rows`, encoded with one row per input row.
+
+        Returns
+        -------
+        DatasetDict
+            The encoded dataset with a row for each row of the input dataset. The duplicate rows are selected through
+            an indices mapping, without copying the encoded rows.
+        """
+        fanned_out = DatasetDict()
+        for split, representatives in self.representatives.items():
+            fanned_out[split] = encoded[split]
+            if len(self.unique_rows[split]) < len(representatives):
+                positions = {row: position for position, row in enumerate(self.unique_rows[split])}
+                fanned_out[split] = encoded[split].select([positions[row] for row in representatives])
+        return fanned_out
@@ -15,5 +15,6 @@
 # limitations under the License.
 """Export the classes and functions in this module to the package."""
 from .base import BaseDocument, ImageDocument, PDFDocument
+from .loading import LoadedDocument, load_documents
 
-__all__ = ["BaseDocument", "ImageDocument", "PDFDocument"]
+__all__ = ["BaseDocument", "ImageDocument", "LoadedDocument", "PDFDocument", "load_documents"]
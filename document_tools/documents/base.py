@@ -14,10 +14,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """base.py contains the base class for all documents, including the base class for all document types."""
+import io
 import logging
+import mmap
+import os
+from contextlib import contextmanager
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Union
+from typing import Any, Iterator, Optional, Sequence, Tuple, Union
+
+from datasets import IterableDataset
+from PIL import Image
+
+from .rendering import DEFAULT_DPI, count_pages, generate_page_rows, page_row_features, render_pages
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +35,47 @@ IMAGE_EXTENSIONS = ["ai", "bmp", "eps", "gif", "jpg", "jpeg", "png", "psd", "raw
 DOCUMENT_EXTENSIONS = IMAGE_EXTENSIONS[:] + ["pdf"]
 
 
+class _MappedFile(io.RawIOBase):
+    """Read-only file over a memory map, which Pillow can close without unmapping the document."""
+
+    def __init__(self, buffer: mmap.mmap):
+        """Wrap a memory map, without copying it."""
+        super().__init__()
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self) -> bool:
+        """Return True, the file is readable."""
+        return True
+
+    def seekable(self) -> bool:
+        """Return True, the file is seekable."""
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        """Read bytes into a pre-allocated buffer."""
+        data = self._view[self._position : self._position + len(buffer)]
+        buffer[: len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        """Move to a position of the file, which may be past its end like in a regular file."""
+        origin = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(origin + offset, 0)
+        return self._position
+
+    def tell(self) -> int:
+        """Return the current position."""
+        return self._position
+
+    def close(self):
+        """Release the view of the memory map."""
+        if not self.closed:
+            self._view.release()
+        super().close()
+
+
 @dataclass
 class BaseDocument:
     """
@@ -75,9 +125,25 @@ class BaseDocument:
 
     def to_dict(self):
         """Convert the document to a dictionary."""
-        tmp_dict = self.__dict__.copy()
-        tmp_dict.pop("_path")
-        return tmp_dict
+        return {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+
+    @contextmanager
+    def _mapped_file(self) -> Iterator[_MappedFile]:
+        """
+        Map the file of the document in memory, read-only, for the duration of a `with` block.
+
+        The pages of the file are only read from disk when they are accessed, and the map is released when the block
+        exits, so that many documents can be loaded without keeping their files mapped.
+        """
+        with open(self._path, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                raise ValueError(f"{self._path} is empty.")
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            with _MappedFile(buffer) as mapped_file:
+                yield mapped_file
+        finally:
+            buffer.close()
 
     def load(self):
         """Load the document."""
@@ -94,7 +160,16 @@ class BaseDocument:
 
 @dataclass
 class ImageDocument(BaseDocument):
-    """Class for image documents."""
+    """
+    Class for image documents.
+
+    Loading an image document is lazy: `load` maps the file in memory and only decodes its header, for the `size` and
+    `format` of the image. The pixels are decoded by `open_image`, and released when leaving its `with` block. The
+    document only holds the path and the header of its file, so it is cheap to keep and to pickle.
+    """
+
+    _size: Optional[Tuple[int, int]] = field(default=None, init=False, repr=False, compare=False)
+    _format: Optional[str] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         """Post-init method for ImageDocument."""
@@ -104,13 +179,170 @@ class ImageDocument(BaseDocument):
                 f"{self.extension} is not a valid image extension. Valid extensions are: {', '.join(IMAGE_EXTENSIONS)}"
             )
 
+    def load(self) -> "ImageDocument":
+        """
+        Read the header of the image file through a memory map, without decoding the pixels.
+
+        Returns
+        -------
+        ImageDocument
+            The document itself, to chain calls.
+
+        Raises
+        ------
+        ValueError
+            If the file is empty.
+        PIL.UnidentifiedImageError
+            If the file is not an image that Pillow can read.
+        """
+        if self._size is None:
+            with self._mapped_file() as file, Image.open(file) as image:
+                self._size = image.size
+                self._format = image.format
+        return self
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """Width and height of the image, read from the header of the file."""
+        if self._size is None:
+            self.load()
+        return self._size  # type: ignore
+
+    @property
+    def format(self) -> Optional[str]:
+        """Format of the image, as named by Pillow, read from the header of the file."""
+        if self._size is None:
+            self.load()
+        return self._format
+
+    @contextmanager
+    def open_image(self) -> Iterator[Image.Image]:
+        """
+        Decode the pixels of the image from the memory map of the file.
+
+        Yields
+        ------
+        PIL.Image.Image
+            The decoded image, which is closed and released when the `with` block exits. Copy it to keep it longer.
+        """
+        with self._mapped_file() as file:
+            image = Image.open(file)
+            try:
+                image.load()
+                yield image
+            finally:
+                image.close()
+
 
 @dataclass
 class PDFDocument(BaseDocument):
-    """Class for pdf documents."""
+    """
+    Class for pdf documents.
+
+    Loading a pdf document is lazy: `load` maps the file in memory and only checks its header, for the `version` of
+    the pdf format. The pages are rendered one at a time by `pages`, which requires `pypdfium2`.
+    """
+
+    _version: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    _num_pages: Optional[int] = field(default=None, init=False, repr=False, compare=False)
 
     def __post_init__(self):
         """Post-init method for PDFDocument."""
         super().__post_init__()
         if self.extension != "pdf":
             raise ValueError(f"{self.extension} is not a valid pdf extension. Valid extension is: pdf")
+
+    def load(self) -> "PDFDocument":
+        """
+        Read the header of the pdf file through a memory map.
+
+        Returns
+        -------
+        PDFDocument
+            The document itself, to chain calls.
+
+        Raises
+        ------
+        ValueError
+            If the file is empty or does not start with a pdf header.
+        """
+        if self._version is None:
+            with self._mapped_file() as file:
+                header = file.read(16).split(b"\n")[0].split(b"\r")[0]
+            if not header.startswith(b"%PDF-"):
+                raise ValueError(f"{self._path} does not start with a pdf header.")
+            self._version = header[5:].decode("ascii", errors="replace").strip()
+        return self
+
+    @property
+    def version(self) -> str:
+        """Version of the pdf format, read from the header of the file."""
+        if self._version is None:
+            self.load()
+        return self._version  # type: ignore
+
+    @property
+    def num_pages(self) -> int:
+        """Number of pages of the pdf document."""
+        if self._num_pages is None:
+            self._num_pages = count_pages(self._path)
+        return self._num_pages
+
+    def pages(
+        self,
+        dpi: int = DEFAULT_DPI,
+        size: Optional[Tuple[int, int]] = None,
+        num_proc: Optional[int] = None,
+        pages: Optional[Sequence[int]] = None,
+    ) -> Iterator[Image.Image]:
+        """
+        Render the pages of the pdf document one at a time, in order.
+
+        Parameters
+        ----------
+        dpi : int (default=200)
+            Resolution of the rendering, in dots per inch. The default is high enough for OCR.
+        size : Tuple[int, int], optional (default=None)
+            Width and height of the rendered pages, for example (224, 224) for the encoders. The pages are rendered at
+            `dpi`, then downscaled to this size.
+        num_proc : int, optional (default=None)
+            Number of processes rendering the pages.
+        pages : Sequence[int], optional (default=None)
+            Indices of the pages to render, starting from 0. All the pages if None.
+
+        Yields
+        ------
+        PIL.Image.Image
+            The rendered pages, in RGB.
+        """
+        yield from render_pages(self._path, pages=pages, dpi=dpi, size=size, num_proc=num_proc)
+
+    def to_iterable_dataset(
+        self, label: Any, dpi: int = DEFAULT_DPI, size: Optional[Tuple[int, int]] = None, num_proc: Optional[int] = None
+    ) -> IterableDataset:
+        """
+        Stream the rendered pages of the pdf document as a dataset that can be passed to `tokenize_dataset`.
+
+        Parameters
+        ----------
+        label : Any
+            Label of all the pages of the document.
+        dpi : int (default=200)
+            Resolution of the rendering, in dots per inch.
+        size : Tuple[int, int], optional (default=None)
+            Width and height the rendered pages are downscaled to.
+        num_proc : int, optional (default=None)
+            Number of processes rendering the pages.
+
+        Returns
+        -------
+        IterableDataset
+            Dataset with an `image`, a `label` and a `page` column, whose pages are rendered while it is iterated. The
+            type of the labels is the one of `label`. The dataset only has the label of this document, so pass all the
+            labels to `tokenize_dataset` with `labels=`.
+        """
+        return IterableDataset.from_generator(
+            generate_page_rows,
+            features=page_row_features(label),
+            gen_kwargs={"path": str(self._path), "label": label, "dpi": dpi, "size": size, "num_proc": num_proc},
+        )
@@ -0,0 +1,193 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""loading.py reads many documents concurrently with asyncio, decoding them in a pool while the next ones are read."""
+import asyncio
+import io
+import itertools
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from PIL import Image
+
+from ..encoders.images import reduce_image
+from .base import BaseDocument, ImageDocument, PDFDocument
+from .rendering import DEFAULT_DPI, _import_pdfium, render_page
+
+logger = logging.getLogger(__name__)
+
+Reader = Callable[[Path], Awaitable[bytes]]
+
+
+# Number of pages of a pdf document rendered by each task of the decoding pool, and held in each `LoadedDocument`.
+PDF_PAGES_PER_TASK = 4
+
+
+@dataclass
+class LoadedDocument:
+    """
+    A document and decoded pages of it, in RGB: the image of an image document, or consecutive pages of a pdf document.
+
+    Attributes
+    ----------
+    document : BaseDocument
+        The loaded document.
+    pages : List[PIL.Image.Image]
+        The decoded pages, at most `PDF_PAGES_PER_TASK` for a pdf document.
+    first_page : int
+        Index of the first page of `pages` in the document.
+    """
+
+    document: BaseDocument
+    pages: List[Image.Image]
+    first_page: int = 0
+
+
+def _as_document(document: Union[BaseDocument, str, Path]) -> BaseDocument:
+    """Get the document of a path, a `PDFDocument` for a pdf file and an `ImageDocument` otherwise."""
+    if isinstance(document, BaseDocument):
+        return document
+    return PDFDocument(document) if str(document).lower().endswith(".pdf") else ImageDocument(document)
+
+
+def _decode_document(
+    data: bytes, extension: str, first_page: int, dpi: int, size: Optional[Tuple[int, int]]
+) -> Tuple[List[Image.Image], int]:
+    """
+    Decode pages of a document from the bytes of its file, in RGB, shrunk to `size` if it is set.
+
+    Returns the image of an image document, or at most `PDF_PAGES_PER_TASK` pages of a pdf document from `first_page`,
+    with the number of pages of the document.
+    """
+    if extension == "pdf":
+        pdf = _import_pdfium().PdfDocument(data)
+        try:
+            num_pages = len(pdf)
+            indices = range(first_page, min(first_page + PDF_PAGES_PER_TASK, num_pages))
+            return [render_page(pdf, index, dpi, size) for index in indices], num_pages
+        finally:
+            pdf.close()
+
+    with Image.open(io.BytesIO(data)) as image:
+        if size is not None:
+            return [reduce_image(image, size)], 1
+        return [image.convert("RGB")], 1
+
+
+async def load_documents(
+    documents: Iterable[Union[BaseDocument, str, Path]],
+    max_concurrency: int = 16,
+    num_proc: Optional[int] = None,
+    dpi: int = DEFAULT_DPI,
+    size: Optional[Tuple[int, int]] = None,
+    reader: Optional[Reader] = None,
+) -> AsyncIterator[LoadedDocument]:
+    """
+    Load documents concurrently, yielding each one as soon as it is read and decoded.
+
+    At most `max_concurrency` files are read at once, and their bytes are decoded in a pool while the next files are
+    read, so the latency of slow storage, such as network volumes, overlaps with decoding and with the work of the
+    consumer instead of adding up. At most twice `max_concurrency` documents are in flight, so the memory used does not
+    depend on the number of documents. The pages of a pdf document are rendered `PDF_PAGES_PER_TASK` at a time, each
+    group being yielded as its own `LoadedDocument`, so a long document is never held in memory at once. Files that
+    can't be read or decoded are skipped with a warning.
+
+    Parameters
+    ----------
+    documents : Iterable[BaseDocument, str or Path]
+        Documents to load, or their paths. A path is loaded as a `PDFDocument` if it ends with `.pdf`, else as an
+        `ImageDocument`. The iterable is consumed lazily.
+    max_concurrency : int (default=16)
+        Maximum number of files read at the same time.
+    num_proc : int, optional (default=None)
+        Number of processes decoding the documents. If None or 1, they are decoded in the default executor of the
+        event loop, a pool of threads.
+    dpi : int (default=200)
+        Resolution of the rendering of the pdf pages, in dots per inch. The default is high enough for OCR. Requires
+        `pypdfium2` if there are pdf documents.
+    size : Tuple[int, int], optional (default=None)
+        Width and height to shrink the pages to, for example (224, 224) for the encoders. The images are reduced before
+        being converted to RGB, and the pdf pages are rendered at `dpi`, then downscaled to this size.
+    reader : Callable[[Path], Awaitable[bytes]], optional (default=None)
+        Coroutine function reading the bytes of a file, for example from an asynchronous storage client. By default,
+        the files are read with `Path.read_bytes` in a pool of `max_concurrency` threads.
+
+    Yields
+    ------
+    LoadedDocument
+        Each document with its decoded pages, in the order they finish loading. The groups of pages of a pdf document
+        are yielded in order.
+
+    Raises
+    ------
+    ValueError
+        If `max_concurrency` is not positive, or a path is not a valid document.
+    """
+    if max_concurrency < 1:
+        raise ValueError(f"`max_concurrency` must be a positive number of files, not {max_concurrency}.")
+
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # The pools are shut down in the default executor, so that waiting for their last tasks does not block the loop.
+    pools: List[Executor] = []
+    read_pool: Optional[Executor] = None
+    if reader is None:
+        read_pool = ThreadPoolExecutor(max_concurrency)
+        pools.append(read_pool)
+    decode_pool: Optional[Executor] = None
+    if num_proc is not None and num_proc > 1:
+        decode_pool = ProcessPoolExecutor(num_proc)
+        pools.append(decode_pool)
+
+    async def load(document: BaseDocument, data: Optional[bytes], first_page: int) -> Tuple[LoadedDocument, bytes, int]:
+        if data is None:
+            path = Path(document._path)
+            async with semaphore:
+                data = await (reader(path) if reader is not None else loop.run_in_executor(read_pool, path.read_bytes))
+        pages, num_pages = await loop.run_in_executor(
+            decode_pool, _decode_document, data, document.extension, first_page, dpi, size
+        )
+        return LoadedDocument(document, pages, first_page), data, num_pages
+
+    iterator = iter(documents)
+    pending: Dict["asyncio.Future[Tuple[LoadedDocument, bytes, int]]", BaseDocument] = {}
+    try:
+        while True:
+            for document in itertools.islice(iterator, 2 * max_concurrency - len(pending)):
+                document = _as_document(document)
+                pending[asyncio.ensure_future(load(document, None, 0))] = document
+            if not pending:
+                return
+
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                document = pending.pop(task)
+                if task.exception() is not None:
+                    logger.warning(f"Skipping {document._path}, it can't be loaded: {task.exception()}")
+                    continue
+                loaded, data, num_pages = task.result()
+                next_page = loaded.first_page + len(loaded.pages)
+                if next_page < num_pages:
+                    # The next pages are rendered from the bytes already read, while the consumer uses these ones.
+                    pending[asyncio.ensure_future(load(document, data, next_page))] = document
+                yield loaded
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await asyncio.gather(*(loop.run_in_executor(None, pool.shutdown) for pool in pools))
@@ -0,0 +1,167 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""rendering.py rasterizes the pages of pdf documents one at a time, optionally in a pool of processes."""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Sequence, Tuple, Union
+
+import pyarrow as pa
+from datasets import Features
+from datasets import Image as ImageFeature
+from datasets import Sequence as SequenceFeature
+from datasets import Value
+from datasets.features.features import generate_from_arrow_type
+from PIL import Image
+
+from ..utils import _ordered_imap
+
+# OCR needs about 200 dots per inch to read the small print of the documents.
+DEFAULT_DPI = 200
+POINTS_PER_INCH = 72
+
+# pdf document opened once by each process of the rendering pool.
+_WORKER_PDF: Any = None
+
+
+def _import_pdfium():
+    """Import pypdfium2, which is only needed to render pdf documents."""
+    try:
+        import pypdfium2
+    except ImportError:
+        raise ImportError(
+            "You need to install `pypdfium2` to render the pages of pdf documents: `pip install pypdfium2`"
+        )
+    return pypdfium2
+
+
+def count_pages(path: Union[str, Path]) -> int:
+    """Count the pages of a pdf document."""
+    pdf = _import_pdfium().PdfDocument(str(path))
+    try:
+        return len(pdf)
+    finally:
+        pdf.close()
+
+
+def render_page(pdf: Any, index: int, dpi: int = DEFAULT_DPI, size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """
+    Render a page of an opened pdf document.
+
+    Parameters
+    ----------
+    pdf : pypdfium2.PdfDocument
+        Opened pdf document.
+    index : int
+        Index of the page, starting from 0.
+    dpi : int (default=200)
+        Resolution of the rendering, in dots per inch.
+    size : Tuple[int, int], optional (default=None)
+        Width and height of the rendered page. The page is rendered at `dpi`, or at the smallest scale covering this
+        size if it is larger, then downscaled to it.
+
+    Returns
+    -------
+    PIL.Image.Image
+        The rendered page, in RGB.
+    """
+    page = pdf[index]
+    try:
+        scale = dpi / POINTS_PER_INCH
+        if size is not None:
+            width, height = page.get_size()
+            scale = max(scale, size[0] / width, size[1] / height)
+        image = page.render(scale=scale).to_pil().convert("RGB")
+    finally:
+        page.close()
+    if size is not None and image.size != tuple(size):
+        image = image.resize(size, Image.BILINEAR)
+    return image
+
+
+def _open_in_worker(path: str):
+    """Open the pdf document once in each process of the rendering pool."""
+    global _WORKER_PDF
+    _WORKER_PDF = _import_pdfium().PdfDocument(path)
+
+
+def _render_in_worker(index: int, dpi: int, size: Optional[Tuple[int, int]]) -> Image.Image:
+    """Render a page of the pdf document opened by the process."""
+    return render_page(_WORKER_PDF, index, dpi, size)
+
+
+def render_pages(
+    path: Union[str, Path],
+    pages: Optional[Sequence[int]] = None,
+    dpi: int = DEFAULT_DPI,
+    size: Optional[Tuple[int, int]] = None,
+    num_proc: Optional[int] = None,
+) -> Iterator[Image.Image]:
+    """
+    Render the pages of a pdf document one at a time, in order.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path to the pdf document.
+    pages : Sequence[int], optional (default=None)
+        Indices of the pages to render. All the pages if None.
+    dpi : int (default=200)
+        Resolution of the rendering, in dots per inch.
+    size : Tuple[int, int], optional (default=None)
+        Width and height the rendered pages are downscaled to, for example the input size of the encoders.
+    num_proc : int, optional (default=None)
+        Number of processes rendering the pages. Each process opens the document once, and at most two pages per
+        process are rendered ahead of the page being consumed.
+
+    Yields
+    ------
+    PIL.Image.Image
+        The rendered pages, in RGB.
+    """
+    pdfium = _import_pdfium()
+    if pages is None:
+        pages = range(count_pages(path))
+
+    if not num_proc or num_proc <= 1:
+        pdf = pdfium.PdfDocument(str(path))
+        try:
+            for index in pages:
+                yield render_page(pdf, index, dpi, size)
+        finally:
+            pdf.close()
+        return
+
+    with ProcessPoolExecutor(num_proc, initializer=_open_in_worker, initargs=(str(path),)) as pool:
+        yield from _ordered_imap(pool, _render_in_worker, ((index, dpi, size) for index in pages), 2 * num_proc)
+
+
+def page_row_features(label: Any) -> Features:
+    """Features of the rows generated by `generate_page_rows`, with the type of the label inferred from `label`."""
+    return Features(
+        {
+            "image": ImageFeature(),
+            "label": SequenceFeature(generate_from_arrow_type(pa.array([label]).type)),
+            "page": Value(dtype="int64"),
+        }
+    )
+
+
+def generate_page_rows(
+    path: str, label: Any, dpi: int, size: Optional[Tuple[int, int]], num_proc: Optional[int]
+) -> Iterator[Dict[str, Any]]:
+    """Generate the rows of a dataset of the rendered pages of a pdf document, as expected by `tokenize_dataset`."""
+    for index, image in enumerate(render_pages(path, dpi=dpi, size=size, num_proc=num_proc)):
+        yield {"image": image, "label": [label], "page": index}
@@ -15,6 +15,7 @@
 # limitations under the License.
 """Export the classes and functions in this module to the package."""
 from .encoders import LayoutLMv2Encoder, LayoutLMv3Encoder, LayoutXLMEncoder
+from .ocr import CallableOCR, OCRBackend, OCRCache, OCRStage, PrecomputedOCR, TesseractOCR
 
 TARGET_MODELS = {"layoutlmv2": LayoutLMv2Encoder, "layoutlmv3": LayoutLMv3Encoder, "layoutxlm": LayoutXLMEncoder}
 
@@ -23,5 +24,11 @@ __all__ = [
     "LayoutLMv2Encoder",
     "LayoutLMv3Encoder",
     "LayoutXLMEncoder",
+    "CallableOCR",
+    "OCRBackend",
+    "OCRCache",
+    "OCRStage",
+    "PrecomputedOCR",
+    "TesseractOCR",
     "TARGET_MODELS",
 ]
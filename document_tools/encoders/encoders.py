@@ -14,19 +14,100 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """encode_functions.py defines all encoding functions used to tokenize a dataset."""
+import copy
+import json
 import logging
-from typing import Any, Dict, List, Optional
+import threading
+from contextlib import nullcontext
+from typing import Any, ContextManager, Dict, List, Optional, Tuple, Type
 
+import numpy as np
 from datasets import Array2D, Array3D, ClassLabel, Features, Sequence, Value
-from transformers import LayoutLMv2Processor, LayoutLMv3Processor, LayoutXLMProcessor
+from PIL import Image
+from transformers import BatchEncoding, LayoutLMv2Processor, LayoutLMv3Processor, LayoutXLMProcessor, ProcessorMixin
+
+from ..instrumentation import EncodingStats
+from .images import batch_pixel_values, image_nbytes, open_image
+from .ocr import OCR_FEATURES, Boxes, OCRBackend, OCRCache, TesseractOCR, Words, ocr_images
 
 logger = logging.getLogger(__name__)
 
+# Narrowest dtypes that can hold the encoded values: pixels are 0-255, boxes are normalized to 0-1000, the vocabularies
+# have less than 2**31 tokens and masks are 0 or 1.
+COMPACT_DTYPES = {
+    "image": "uint8",
+    "input_ids": "int32",
+    "attention_mask": "int8",
+    "token_type_ids": "int8",
+    "bbox": "int16",
+    "labels": "int32",
+}
+
+# Keys of the configuration that the processors pass to their tokenizer when it is called.
+TOKENIZER_CALL_KWARGS = (
+    "padding",
+    "truncation",
+    "max_length",
+    "pad_to_multiple_of",
+    "return_token_type_ids",
+    "return_attention_mask",
+)
+
+_PROCESSORS: Dict[Tuple[str, str, str], ProcessorMixin] = {}
+_PROCESSORS_LOCK = threading.Lock()
+
+
+def _get_processor(processor_class: Type[ProcessorMixin], model: str, config: Dict[str, Any]) -> ProcessorMixin:
+    """
+    Get a processor from the process-wide registry, loading it with `from_pretrained` the first time it is requested.
+
+    Parameters
+    ----------
+    processor_class : Type[ProcessorMixin]
+        Class of the processor.
+    model : str
+        Name or path of the pretrained model.
+    config : Dict[str, Any]
+        Keyword arguments passed to `from_pretrained`.
+
+    Returns
+    -------
+    ProcessorMixin
+        The processor, shared by all the encoders of the process with the same class, model and configuration.
+    """
+    key = (processor_class.__name__, model, json.dumps(config, sort_keys=True, default=repr))
+    with _PROCESSORS_LOCK:
+        if key not in _PROCESSORS:
+            logger.debug(f"Loading {processor_class.__name__} for {model}.")
+            _PROCESSORS[key] = processor_class.from_pretrained(model, **config)
+        return _PROCESSORS[key]
+
+
+def clear_processor_cache():
+    """Remove all the processors from the process-wide registry, they will be loaded again when requested."""
+    with _PROCESSORS_LOCK:
+        _PROCESSORS.clear()
+
 
 class BaseEncoder:
     """BaseEncoder is the base class for all encoders."""
 
-    def __init__(self, labels: List[Any], config: Optional[Dict[str, Any]] = None):
+    processor_class: Optional[Type[ProcessorMixin]] = None
+    pixel_values_column = "image"
+    flip_channel_order = False
+
+    def __init__(
+        self,
+        labels: List[Any],
+        config: Optional[Dict[str, Any]] = None,
+        ocr_cache: Optional[OCRCache] = None,
+        compact: bool = False,
+        stats: Optional[EncodingStats] = None,
+        fast_image_processing: bool = False,
+        variable_length: bool = False,
+        stride: Optional[int] = None,
+        ocr_backend: Optional[OCRBackend] = None,
+    ):
         """
         Initialize the encoder.
 
@@ -36,10 +117,49 @@ class BaseEncoder:
             Configuration for the encoder.
         labels : List[Any]
             List of the labels in the dataset.
+        ocr_cache : OCRCache, optional (default=None)
+            Cache of OCR results. If provided, OCR is looked up in the cache and only run on the images it misses.
+        compact : bool (default=False)
+            Whether to store the encoded features with the narrowest safe dtypes (see `COMPACT_DTYPES`) instead of
+            int64. Use `document_tools.collate.widen_batch` or the torch format to widen them back when loading.
+        stats : EncodingStats, optional (default=None)
+            Stats in which the wall time, item counts and bytes of each encoding stage are recorded. If None, nothing is
+            measured.
+        fast_image_processing : bool (default=False)
+            Whether to compute the pixel values with `batch_pixel_values` instead of the image processor: each image is
+            shrunk before being converted to RGB, with `draft` for JPEG images that are not decoded yet, then the
+            whole batch is rescaled and normalized at once. The pixel values are close to, but not exactly, the ones of
+            the image processor. OCR still runs on the full resolution images.
+        variable_length : bool (default=False)
+            Whether to store each row with its own number of tokens, without padding, and the boxes as a `Sequence`
+            instead of an `Array2D` of the maximum length. Use `document_tools.collate.PaddingCollator` to pad the rows
+            of each batch to its longest row when loading.
+        stride : int, optional (default=None)
+            If set, the pages with more tokens than the maximum length are split into overlapping windows instead of
+            being truncated, with `stride` tokens repeated between consecutive windows. Each window is a row with its
+            own tokens and boxes, the pixel values and labels of its page, the `document_id` of its page (the
+            `document_id` column of the batch, or the index of the page in the batch) and its `window` index.
+        ocr_backend : OCRBackend, optional (default=None)
+            Backend applying OCR on the batches of images, for example a `TesseractOCR` with a pool of processes, a
+            `CallableOCR` wrapping another engine, or a `PrecomputedOCR` reading the words and boxes from columns of
+            the batch. Defaults to Tesseract with the OCR settings of the processor.
         """
         self.config = config if config else {"padding": "max_length", "truncation": True}
+        if variable_length:
+            self.config = {**self.config, "padding": False}
         self.labels = labels
+        self.ocr_cache = ocr_cache
+        self.compact = compact
         self.features = None
+        self.default_model: Optional[str] = None
+        self.stats = stats
+        self.fast_image_processing = fast_image_processing
+        self.variable_length = variable_length
+        self.stride = stride
+        self._ocr_backend = ocr_backend
+        self._default_ocr_backend: Optional[OCRBackend] = None
+        self.processor: Any = None
+        self._image_processor_without_ocr: Any = None
 
     def __call__(self, batch: Dict[str, List]):
         """
@@ -52,10 +172,194 @@ class BaseEncoder:
         """
         raise NotImplementedError()
 
+    def __getstate__(self) -> Dict[str, Any]:
+        """
+        Drop the processors when the encoder is pickled, they are fetched from the registry when unpickled.
+
+        The stats and the default OCR backend are dropped too, so that measuring the encoding or applying OCR does not
+        change the fingerprint of the encoder.
+        """
+        state = self.__dict__.copy()
+        state["stats"] = None
+        state["_default_ocr_backend"] = None
+        if self.processor_class is not None:
+            state["processor"] = None
+            state["_image_processor_without_ocr"] = None
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]):
+        """Restore the encoder, loading its processor at most once per process, and its stats from the environment."""
+        self.__dict__.update(state)
+        self.stats = EncodingStats.from_environment()
+        if self.processor_class is not None:
+            self.processor = self._load_processor()
+
+    def _measure(self, stage: str, items: int = 0, nbytes: int = 0) -> ContextManager:
+        """Measure a stage of the encoding if the encoder has stats, else do nothing."""
+        if self.stats is None:
+            return nullcontext()
+        return self.stats.measure(stage, items, nbytes)
+
+    def _dtype(self, column: str, default: str = "int64") -> str:
+        """Return the storage dtype of an encoded column."""
+        return COMPACT_DTYPES.get(column, default) if self.compact else default
+
+    def _bbox_feature(self):
+        """Return the feature of the boxes, padded to the maximum length unless the rows have variable length."""
+        if self.variable_length:
+            return Sequence(Sequence(Value(dtype=self._dtype("bbox")), length=4))
+        return Array2D(dtype=self._dtype("bbox"), shape=(self.config.get("max_length", 512), 4))
+
+    def _add_window_features(self):
+        """Add the back-reference of the windows to their page to the features, if the pages are split in windows."""
+        if self.stride is not None:
+            self.features["document_id"] = Value(dtype="int64")
+            self.features["window"] = Value(dtype="int64")
+
+    @property
+    def _tokenizer_kwargs(self) -> Dict[str, Any]:
+        """Padding and truncation settings of the configuration, passed to the tokenizer."""
+        kwargs = {key: self.config[key] for key in TOKENIZER_CALL_KWARGS if key in self.config}
+        if self.stride is not None:
+            kwargs.update(truncation=True, stride=self.stride, return_overflowing_tokens=True)
+        return kwargs
+
+    def _load_processor(self) -> ProcessorMixin:
+        """Get the processor of the encoder from the process-wide registry."""
+        if self.processor_class is None or self.default_model is None:
+            raise NotImplementedError()
+        return _get_processor(self.processor_class, self.default_model, self.config)
+
+    @property
+    def _image_processor(self):
+        """Image processor (or feature extractor for older versions of transformers) of the processor."""
+        return getattr(self.processor, "image_processor", None) or self.processor.feature_extractor
+
+    @property
+    def ocr_settings(self) -> Dict[str, Any]:
+        """OCR settings of the processor, those of the default Tesseract backend."""
+        return {
+            "ocr_lang": getattr(self._image_processor, "ocr_lang", None),
+            "tesseract_config": getattr(self._image_processor, "tesseract_config", None) or None,
+        }
+
+    @property
+    def ocr_backend(self) -> OCRBackend:
+        """Backend applying OCR, Tesseract with the OCR settings of the processor unless another one was given."""
+        if self._ocr_backend is not None:
+            return self._ocr_backend
+        if self._default_ocr_backend is None:
+            self._default_ocr_backend = TesseractOCR(**self.ocr_settings)
+        return self._default_ocr_backend
+
+    def _encode(
+        self,
+        images: Optional[List[Image.Image]],
+        words: Optional[List[Words]] = None,
+        boxes: Optional[List[Boxes]] = None,
+        pixel_values: Any = None,
+    ) -> BatchEncoding:
+        """
+        Encode the images with the image processor and the tokenizer of the processor.
+
+        If the words and boxes are given, they come from a separate OCR stage or from the columns of a precomputed OCR
+        backend. Otherwise, the OCR backend is run through the OCR cache if there is one. The image processor never
+        applies OCR itself, so that each stage can be measured. If the pixel values are given, they were computed by the
+        fast path and the image processor is not used, so the images are only needed for OCR.
+
+        Without stats, OCR cache, OCR backend or stride, nothing needs the stages apart, so the images are encoded with
+        a single call of the processor, which applies Tesseract itself.
+        """
+        single_call = self.stats is None and self.ocr_cache is None and self._ocr_backend is None
+        if single_call and words is None and pixel_values is None and self.stride is None:
+            return self.processor(images, **self._tokenizer_kwargs)
+
+        nbytes = image_nbytes(images) if self.stats is not None and images is not None else 0
+        if words is None:
+            with self._measure("ocr", len(images), nbytes):  # type: ignore
+                words, boxes = ocr_images(images, self.ocr_backend, self.ocr_cache)  # type: ignore
+
+        if pixel_values is None:
+            if self._image_processor_without_ocr is None:
+                self._image_processor_without_ocr = copy.copy(self._image_processor)
+                self._image_processor_without_ocr.apply_ocr = False
+            with self._measure("image_processing", len(images), nbytes):  # type: ignore
+                pixel_values = self._image_processor_without_ocr(images=images)["pixel_values"]
+
+        with self._measure("tokenization", len(words)):
+            encoded_inputs = self.processor.tokenizer(text=words, boxes=boxes, **self._tokenizer_kwargs)
+        encoded_inputs[self.pixel_values_column] = pixel_values
+        return encoded_inputs
+
+    def _encode_batch(self, batch: Dict[str, List]) -> BatchEncoding:
+        """
+        Encode a batch of images and labels, as done by the `__call__` of the encoders.
+
+        The images are either decoded or, with the fast image processing, possibly the `{"bytes", "path"}` storage of
+        undecoded images. They are only converted to RGB at full resolution when OCR has to run on them.
+        """
+        words_column, boxes_column = self.ocr_backend.columns or tuple(OCR_FEATURES)
+        words, boxes = batch.get(words_column), batch.get(boxes_column)
+        images, pixel_values = None, None
+        nbytes = image_nbytes(batch["image"]) if self.stats is not None else 0
+        if words is None or not self.fast_image_processing:
+            with self._measure("convert", len(batch["image"]), nbytes):
+                images = [open_image(image).convert("RGB") for image in batch["image"]]
+        if self.fast_image_processing:
+            with self._measure("image_processing", len(batch["image"]), nbytes):
+                pixel_values = batch_pixel_values(batch["image"], self._image_processor, self.flip_channel_order)
+
+        self._check_labels(batch["label"])
+        encoded_inputs = self._encode(images, words, boxes, pixel_values)
+        encoded_inputs["labels"] = [label for label in batch["label"]]
+        if self.stride is not None:
+            with self._measure("windowing", len(batch["label"])):
+                self._split_windows(encoded_inputs, batch)
+        if self.stats is not None:
+            self.stats.flush()
+        return encoded_inputs
+
+    def _check_labels(self, labels: List[Any]):
+        """Check that the labels of a batch are known by the `ClassLabel` feature of the labels, if there is one."""
+        label_feature = getattr(self.features["labels"], "feature", None) if self.features is not None else None
+        if not isinstance(label_feature, ClassLabel):
+            return
+        for row_labels in labels:
+            for label in row_labels if isinstance(row_labels, list) else [row_labels]:
+                try:
+                    label_feature.encode_example(label)
+                except (TypeError, ValueError):
+                    raise ValueError(
+                        f"The label {label!r} is not one of the {len(self.labels)} labels of the encoder. When the "
+                        "labels are discovered from the first `label_discovery_rows` rows of an iterable dataset, "
+                        "pass all of them with `labels=`."
+                    ) from None
+
+    def _split_windows(self, encoded_inputs: BatchEncoding, batch: Dict[str, List]):
+        """
+        Give each window of tokens the pixel values, label and document id of its page, in place.
+
+        The tokenizer returns the windows of all the pages of the batch in order, with the index of the page of each
+        window, so the page values are gathered and the window indices computed for the whole batch at once.
+        """
+        if "overflow_to_sample_mapping" not in encoded_inputs:
+            raise ValueError("Splitting the pages in windows requires a fast tokenizer, set `use_fast=True`.")
+        pages = np.asarray(encoded_inputs.pop("overflow_to_sample_mapping"), dtype=np.int64)
+        document_ids = np.asarray(batch.get("document_id", range(len(batch["label"]))), dtype=np.int64)
+
+        encoded_inputs[self.pixel_values_column] = np.asarray(encoded_inputs[self.pixel_values_column])[pages]
+        encoded_inputs["labels"] = [encoded_inputs["labels"][page] for page in pages]
+        encoded_inputs["document_id"] = document_ids[pages]
+        # The windows of a page are consecutive, so the index of a window is its distance to the first one of its page.
+        encoded_inputs["window"] = np.arange(len(pages)) - np.searchsorted(pages, pages)
+
 
 class LayoutLMv2Encoder(BaseEncoder):
     """LayoutLMv2Encoder is the encoder for datasets using LayoutLMv2."""
 
+    processor_class = LayoutLMv2Processor
+    flip_channel_order = True
+
     def __init__(self, **kwargs):
         """
         Initialize the LayoutLMv2Encoder.
@@ -68,29 +372,30 @@ class LayoutLMv2Encoder(BaseEncoder):
         """
         super().__init__(**kwargs)
         self.default_model = self.config.get("default_model", "microsoft/layoutlmv2-base-uncased")
-        self.processor = LayoutLMv2Processor.from_pretrained(self.default_model, **self.config)
+        self.processor = self._load_processor()
         self.features = Features(
             {
-                "image": Array3D(dtype="int64", shape=(3, 224, 224)),
-                "input_ids": Sequence(feature=Value(dtype="int64")),
-                "attention_mask": Sequence(Value(dtype="int64")),
-                "token_type_ids": Sequence(Value(dtype="int64")),
-                "bbox": Array2D(dtype="int64", shape=(512, 4)),
+                "image": Array3D(dtype=self._dtype("image"), shape=(3, 224, 224)),
+                "input_ids": Sequence(feature=Value(dtype=self._dtype("input_ids"))),
+                "attention_mask": Sequence(Value(dtype=self._dtype("attention_mask"))),
+                "token_type_ids": Sequence(Value(dtype=self._dtype("token_type_ids"))),
+                "bbox": self._bbox_feature(),
                 "labels": Sequence(ClassLabel(num_classes=len(self.labels), names=self.labels)),
             }
         )
+        self._add_window_features()
 
     def __call__(self, batch: Dict[str, List]):
         """Call the LayoutLMv2Encoder."""
-        images = [image.convert("RGB") for image in batch["image"]]
-        encoded_inputs = self.processor(images)
-        encoded_inputs["labels"] = [label for label in batch["label"]]
-        return encoded_inputs
+        return self._encode_batch(batch)
 
 
 class LayoutLMv3Encoder(BaseEncoder):
     """LayoutLMv3Encoder is the encoder for datasets using LayoutLMv3."""
 
+    processor_class = LayoutLMv3Processor
+    pixel_values_column = "pixel_values"
+
     def __init__(self, **kwargs):
         """
         Initialize the LayoutLMv3Encoder.
@@ -103,28 +408,29 @@ class LayoutLMv3Encoder(BaseEncoder):
         """
         super().__init__(**kwargs)
         self.default_model = self.config.get("default_model", "microsoft/layoutlmv3-base")
-        self.processor = LayoutLMv3Processor.from_pretrained(self.default_model, **self.config)
+        self.processor = self._load_processor()
         self.features = Features(
             {
                 "pixel_values": Array3D(dtype="float32", shape=(3, 224, 224)),
-                "input_ids": Sequence(feature=Value(dtype="int64")),
-                "attention_mask": Sequence(Value(dtype="int64")),
-                "bbox": Array2D(dtype="int64", shape=(512, 4)),
-                "labels": Sequence(feature=Value(dtype='int64')),
+                "input_ids": Sequence(feature=Value(dtype=self._dtype("input_ids"))),
+                "attention_mask": Sequence(Value(dtype=self._dtype("attention_mask"))),
+                "bbox": self._bbox_feature(),
+                "labels": Sequence(feature=Value(dtype=self._dtype("labels"))),
             }
         )
+        self._add_window_features()
 
     def __call__(self, batch: Dict[str, List]):
         """Call the LayoutLMv3Encoder."""
-        images = [image.convert("RGB") for image in batch["image"]]
-        encoded_inputs = self.processor(images)
-        encoded_inputs["labels"] = [label for label in batch["label"]]
-        return encoded_inputs
+        return self._encode_batch(batch)
 
 
 class LayoutXLMEncoder(BaseEncoder):
     """LayoutXLMEncoder is the encoder for datasets using LayoutXLM."""
 
+    processor_class = LayoutXLMProcessor
+    flip_channel_order = True
+
     def __init__(self, **kwargs):
         """
         Initialize the LayoutXLMEncoder.
@@ -137,22 +443,20 @@ class LayoutXLMEncoder(BaseEncoder):
         """
         super().__init__(**kwargs)
         self.default_model = self.config.get("default_model", "microsoft/layoutxlm-base")
-        self.config["return_token_type_ids"] = True
-        self.processor = LayoutXLMProcessor.from_pretrained(self.default_model, **self.config)
+        self.config = {**self.config, "return_token_type_ids": True}
+        self.processor = self._load_processor()
         self.features = Features(
             {
-                "image": Array3D(dtype="int64", shape=(3, 224, 224)),
-                "input_ids": Sequence(feature=Value(dtype="int64")),
-                "attention_mask": Sequence(Value(dtype="int64")),
+                "image": Array3D(dtype=self._dtype("image"), shape=(3, 224, 224)),
+                "input_ids": Sequence(feature=Value(dtype=self._dtype("input_ids"))),
+                "attention_mask": Sequence(Value(dtype=self._dtype("attention_mask"))),
                 # "token_type_ids": Sequence(Value(dtype="int64")),
-                "bbox": Array2D(dtype="int64", shape=(512, 4)),
+                "bbox": self._bbox_feature(),
                 "labels": Sequence(ClassLabel(num_classes=len(self.labels), names=self.labels)),
             }
         )
+        self._add_window_features()
 
     def __call__(self, batch: Dict[str, List]):
         """Call the LayoutXLMEncoder."""
-        images = [image.convert("RGB") for image in batch["image"]]
-        encoded_inputs = self.processor(images)
-        encoded_inputs["labels"] = [label for label in batch["label"]]
-        return encoded_inputs
+        return self._encode_batch(batch)
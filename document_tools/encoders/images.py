@@ -0,0 +1,148 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""images.py prepares the pixel values of a batch of images without going through the image processor per image."""
+import io
+import os
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+# The images are shrunk cheaply to at least this many times the target size, then resized with the resampling filter of
+# the image processor, as done by the `reducing_gap` of `PIL.Image.resize`.
+REDUCING_GAP = 2
+
+# Modes in which averaging neighbouring pixels is meaningful, the other modes are converted to RGB before reducing.
+_REDUCIBLE_MODES = ("L", "LA", "RGB", "RGBA", "CMYK", "YCbCr")
+
+ImageInput = Union[Image.Image, Dict[str, Any]]
+
+
+def open_image(image: ImageInput) -> Image.Image:
+    """
+    Open an image of a batch, which is either decoded or the `{"bytes", "path"}` storage of an undecoded image.
+
+    Undecoded images are opened lazily, so that only their header is read until their pixels are needed.
+    """
+    if isinstance(image, Image.Image):
+        return image
+    if image.get("bytes") is not None:
+        return Image.open(io.BytesIO(image["bytes"]))
+    return Image.open(image["path"])
+
+
+def image_nbytes(images: List[ImageInput]) -> int:
+    """
+    Count the bytes of the images of a batch, as measured by the encoding stats.
+
+    Decoded images count the size of their pixels, and undecoded images the size of their encoded file.
+    """
+    nbytes = 0
+    for image in images:
+        if isinstance(image, Image.Image):
+            nbytes += image.width * image.height * len(image.getbands())
+        elif image.get("bytes") is not None:
+            nbytes += len(image["bytes"])
+        else:
+            nbytes += os.path.getsize(image["path"])
+    return nbytes
+
+
+def reduce_image(image: Image.Image, size: Tuple[int, int], resample: int = Image.BILINEAR) -> Image.Image:
+    """
+    Shrink an image to `size` in RGB, reducing it before converting its colour space.
+
+    JPEG images that are not decoded yet are decoded directly at a reduced scale with `draft`. The other images are
+    shrunk by an integer factor with `reduce`, which averages blocks of pixels. Both keep at least `REDUCING_GAP` times
+    the target size, so that the final resize with `resample` is close to resizing the full image.
+
+    Parameters
+    ----------
+    image : PIL.Image.Image
+        Image to shrink, decoded or not.
+    size : Tuple[int, int]
+        Width and height of the output image.
+    resample : int (default=PIL.Image.BILINEAR)
+        Resampling filter of the final resize.
+
+    Returns
+    -------
+    PIL.Image.Image
+        The image at `size`, in RGB.
+    """
+    width, height = size
+    if image.format == "JPEG":
+        # No-op if the image is already decoded.
+        image.draft("RGB", (width * REDUCING_GAP, height * REDUCING_GAP))
+    if image.mode not in _REDUCIBLE_MODES:
+        image = image.convert("RGB")
+    factor = min(image.width // (width * REDUCING_GAP), image.height // (height * REDUCING_GAP))
+    if factor > 1:
+        image = image.reduce(factor)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return image.resize(size, resample)
+
+
+def _reduced_pixels(image: ImageInput, size: Tuple[int, int], resample: int) -> np.ndarray:
+    """Pixels of an image shrunk with `reduce_image`, closing the image if it was opened from its storage."""
+    opened = open_image(image)
+    try:
+        return np.asarray(reduce_image(opened, size, resample))
+    finally:
+        if opened is not image:
+            opened.close()
+
+
+def batch_pixel_values(images: List[ImageInput], image_processor: Any, flip_channel_order: bool = False) -> np.ndarray:
+    """
+    Compute the pixel values of a batch of images as the image processor does, on a single array.
+
+    Each image is shrunk with `reduce_image` to the size of the image processor, then the batch is rescaled, normalized
+    and transposed to channels first at once, with the settings of the image processor.
+
+    Parameters
+    ----------
+    images : List[PIL.Image.Image or Dict[str, Any]]
+        Images of the batch, decoded or not.
+    image_processor : BaseImageProcessor
+        Image processor of the target model, whose `size`, `resample`, `do_rescale`, `rescale_factor`,
+        `do_normalize`, `image_mean` and `image_std` are applied.
+    flip_channel_order : bool (default=False)
+        Whether to flip the channels from RGB to BGR, as the LayoutLMv2 image processor does.
+
+    Returns
+    -------
+    np.ndarray
+        Pixel values of shape (batch, 3, height, width), in uint8 if they are neither rescaled nor normalized, in
+        float32 otherwise.
+    """
+    size = image_processor.size
+    # Older feature extractors of 🤗 Transformers have a square integer size.
+    size = (size, size) if isinstance(size, int) else (size["width"], size["height"])
+    resample = getattr(image_processor, "resample", Image.BILINEAR)
+    pixel_values: np.ndarray = np.stack([_reduced_pixels(image, size, resample) for image in images])
+
+    if getattr(image_processor, "do_rescale", False) or getattr(image_processor, "do_normalize", False):
+        pixel_values = pixel_values.astype(np.float32)
+        if getattr(image_processor, "do_rescale", False):
+            pixel_values *= np.float32(image_processor.rescale_factor)
+        if getattr(image_processor, "do_normalize", False):
+            pixel_values -= np.asarray(image_processor.image_mean, dtype=np.float32)
+            pixel_values /= np.asarray(image_processor.image_std, dtype=np.float32)
+    if flip_channel_order:
+        pixel_values = pixel_values[..., ::-1]
+    return np.ascontiguousarray(pixel_values.transpose(0, 3, 1, 2))
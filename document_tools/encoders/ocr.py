@@ -0,0 +1,575 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ocr.py defines the OCR step of the encoders, its backends and the on-disk cache of its results."""
+import hashlib
+import json
+import logging
+import multiprocessing
+import sqlite3
+import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Tuple, Union
+
+from datasets import Sequence, Value
+from PIL import Image
+
+from ..instrumentation import EncodingStats
+from .images import image_nbytes
+
+logger = logging.getLogger(__name__)
+
+Words = List[str]
+Boxes = List[List[int]]
+
+DEFAULT_OCR_CACHE_SIZE = 1024**3
+ACCESS_BATCH_SIZE = 256
+EVICTION_BATCH_SIZE = 256
+
+OCR_FEATURES = {
+    "words": Sequence(feature=Value(dtype="string")),
+    "boxes": Sequence(feature=Sequence(feature=Value(dtype="int64"), length=4)),
+}
+
+
+def _normalize_box(box: List[int], width: int, height: int) -> List[int]:
+    """Normalize a box in pixels to the 0-1000 scale used by the LayoutLM models."""
+    return [
+        int(1000 * (box[0] / width)),
+        int(1000 * (box[1] / height)),
+        int(1000 * (box[2] / width)),
+        int(1000 * (box[3] / height)),
+    ]
+
+
+def apply_tesseract(
+    image: Image.Image, ocr_lang: Optional[str] = None, tesseract_config: Optional[str] = None
+) -> Tuple[Words, Boxes]:
+    """
+    Apply Tesseract OCR on a document image, the same way the LayoutLM processors do.
+
+    Parameters
+    ----------
+    image : Image.Image
+        Image of the document.
+    ocr_lang : str, optional (default=None)
+        Language used by Tesseract, English by default.
+    tesseract_config : str, optional (default=None)
+        Additional flags passed to Tesseract, for example `"--psm 6"`.
+
+    Returns
+    -------
+    Tuple[List[str], List[List[int]]]
+        Recognized words and their boxes normalized to the 0-1000 scale.
+    """
+    try:
+        import pytesseract
+    except ImportError:
+        raise ImportError("You need to install `pytesseract` to apply OCR on the documents: `pip install pytesseract`")
+
+    data = pytesseract.image_to_data(image, lang=ocr_lang, output_type="dict", config=tesseract_config or "")
+    width, height = image.size
+
+    words, boxes = [], []
+    for word, left, top, box_width, box_height in zip(
+        data["text"], data["left"], data["top"], data["width"], data["height"]
+    ):
+        if not word.strip():
+            continue
+        words.append(word)
+        boxes.append(_normalize_box([left, top, left + box_width, top + box_height], width, height))
+
+    return words, boxes
+
+
+class OCRBackend:
+    """
+    OCRBackend is the base class of the OCR engines used by the encoders and the OCR stage.
+
+    A backend recognizes the words of a whole batch of images at once, and returns their boxes normalized to the 0-1000
+    scale. The encoders tokenize its results with processors that never apply OCR themselves, so any engine can be
+    used without changing the encoders.
+    """
+
+    # Columns of the dataset holding the words and boxes, for backends that read them instead of applying OCR.
+    columns: Optional[Tuple[str, str]] = None
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """Settings of the backend, used to key the OCR cache: backends with the same settings give the same results."""
+        return {"backend": type(self).__name__}
+
+    def __call__(self, images: List[Image.Image]) -> Tuple[List[Words], List[Boxes]]:
+        """
+        Apply OCR on a batch of images.
+
+        Parameters
+        ----------
+        images : List[Image.Image]
+            RGB images of the documents.
+
+        Returns
+        -------
+        Tuple[List[List[str]], List[List[List[int]]]]
+            Words and normalized boxes of each image.
+        """
+        raise NotImplementedError()
+
+
+class TesseractOCR(OCRBackend):
+    """
+    TesseractOCR applies Tesseract with `apply_tesseract`, optionally in a persistent pool of processes.
+
+    Tesseract runs on a single image at a time, so a batch is spread over `num_proc` processes. The pool is started on
+    the first batch and reused by the next ones, instead of starting new processes for each batch. It is shut down by
+    `close`, at the end of a `with` block, or when the backend is garbage collected or the interpreter exits. Daemonic
+    processes, such as the `num_proc` workers of `datasets.map`, can't start a pool, so they apply Tesseract serially.
+    """
+
+    def __init__(
+        self, ocr_lang: Optional[str] = None, tesseract_config: Optional[str] = None, num_proc: Optional[int] = None
+    ):
+        """
+        Initialize the Tesseract backend.
+
+        Parameters
+        ----------
+        ocr_lang : str, optional (default=None)
+            Language used by Tesseract, English by default.
+        tesseract_config : str, optional (default=None)
+            Additional flags passed to Tesseract, for example `"--psm 6"`.
+        num_proc : int, optional (default=None)
+            Number of processes of the pool applying Tesseract. The images are processed in the calling process if
+            it is None or 1.
+        """
+        self.ocr_lang = ocr_lang
+        self.tesseract_config = tesseract_config
+        self.num_proc = num_proc
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._finalizer: Optional[weakref.finalize] = None
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Drop the pool when the backend is pickled, each process starts its own."""
+        return {**self.__dict__, "_pool": None, "_finalizer": None}
+
+    def __enter__(self) -> "TesseractOCR":
+        """Use the backend in a `with` block, which shuts its pool down at the end."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Shut the pool of processes down."""
+        self.close()
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """Language and configuration of Tesseract, the OCR settings of the processors."""
+        return {"ocr_lang": self.ocr_lang, "tesseract_config": self.tesseract_config}
+
+    def __call__(self, images: List[Image.Image]) -> Tuple[List[Words], List[Boxes]]:
+        """Apply Tesseract on a batch of images."""
+        serial = not self.num_proc or self.num_proc <= 1 or len(images) <= 1
+        if serial or multiprocessing.current_process().daemon:
+            results = [apply_tesseract(image, self.ocr_lang, self.tesseract_config) for image in images]
+        else:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.num_proc)
+                self._finalizer = weakref.finalize(self, self._pool.shutdown)
+            results = list(
+                self._pool.map(apply_tesseract, images, repeat(self.ocr_lang), repeat(self.tesseract_config))
+            )
+        return [words for words, _ in results], [boxes for _, boxes in results]
+
+    def close(self):
+        """Shut the pool of processes down, it is started again by the next batch."""
+        if self._finalizer is not None:
+            self._finalizer()
+        self._pool = None
+        self._finalizer = None
+
+
+class PrecomputedOCR(OCRBackend):
+    """
+    PrecomputedOCR reads the words and boxes of each image from columns of the dataset instead of applying OCR.
+
+    Use it to tokenize OCR results computed upstream, for example by another system. The boxes must be normalized to
+    the 0-1000 scale.
+    """
+
+    def __init__(self, words_column: str = "words", boxes_column: str = "boxes"):
+        """
+        Initialize the precomputed backend.
+
+        Parameters
+        ----------
+        words_column : str (default="words")
+            Name of the column containing the words of each image.
+        boxes_column : str (default="boxes")
+            Name of the column containing the normalized boxes of the words.
+        """
+        self.words_column = words_column
+        self.boxes_column = boxes_column
+        self.columns = (words_column, boxes_column)
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """Columns the results are read from."""
+        return {"backend": "precomputed", "columns": [self.words_column, self.boxes_column]}
+
+    def __call__(self, images: List[Image.Image]) -> Tuple[List[Words], List[Boxes]]:
+        """Refuse to apply OCR, the results are read from the columns of the batch."""
+        raise ValueError(f"The OCR results are read from the {self.columns} columns, which are missing from the batch.")
+
+
+class CallableOCR(OCRBackend):
+    """CallableOCR wraps any local function applying OCR, on a single image or on a batch of images."""
+
+    def __init__(self, function: Callable, name: Optional[str] = None, batched: bool = False):
+        """
+        Initialize the callable backend.
+
+        Parameters
+        ----------
+        function : Callable
+            Function returning the words and normalized boxes of an image, or the lists of words and boxes of a list
+            of images if `batched` is True. It must be picklable to be used with `num_proc`.
+        name : str, optional (default=None)
+            Name of the engine and of its settings, used to key the OCR cache. Defaults to the qualified name of the
+            function, so change it when the results of the function change.
+        batched : bool (default=False)
+            Whether the function is called on the whole batch at once.
+        """
+        self.function = function
+        self.name = name if name is not None else f"{function.__module__}.{function.__qualname__}"
+        self.batched = batched
+
+    @property
+    def settings(self) -> Dict[str, Any]:
+        """Name of the engine."""
+        return {"backend": self.name}
+
+    def __call__(self, images: List[Image.Image]) -> Tuple[List[Words], List[Boxes]]:
+        """Apply the function on a batch of images."""
+        if self.batched:
+            words, boxes = self.function(images)
+            return list(words), list(boxes)
+        results = [self.function(image) for image in images]
+        return [words for words, _ in results], [boxes for _, boxes in results]
+
+
+def _as_backend(ocr_backend: Union[OCRBackend, Dict[str, Any]]) -> OCRBackend:
+    """Get the backend of OCR settings, which are the keyword arguments of `TesseractOCR`."""
+    return ocr_backend if isinstance(ocr_backend, OCRBackend) else TesseractOCR(**ocr_backend)
+
+
+class OCRCache:
+    """
+    Persistent on-disk cache of OCR results, with a least recently used eviction policy.
+
+    Entries are keyed by a hash of the image pixels and of the OCR settings, so the cache can be shared by all the
+    encoders and between runs: re-tokenizing an unchanged corpus for another target model does not run OCR again. The
+    cache is stored in a SQLite database, which is safe to use from the `num_proc` workers of `datasets.map`. The access
+    times of the cache hits are written in batches, with the next result cached or every `ACCESS_BATCH_SIZE` hits, so
+    the hits of a process that exits before writing them are not counted by the eviction.
+    """
+
+    def __init__(self, cache_dir: Union[str, Path], max_size: Optional[int] = DEFAULT_OCR_CACHE_SIZE):
+        """
+        Initialize the OCR cache.
+
+        Parameters
+        ----------
+        cache_dir : str or Path
+            Directory where the cache is stored. It is created if it does not exist.
+        max_size : int, optional (default=1GiB)
+            Maximum size of the cached results in bytes. The least recently used entries are evicted when it is
+            exceeded. `None` disables the eviction.
+        """
+        if max_size is not None and max_size <= 0:
+            raise ValueError(f"`max_size` must be a positive number of bytes, not {max_size}")
+
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self._connection: Optional[sqlite3.Connection] = None
+        self._accesses: Dict[str, float] = {}
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._connect()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Drop the connection when the cache is pickled to be sent to other processes."""
+        state = self.__dict__.copy()
+        state["_connection"] = None
+        state["_accesses"] = {}
+        return state
+
+    def __len__(self) -> int:
+        """Return the number of cached results."""
+        return self._connect().execute("SELECT COUNT(*) FROM ocr").fetchone()[0]
+
+    @property
+    def size(self) -> int:
+        """Size of the cached results in bytes."""
+        return self._connect().execute("SELECT total FROM ocr_size").fetchone()[0]
+
+    @staticmethod
+    def key(image: Image.Image, settings: Dict[str, Any]) -> str:
+        """
+        Compute the key of an image for some OCR settings.
+
+        Parameters
+        ----------
+        image : Image.Image
+            Image of the document.
+        settings : Dict[str, Any]
+            OCR settings, like the language and the Tesseract configuration.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest identifying the image content and the OCR settings.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(settings, sort_keys=True).encode())
+        digest.update(f"{image.mode}:{image.size}".encode())
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[Words, Boxes]]:
+        """
+        Get the cached OCR result of a key.
+
+        Parameters
+        ----------
+        key : str
+            Key computed with `OCRCache.key`.
+
+        Returns
+        -------
+        Tuple[List[str], List[List[int]]], optional
+            The cached words and boxes, or None if the key is not cached.
+        """
+        connection = self._connect()
+        row = connection.execute("SELECT value FROM ocr WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._accesses[key] = time.time()
+        if len(self._accesses) >= ACCESS_BATCH_SIZE:
+            with connection:
+                self._write_accesses(connection)
+        words, boxes = json.loads(row[0])
+        return words, boxes
+
+    def set(self, key: str, words: Words, boxes: Boxes):
+        """
+        Cache the OCR result of a key and evict the least recently used entries if the cache is too large.
+
+        Parameters
+        ----------
+        key : str
+            Key computed with `OCRCache.key`.
+        words : List[str]
+            Recognized words.
+        boxes : List[List[int]]
+            Normalized boxes of the words.
+        """
+        value = json.dumps([words, boxes])
+        connection = self._connect()
+        with connection:
+            self._write_accesses(connection)
+            connection.execute("DELETE FROM ocr WHERE key = ?", (key,))
+            connection.execute(
+                "INSERT INTO ocr (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            if self.max_size is not None:
+                self._evict(connection, self.max_size)
+
+    def clear(self):
+        """Remove all the cached results."""
+        connection = self._connect()
+        self._accesses.clear()
+        with connection:
+            connection.execute("DELETE FROM ocr")
+
+    def _write_accesses(self, connection: sqlite3.Connection):
+        """Write the access times of the cache hits not written yet, in the current transaction."""
+        if self._accesses:
+            connection.executemany(
+                "UPDATE ocr SET last_access = ? WHERE key = ?", [(at, key) for key, at in self._accesses.items()]
+            )
+            self._accesses.clear()
+
+    @staticmethod
+    def _evict(connection: sqlite3.Connection, max_size: int):
+        """
+        Delete the least recently used entries until the cache fits in `max_size` bytes.
+
+        Each statement only reads the `EVICTION_BATCH_SIZE` oldest entries through the index on `last_access`, and
+        deletes as many of them as needed to free the excess bytes.
+        """
+        excess = connection.execute("SELECT total FROM ocr_size").fetchone()[0] - max_size
+        while excess > 0:
+            deleted = connection.execute(
+                """
+                DELETE FROM ocr WHERE key IN (
+                    SELECT key FROM (
+                        SELECT key, SUM(size) OVER (ORDER BY last_access, key ROWS UNBOUNDED PRECEDING) - size AS freed
+                        FROM (SELECT key, size, last_access FROM ocr ORDER BY last_access LIMIT ?)
+                    ) WHERE freed < ?
+                )
+                """,
+                (EVICTION_BATCH_SIZE, excess),
+            ).rowcount
+            if deleted == 0:
+                break
+            excess = connection.execute("SELECT total FROM ocr_size").fetchone()[0] - max_size
+
+    def _connect(self) -> sqlite3.Connection:
+        """Open the SQLite database of the cache once per process and create its tables if needed."""
+        if self._connection is None:
+            connection = sqlite3.connect(str(self.cache_dir / "ocr.sqlite"), timeout=60)
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                connection.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS ocr (
+                        key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS ocr_last_access ON ocr (last_access);
+                    CREATE TABLE IF NOT EXISTS ocr_size (total INTEGER NOT NULL);
+                    INSERT INTO ocr_size (total) SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM ocr_size);
+                    CREATE TRIGGER IF NOT EXISTS ocr_insert AFTER INSERT ON ocr
+                        BEGIN UPDATE ocr_size SET total = total + NEW.size; END;
+                    CREATE TRIGGER IF NOT EXISTS ocr_delete AFTER DELETE ON ocr
+                        BEGIN UPDATE ocr_size SET total = total - OLD.size; END;
+                    """
+                )
+            self._connection = connection
+        return self._connection
+
+
+def ocr_images(
+    images: List[Image.Image], ocr_backend: Union[OCRBackend, Dict[str, Any]], ocr_cache: Optional[OCRCache] = None
+) -> Tuple[List[Words], List[Boxes]]:
+    """
+    Apply OCR on a batch of images, reading and filling the OCR cache if there is one.
+
+    The images missed by the cache are passed to the backend in a single batch.
+
+    Parameters
+    ----------
+    images : List[Image.Image]
+        RGB images of the documents.
+    ocr_backend : OCRBackend or Dict[str, Any]
+        Backend applying OCR, or the keyword arguments of `TesseractOCR`.
+    ocr_cache : OCRCache, optional (default=None)
+        Cache of OCR results.
+
+    Returns
+    -------
+    Tuple[List[List[str]], List[List[List[int]]]]
+        Words and normalized boxes of each image.
+    """
+    ocr_backend = _as_backend(ocr_backend)
+    if ocr_cache is None:
+        return ocr_backend(images)
+
+    keys = [OCRCache.key(image, ocr_backend.settings) for image in images]
+    results = [ocr_cache.get(key) for key in keys]
+    missing = [index for index, result in enumerate(results) if result is None]
+    if missing:
+        words, boxes = ocr_backend([images[index] for index in missing])
+        for index, image_words, image_boxes in zip(missing, words, boxes):
+            ocr_cache.set(keys[index], image_words, image_boxes)
+            results[index] = (image_words, image_boxes)
+    return [result[0] for result in results], [result[1] for result in results]  # type: ignore
+
+
+class OCRStage:
+    """
+    OCRStage runs OCR as a stage of its own, before the encoders, when used with `datasets.map`.
+
+    It adds the `words` and `boxes` columns to the dataset, which the encoders then tokenize without applying OCR. This
+    lets the slow, CPU-bound OCR run with its own `num_proc` and `batch_size`, and be cached by `datasets` on its own.
+    """
+
+    def __init__(
+        self,
+        ocr_backend: Union[OCRBackend, Dict[str, Any]],
+        image_column: str = "image",
+        ocr_cache: Optional[OCRCache] = None,
+        stats: Optional[EncodingStats] = None,
+        image_size: Optional[Tuple[int, int]] = None,
+        resample: int = Image.BILINEAR,
+    ):
+        """
+        Initialize the OCR stage.
+
+        Parameters
+        ----------
+        ocr_backend : OCRBackend or Dict[str, Any]
+            Backend applying OCR, usually the `ocr_backend` of the target encoder, or the keyword arguments of
+            `TesseractOCR`.
+        image_column : str (default="image")
+            Name of the column containing the image.
+        ocr_cache : OCRCache, optional (default=None)
+            Cache of OCR results.
+        stats : EncodingStats, optional (default=None)
+            Stats in which the wall time and item counts of the stage are recorded.
+        image_size : Tuple[int, int], optional (default=None)
+            If set, the images are replaced by their RGB copy resized to this width and height with `resample`, after
+            OCR is applied on the full resolution images. The image processors leave images already at their input
+            size unchanged, so the encoders of models with this input size decode small images only.
+        resample : int (default=PIL.Image.BILINEAR)
+            Resampling filter of the resize, the one of the image processors of the models.
+        """
+        self.ocr_backend = _as_backend(ocr_backend)
+        self.image_column = image_column
+        self.ocr_cache = ocr_cache
+        self.stats = stats
+        self.image_size = image_size
+        self.resample = resample
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Drop the stats when the stage is pickled, so that they do not change its fingerprint."""
+        return {**self.__dict__, "stats": None}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        """Restore the stage, with the stats of the worker process if the parent process collects stats."""
+        self.__dict__.update(state)
+        self.stats = EncodingStats.from_environment()
+
+    def _measure(self, stage: str, items: int = 0, nbytes: int = 0) -> ContextManager:
+        """Measure a step of the stage if it has stats, else do nothing."""
+        return nullcontext() if self.stats is None else self.stats.measure(stage, items, nbytes)
+
+    def __call__(self, batch: Dict[str, List]) -> Dict[str, List]:
+        """Apply OCR on the images of the batch."""
+        nbytes = image_nbytes(batch[self.image_column]) if self.stats is not None else 0
+        with self._measure("convert", len(batch[self.image_column]), nbytes):
+            images = [image.convert("RGB") for image in batch[self.image_column]]
+        rgb_nbytes = image_nbytes(images) if self.stats is not None else 0
+        with self._measure("ocr", len(images), rgb_nbytes):
+            words, boxes = ocr_images(images, self.ocr_backend, self.ocr_cache)
+        outputs: Dict[str, List] = {"words": words, "boxes": boxes}
+        if self.image_size is not None:
+            with self._measure("resize", len(images)):
+                outputs[self.image_column] = [image.resize(self.image_size, self.resample) for image in images]
+        if self.stats is not None:
+            self.stats.flush()
+        return outputs
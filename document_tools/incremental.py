@@ -0,0 +1,298 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""incremental.py encodes only the rows of a dataset that changed since the previous saved output."""
+import hashlib
+import json
+import logging
+import shutil
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List
+
+from datasets import Dataset, DatasetDict, concatenate_datasets, load_from_disk
+
+from .checkpoint import _write_json
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE_NAME = "tokenize_manifest.json"
+
+
+def _value_bytes(value: Any) -> bytes:
+    """Bytes identifying a value of the Arrow storage: the encoded image bytes, the content of its file, or JSON."""
+    if isinstance(value, dict) and "bytes" in value and "path" in value:
+        if value["bytes"] is not None:
+            return value["bytes"]
+        path = Path(value["path"])
+        return path.read_bytes() if path.is_file() else value["path"].encode()
+    if isinstance(value, bytes):
+        return value
+    return json.dumps(value, sort_keys=True, default=repr).encode()
+
+
+def row_fingerprints(dataset: Dataset, image_column: str, label_column: str, chunk_size: int = 1000) -> List[str]:
+    """
+    Fingerprint each row of a dataset from the stored bytes of its image and from its label.
+
+    The image column is read from the Arrow storage in chunks, so the images are hashed without being decoded.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Dataset to fingerprint.
+    image_column : str
+        Name of the column containing the image.
+    label_column : str
+        Name of the column containing the label.
+    chunk_size : int (default=1000)
+        Number of rows read at once.
+
+    Returns
+    -------
+    List[str]
+        Hexadecimal fingerprint of each row.
+    """
+    arrow_dataset = dataset.select_columns([image_column, label_column]).with_format("arrow")
+    fingerprints = []
+    for start in range(0, len(dataset), chunk_size):
+        table = arrow_dataset[start : start + chunk_size]
+        images = table.column(image_column).to_pylist()
+        labels = table.column(label_column).to_pylist()
+        for image, label in zip(images, labels):
+            image_bytes = _value_bytes(image)
+            row_hash = hashlib.blake2b(digest_size=16)
+            row_hash.update(len(image_bytes).to_bytes(8, "little"))
+            row_hash.update(image_bytes)
+            row_hash.update(_value_bytes(label))
+            fingerprints.append(row_hash.hexdigest())
+    return fingerprints
+
+
+def encoder_fingerprint(**config: Any) -> str:
+    """Fingerprint an encoder configuration given as keyword arguments."""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+@dataclass
+class SplitPlan:
+    """
+    Rows of a split to encode, and rows of the previous output to reuse.
+
+    Attributes
+    ----------
+    fingerprints : List[str]
+        Fingerprint of each row of the split.
+    new_rows : List[int]
+        Indices of the rows of the split that were added or modified, and must be encoded.
+    reused_rows : List[int]
+        Indices of the rows of the previous output that are reused.
+    order : List[int]
+        For each row of the split, its index in the reused rows followed by the newly encoded rows.
+    """
+
+    fingerprints: List[str]
+    new_rows: List[int]
+    reused_rows: List[int]
+    order: List[int]
+
+
+def plan_split(fingerprints: List[str], previous_fingerprints: List[str]) -> SplitPlan:
+    """Find the rows that must be encoded and the previous rows that can be reused, by fingerprint."""
+    previous_rows: Dict[str, int] = {}
+    for row, fingerprint in enumerate(previous_fingerprints):
+        previous_rows.setdefault(fingerprint, row)
+
+    new_rows, reused_rows = [], []
+    for row, fingerprint in enumerate(fingerprints):
+        if fingerprint in previous_rows:
+            reused_rows.append(previous_rows[fingerprint])
+        else:
+            new_rows.append(row)
+
+    order, num_reused, num_new = [], 0, 0
+    for fingerprint in fingerprints:
+        if fingerprint in previous_rows:
+            order.append(num_reused)
+            num_reused += 1
+        else:
+            order.append(len(reused_rows) + num_new)
+            num_new += 1
+    return SplitPlan(fingerprints=fingerprints, new_rows=new_rows, reused_rows=reused_rows, order=order)
+
+
+def _load_parts(save_path: Path, split: str, parts: List[str]) -> List[Dataset]:
+    """Load a split from each of the parts saved in a directory, memory-mapped."""
+    return [load_from_disk(str(save_path / part))[split] for part in parts]
+
+
+def _load_split(save_path: Path, split: str, split_manifest: Dict[str, Any]) -> Dataset:
+    """Concatenate the parts of a split, and put its rows in their order with an indices mapping."""
+    parts = _load_parts(save_path, split, split_manifest["parts"])
+    stored = concatenate_datasets(parts) if len(parts) > 1 else parts[0]
+    rows = split_manifest["rows"]
+    return stored if rows == list(range(len(stored))) else stored.select(rows)
+
+
+def load_incremental(save_path: str) -> DatasetDict:
+    """
+    Load the output saved by `tokenize_dataset` in the incremental mode.
+
+    Each run saves the rows it encoded as a new part of `save_path`, and the manifest records the row of the parts
+    holding each row of the output. The parts are memory-mapped and the rows are put in their order with an indices
+    mapping, so no data is copied. Use `save_to_disk` on the result to write a contiguous copy.
+
+    Parameters
+    ----------
+    save_path : str
+        Path given as `save_path` to `tokenize_dataset` with `incremental=True`.
+
+    Returns
+    -------
+    DatasetDict
+        The encoded dataset, in the order of the input of the last run.
+    """
+    manifest = json.loads((Path(save_path) / MANIFEST_FILE_NAME).read_text())
+    return DatasetDict(
+        {
+            split: _load_split(Path(save_path), split, split_manifest)
+            for split, split_manifest in manifest["splits"].items()
+        }
+    )
+
+
+class IncrementalEncoding:
+    """
+    IncrementalEncoding reuses the rows encoded by a previous run of `tokenize_dataset` saved to disk.
+
+    A manifest saved next to the output stores the fingerprint of each row and of the encoder configuration. On the
+    next run, only the rows whose fingerprint is not in the manifest are encoded. They are saved as a new part next to
+    the parts of the previous runs, which stay in place, and the manifest records the part and row of each row of the
+    output, in the order of the input dataset. So each run writes as many rows as were added or modified. Once less
+    than half of the stored rows of a split are used, the split is compacted into the new part. If the encoder
+    configuration changed, all the rows are encoded again.
+    """
+
+    def __init__(self, save_path: str, encoder_key: str):
+        """
+        Initialize the incremental encoding, reading the previous manifest if it has the same configuration.
+
+        Parameters
+        ----------
+        save_path : str
+            Path where the parts of the encoded dataset and its manifest are saved.
+        encoder_key : str
+            Fingerprint of the encoder configuration.
+        """
+        self.save_path = Path(save_path)
+        self.encoder_key = encoder_key
+        self.previous: Dict[str, Dict[str, Any]] = {}
+        self.plans: Dict[str, SplitPlan] = {}
+
+        manifest_path = self.save_path / MANIFEST_FILE_NAME
+        if not manifest_path.is_file():
+            return
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get("encoder") != encoder_key:
+            logger.info("The encoder configuration changed since the previous run, all the rows are encoded again.")
+            return
+        self.previous = manifest["splits"]
+
+    def select_rows_to_encode(self, dataset: DatasetDict, image_column: str, label_column: str) -> DatasetDict:
+        """
+        Plan each split and select the rows that must be encoded.
+
+        Parameters
+        ----------
+        dataset : DatasetDict
+            Dataset to encode.
+        image_column : str
+            Name of the column containing the image.
+        label_column : str
+            Name of the column containing the label.
+
+        Returns
+        -------
+        DatasetDict
+            The added or modified rows of each split.
+        """
+        for split, split_dataset in dataset.items():
+            fingerprints = row_fingerprints(split_dataset, image_column, label_column)
+            previous_fingerprints = self.previous[split]["fingerprints"] if split in self.previous else []
+            self.plans[split] = plan_split(fingerprints, previous_fingerprints)
+
+        num_rows = sum(len(plan.fingerprints) for plan in self.plans.values())
+        num_new_rows = sum(len(plan.new_rows) for plan in self.plans.values())
+        logger.info(f"Encoding {num_new_rows} new or modified rows, and reusing {num_rows - num_new_rows} rows.")
+        return DatasetDict({split: dataset[split].select(plan.new_rows) for split, plan in self.plans.items()})
+
+    def _new_part_name(self) -> str:
+        """Name of the directory of the next part, after all the parts found in `save_path`."""
+        numbers = [int(path.name.split("-")[1].split(".")[0]) for path in self.save_path.glob("part-*")]
+        return f"part-{max(numbers, default=-1) + 1:05d}"
+
+    def merge_and_save(self, encoded: DatasetDict) -> DatasetDict:
+        """
+        Save the newly encoded rows as a new part, and record the order of the reused and new rows in the manifest.
+
+        The new part is written under a temporary name and renamed once saved, then the manifest is replaced, so an
+        interrupted run keeps the previous output. The parts no longer used by the manifest are removed last.
+
+        Parameters
+        ----------
+        encoded : DatasetDict
+            The encoded rows selected by `select_rows_to_encode`.
+
+        Returns
+        -------
+        DatasetDict
+            The merged dataset, loaded from the parts on disk.
+        """
+        part = self._new_part_name()
+        new_part = DatasetDict()
+        splits = {}
+        for split, plan in self.plans.items():
+            previous = self.previous.get(split, {"parts": [], "rows": []})
+            stored = _load_parts(self.save_path, split, previous["parts"])
+            num_stored = sum(len(dataset) for dataset in stored)
+            num_reused = len(plan.reused_rows)
+            rows = [
+                previous["rows"][plan.reused_rows[index]] if index < num_reused else num_stored + index - num_reused
+                for index in plan.order
+            ]
+            parts = list(previous["parts"])
+            if len(set(rows)) * 2 < num_stored + len(plan.new_rows):
+                # Most of the stored rows were deleted or modified, the used rows are rewritten in their order.
+                merged = concatenate_datasets(stored + [encoded[split]])
+                new_part[split] = merged.select(rows)
+                parts, rows = [part], list(range(len(rows)))
+            elif plan.new_rows or not parts:
+                new_part[split] = encoded[split]
+                parts.append(part)
+            splits[split] = {"fingerprints": plan.fingerprints, "parts": parts, "rows": rows}
+
+        self.save_path.mkdir(parents=True, exist_ok=True)
+        if new_part:
+            tmp_path = self.save_path / f"{part}.tmp"
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            new_part.save_to_disk(str(tmp_path))
+            tmp_path.rename(self.save_path / part)
+        _write_json(self.save_path / MANIFEST_FILE_NAME, {"encoder": self.encoder_key, "splits": splits})
+
+        used = {name for split_manifest in splits.values() for name in split_manifest["parts"]}
+        for path in self.save_path.glob("part-*"):
+            if path.name not in used:
+                shutil.rmtree(path)
+        return load_incremental(str(self.save_path))
@@ -0,0 +1,258 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""ingest.py turns a directory of documents into a dataset that can be passed to `tokenize_dataset`."""
+import hashlib
+import io
+import json
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Deque, Iterator, List, Optional, Sequence, Tuple, Union
+
+from datasets import ClassLabel, Dataset, Features, Image
+from datasets import Sequence as SequenceFeature
+from datasets import config
+from datasets.arrow_writer import ArrowWriter
+from PIL import Image as PILImage
+
+from .documents.base import DOCUMENT_EXTENSIONS
+from .documents.rendering import DEFAULT_DPI, _import_pdfium, render_page
+from .utils import _ordered_imap
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = (2048, 2048)
+
+# Path and pdf document opened by the process, whose pages are being loaded.
+_OPENED_PDF: Optional[Tuple[str, Any]] = None
+
+
+def find_documents(directory: Union[str, Path], extensions: Sequence[str] = DOCUMENT_EXTENSIONS) -> List[Path]:
+    """
+    Find the documents in a directory tree.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Root of the directory tree.
+    extensions : Sequence[str] (default=DOCUMENT_EXTENSIONS)
+        Extensions of the documents, without the dot. The extensions of the files are compared in lower case.
+
+    Returns
+    -------
+    List[Path]
+        Paths of the documents, sorted.
+    """
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = Path(root) / name
+            if path.suffix[1:].lower() in extensions:
+                paths.append(path)
+    return sorted(paths)
+
+
+def _thumbnail(data: bytes, max_size: Optional[Tuple[int, int]]) -> bytes:
+    """
+    Decode an image and shrink it to fit in `max_size`, keeping its aspect ratio.
+
+    JPEG images are decoded directly at a reduced scale. The bytes of images that already fit are kept as they are.
+    """
+    with PILImage.open(io.BytesIO(data)) as image:
+        if max_size is None or (image.width <= max_size[0] and image.height <= max_size[1]):
+            image.verify()
+            return data
+        image_format = "JPEG" if image.format == "JPEG" else "PNG"
+        image.thumbnail(max_size)
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, format=image_format)
+        return output.getvalue()
+
+
+def _open_pdf(path: str) -> Any:
+    """
+    Open a pdf document, keeping the last document opened by the process.
+
+    The pages of a document are loaded one after the other, so each process opens each document once.
+    """
+    global _OPENED_PDF
+    if _OPENED_PDF is None or _OPENED_PDF[0] != path:
+        _close_pdf()
+        _OPENED_PDF = (path, _import_pdfium().PdfDocument(path))
+    return _OPENED_PDF[1]
+
+
+def _close_pdf():
+    """Close the pdf document kept open by the process, if there is one."""
+    global _OPENED_PDF
+    if _OPENED_PDF is not None:
+        _OPENED_PDF[1].close()
+        _OPENED_PDF = None
+
+
+def _page_indices(path: str) -> Sequence[Optional[int]]:
+    """
+    Return the indices of the pages of a document: None for an image, the page numbers for a pdf document.
+
+    A pdf document that can't be opened is skipped with a warning, and has a single page of index -1.
+    """
+    if Path(path).suffix.lower() != ".pdf":
+        return [None]
+    try:
+        return range(len(_open_pdf(path)))
+    except Exception as e:
+        logger.warning(f"Skipping {path}, it can't be decoded: {e}")
+        return [-1]
+
+
+def _load_page(path: str, index: Optional[int], max_size: Optional[Tuple[int, int]], pdf_dpi: int) -> Optional[bytes]:
+    """
+    Load a page of a document as encoded image bytes, or None if it can't be decoded.
+
+    An image is decoded and shrunk to `max_size`, and a page of a pdf document is rendered at `pdf_dpi` then shrunk.
+    """
+    if index is not None and index < 0:
+        return None
+    try:
+        if index is None:
+            return _thumbnail(Path(path).read_bytes(), max_size)
+        image = render_page(_open_pdf(path), index, dpi=pdf_dpi)
+        if max_size is not None:
+            image.thumbnail(max_size)
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        return output.getvalue()
+    except Exception as e:
+        page = f"page {index} of " if index is not None else ""
+        logger.warning(f"Skipping {page}{path}, it can't be decoded: {e}")
+        return None
+
+
+def _load_pages(
+    paths: List[str],
+    labels: List[str],
+    max_size: Optional[Tuple[int, int]],
+    pdf_dpi: int,
+    num_proc: Optional[int],
+) -> Iterator[Tuple[str, Optional[bytes]]]:
+    """
+    Load the pages of the documents one at a time and in order, with their label.
+
+    The pages are loaded in a pool of processes if `num_proc` is greater than 1, so a long pdf document is never held
+    in memory at once.
+    """
+    pending_labels: Deque[str] = deque()
+
+    def arguments() -> Iterator[Tuple[str, Optional[int], Optional[Tuple[int, int]], int]]:
+        for path, label in zip(paths, labels):
+            for index in _page_indices(path):
+                pending_labels.append(label)
+                yield path, index, max_size, pdf_dpi
+
+    try:
+        if not num_proc or num_proc <= 1:
+            for args in arguments():
+                yield pending_labels.popleft(), _load_page(*args)
+            return
+
+        with ProcessPoolExecutor(num_proc) as pool:
+            for data in _ordered_imap(pool, _load_page, arguments(), 4 * num_proc):
+                yield pending_labels.popleft(), data
+    finally:
+        _close_pdf()
+
+
+def _default_cache_file_name(paths: List[str], labels: List[str], *settings) -> str:
+    """Name of the cache file of the ingestion, which changes when a file or a setting changes."""
+    ingestion_hash = hashlib.sha256(json.dumps(settings, default=repr).encode())
+    for path, label in zip(paths, labels):
+        stat = os.stat(path)
+        ingestion_hash.update(json.dumps([path, label, stat.st_size, stat.st_mtime_ns]).encode())
+    return str(Path(config.HF_DATASETS_CACHE) / "document_tools" / f"ingest-{ingestion_hash.hexdigest()[:16]}.arrow")
+
+
+def ingest_directory(
+    directory: Union[str, Path],
+    cache_file_name: Optional[str] = None,
+    max_size: Optional[Tuple[int, int]] = DEFAULT_MAX_SIZE,
+    pdf_dpi: int = DEFAULT_DPI,
+    num_proc: Optional[int] = None,
+    writer_batch_size: int = 100,
+    label_fn: Optional[Callable[[Path], str]] = None,
+) -> Dataset:
+    """
+    Ingest a directory tree of documents into a dataset with the `image` and `label` columns expected by the encoders.
+
+    The documents are found with `find_documents`, and labelled with the name of their folder by default. The images
+    are decoded and shrunk to `max_size`, and the pages of the pdf documents are rendered one at a time, each process
+    of the pool of `num_proc` processes opening a document once. The pages are written to an Arrow file as they are
+    loaded, `writer_batch_size` at a time, so the memory used depends neither on the number of documents nor on their
+    number of pages. Files and pages that can't be decoded are skipped with a warning.
+
+    Parameters
+    ----------
+    directory : str or Path
+        Root of the directory tree.
+    cache_file_name : str, optional (default=None)
+        Path of the Arrow file written. By default, a file in the cache of 🤗 Datasets, named after the paths, sizes
+        and modification times of the documents and the settings, so ingesting the same directory again is instant.
+    max_size : Tuple[int, int], optional (default=(2048, 2048))
+        Maximum width and height of the pages, which are shrunk to fit, keeping their aspect ratio. If None, the
+        images are kept at full resolution.
+    pdf_dpi : int (default=200)
+        Resolution of the rendering of the pdf pages, in dots per inch, before they are shrunk to `max_size`. The
+        default is high enough for OCR. Requires `pypdfium2` if there are pdf documents.
+    num_proc : int, optional (default=None)
+        Number of processes decoding the images and rendering the pdf pages. Use `os.cpu_count()` to use all the cores.
+    writer_batch_size : int (default=100)
+        Number of pages buffered in memory before each write.
+    label_fn : Callable[[Path], str], optional (default=None)
+        Function giving the label of a document from its path. By default, the name of its folder.
+
+    Returns
+    -------
+    Dataset
+        Dataset with an `image` column and a `label` column of lists with one label, memory-mapped from the Arrow file.
+    """
+    documents = [str(path) for path in find_documents(directory)]
+    labels = [label_fn(Path(path)) if label_fn is not None else Path(path).parent.name for path in documents]
+
+    if cache_file_name is None:
+        cache_file_name = _default_cache_file_name(documents, labels, max_size, pdf_dpi)
+    if Path(cache_file_name).is_file():
+        logger.info(f"Loading the ingested documents from {cache_file_name}.")
+        return Dataset.from_file(cache_file_name)
+
+    features = Features({"image": Image(), "label": SequenceFeature(ClassLabel(names=sorted(set(labels))))})
+    Path(cache_file_name).parent.mkdir(parents=True, exist_ok=True)
+    tmp_file_name = f"{cache_file_name}.tmp"
+    num_pages = num_skipped = 0
+    with ArrowWriter(features=features, path=tmp_file_name, writer_batch_size=writer_batch_size) as writer:
+        for label, data in _load_pages(documents, labels, max_size, pdf_dpi, num_proc):
+            if data is None:
+                num_skipped += 1
+                continue
+            num_pages += 1
+            writer.write(features.encode_example({"image": {"bytes": data, "path": None}, "label": [label]}))
+        writer.finalize()
+    os.replace(tmp_file_name, cache_file_name)
+
+    logger.info(f"Ingested {num_pages} pages of {len(documents)} documents, skipped {num_skipped}.")
+    return Dataset.from_file(cache_file_name)
@@ -0,0 +1,229 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""instrumentation.py records where the time goes while a dataset is encoded."""
+import json
+import os
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+STATS_DIR_ENV = "DOCUMENT_TOOLS_STATS_DIR"
+
+
+@dataclass
+class StageStats:
+    """Wall time, number of items and number of bytes processed by a stage."""
+
+    seconds: float = 0.0
+    items: int = 0
+    bytes: int = 0
+    calls: int = 0
+
+
+class EncodingStats:
+    """
+    EncodingStats records the wall time, item counts and bytes of each stage of the encoding.
+
+    The encoders record the `convert`, `ocr`, `image_processing` and `tokenization` stages, with the bytes of the
+    images read by the image stages, and `tokenize_dataset` records the whole `ocr_map` and `encode_map` calls, with
+    the bytes of the Arrow files written. Pass an instance to
+    `tokenize_dataset` to collect the stats of all the `num_proc` workers in it. The time each worker spent in the
+    stages of the encoders is kept in `workers`, under the map stage, the split and the process id of the worker, to
+    measure how evenly the work was spread.
+    """
+
+    def __init__(self):
+        """Initialize empty stats."""
+        self.stages: Dict[str, StageStats] = {}
+        self.workers: Dict[str, float] = {}
+        self._stats_dir: Optional[Path] = None
+        self._name = uuid.uuid4().hex
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle the recorded stages only, the stats of other processes are gathered through files."""
+        return {"stages": self.stages, "workers": self.workers, "_stats_dir": None, "_name": self._name}
+
+    def record(self, stage: str, seconds: float, items: int = 0, nbytes: int = 0):
+        """
+        Record a measurement of a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        seconds : float
+            Wall time spent in the stage.
+        items : int (default=0)
+            Number of items processed, for example images or rows.
+        nbytes : int (default=0)
+            Number of bytes processed.
+        """
+        stats = self.stages.setdefault(stage, StageStats())
+        stats.seconds += seconds
+        stats.items += items
+        stats.bytes += nbytes
+        stats.calls += 1
+
+    @contextmanager
+    def measure(self, stage: str, items: int = 0, nbytes: int = 0) -> Iterator[None]:
+        """Measure the wall time of the block of a `with` statement and record it for a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, items, nbytes)
+
+    def merge(self, other: "EncodingStats"):
+        """Add the stages recorded by other stats to these stats."""
+        for stage, stats in other.stages.items():
+            merged = self.stages.setdefault(stage, StageStats())
+            merged.seconds += stats.seconds
+            merged.items += stats.items
+            merged.bytes += stats.bytes
+            merged.calls += stats.calls
+        for worker, seconds in other.workers.items():
+            self.workers[worker] = self.workers.get(worker, 0.0) + seconds
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Summarize the recorded stages.
+
+        Returns
+        -------
+        Dict[str, Dict[str, float]]
+            For each stage, the recorded values, the throughput in items per second, and the share of the time
+            recorded by the encoders that the stage represents.
+        """
+        encoder_seconds = sum(stats.seconds for stage, stats in self.stages.items() if not stage.endswith("_map"))
+        summary = {}
+        for stage, stats in self.stages.items():
+            summary[stage] = {
+                **asdict(stats),
+                "items_per_second": stats.items / stats.seconds if stats.seconds else 0.0,
+            }
+            if not stage.endswith("_map"):
+                summary[stage]["share"] = stats.seconds / encoder_seconds if encoder_seconds else 0.0
+        return summary
+
+    def worker_utilization(self, stage: str) -> Dict[str, float]:
+        """
+        Measure how busy each worker of a map stage was, compared with the busiest worker of the same split.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the map stage, for example `encode_map`.
+
+        Returns
+        -------
+        Dict[str, float]
+            For each worker of the stage, the time it spent in the stages of the encoders, as a share of the time of
+            the busiest worker of its split, which sets the wall time of the map of the split.
+        """
+        workers = {worker: seconds for worker, seconds in self.workers.items() if worker.startswith(f"{stage}/")}
+        splits = {worker: worker.rsplit("/", 1)[0] for worker in workers}
+        busiest: Dict[str, float] = {}
+        for worker, seconds in workers.items():
+            busiest[splits[worker]] = max(busiest.get(splits[worker], 0.0), seconds)
+        return {
+            worker: seconds / busiest[splits[worker]] if busiest[splits[worker]] else 1.0
+            for worker, seconds in workers.items()
+        }
+
+    def flush(self):
+        """Write the stats to the directory shared by the worker processes, if there is one."""
+        if self._stats_dir is None:
+            return
+        path = self._stats_dir / f"{os.getpid()}-{self._name}.json"
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({stage: asdict(stats) for stage, stats in self.stages.items()}))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, stats_dir: Path, stage: Optional[str] = None, split: Optional[str] = None) -> "EncodingStats":
+        """
+        Merge all the stats written in a directory by `flush`.
+
+        The time of each worker process of the `stage` is kept under `{stage}/{split}/{pid}`, the stats written by the
+        same process being summed.
+        """
+        loaded = cls()
+        for path in sorted(Path(stats_dir).glob("*.json")):
+            worker = cls()
+            worker.stages = {name: StageStats(**values) for name, values in json.loads(path.read_text()).items()}
+            if stage is not None:
+                pid = path.name.split("-", 1)[0]
+                worker.workers[f"{stage}/{split}/{pid}"] = sum(
+                    stats.seconds for name, stats in worker.stages.items() if not name.endswith("_map")
+                )
+            loaded.merge(worker)
+        return loaded
+
+    @classmethod
+    def from_environment(cls) -> Optional["EncodingStats"]:
+        """Create the stats of a worker process if the parent process collects stats, else return None."""
+        stats_dir = os.environ.get(STATS_DIR_ENV)
+        if not stats_dir:
+            return None
+        stats = cls()
+        stats._stats_dir = Path(stats_dir)
+        return stats
+
+
+@contextmanager
+def collect_stats(
+    stats: Optional[EncodingStats], stage: Optional[str] = None, split: Optional[str] = None
+) -> Iterator[Optional[EncodingStats]]:
+    """
+    Collect the stats recorded by the current process and its worker processes into `stats`.
+
+    The encoders do not carry their stats when they are pickled, so that enabling the stats does not change the
+    fingerprints used by `datasets` to cache results. Instead, the worker processes find a shared directory in the
+    environment, flush their stats to it, and all of them are merged into `stats` when the block exits.
+
+    Parameters
+    ----------
+    stats : EncodingStats, optional
+        Stats to fill. If None, nothing is collected.
+    stage : str, optional (default=None)
+        Name of the map stage run by the workers, under which the time of each worker is kept in `stats.workers`.
+    split : str, optional (default=None)
+        Name of the split mapped by the workers, which tells apart the workers of the maps of the different splits.
+
+    Yields
+    ------
+    EncodingStats, optional
+        The stats to give to the encoders of the current process, or None if `stats` is None.
+    """
+    if stats is None:
+        yield None
+        return
+
+    previous = os.environ.get(STATS_DIR_ENV)
+    with tempfile.TemporaryDirectory() as stats_dir:
+        os.environ[STATS_DIR_ENV] = stats_dir
+        try:
+            yield EncodingStats.from_environment()
+        finally:
+            if previous is None:
+                os.environ.pop(STATS_DIR_ENV, None)
+            else:
+                os.environ[STATS_DIR_ENV] = previous
+            stats.merge(EncodingStats.load(Path(stats_dir), stage, split))
@@ -0,0 +1,303 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""serving.py encodes single documents at inference time, gathering concurrent requests into micro-batches."""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import ExitStack, nullcontext
+from typing import Any, ContextManager, Dict, List, Optional, Union
+
+import numpy as np
+from PIL import Image
+
+from .collate import PaddingCollator
+from .documents import ImageDocument
+from .encoders import TARGET_MODELS
+from .encoders.encoders import BaseEncoder
+
+logger = logging.getLogger(__name__)
+
+DocumentInput = Union[ImageDocument, Image.Image]
+
+
+class _Request:
+    """A document waiting to be encoded, and the future of its encoded tensors."""
+
+    def __init__(self, document: DocumentInput):
+        self.document = document
+        self.future: Future = Future()
+
+
+def _open_document(document: DocumentInput) -> ContextManager[Image.Image]:
+    """Decode the image of a document for the duration of a `with` block."""
+    if isinstance(document, ImageDocument):
+        return document.open_image()
+    if isinstance(document, Image.Image):
+        return nullcontext(document)
+    raise TypeError(
+        f"The documents have to be either an `ImageDocument` or a PIL image. You provided: {type(document)}"
+    )
+
+
+class EncodingService:
+    """
+    EncodingService encodes single documents with low latency, on the warm processor of an encoder.
+
+    The requests are queued and encoded by a worker thread in micro-batches: a batch starts with the oldest waiting
+    request and takes the requests arriving within `max_wait` seconds of it, up to `max_batch_size` requests. Under
+    load, the cost of each call of the image processor and the tokenizer is shared by a whole batch, while a lone
+    request waits at most `max_wait`. `encode` is thread-safe and blocks the calling thread, `encode_async` can be
+    awaited from an asyncio event loop, and both share the same batches.
+    """
+
+    def __init__(
+        self,
+        encoder: BaseEncoder,
+        max_batch_size: int = 8,
+        max_wait: float = 0.005,
+        return_tensors: str = "np",
+    ):
+        """
+        Initialize the encoding service.
+
+        Parameters
+        ----------
+        encoder : BaseEncoder
+            Encoder of the target model, with its processor loaded. Its `stats` record the stages of each batch.
+        max_batch_size : int (default=8)
+            Maximum number of documents encoded together.
+        max_wait : float (default=0.005)
+            Maximum time in seconds a request waits for other requests to join its batch.
+        return_tensors : str (default="np")
+            Type of the returned arrays, "np" for numpy arrays or "pt" for torch tensors.
+
+        Raises
+        ------
+        ValueError
+            If `max_batch_size` is not positive or `max_wait` is negative.
+        """
+        if max_batch_size < 1 or max_wait < 0:
+            raise ValueError(
+                f"`max_batch_size` must be positive and `max_wait` non-negative, not {max_batch_size} and {max_wait}."
+            )
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        tokenizer = getattr(encoder.processor, "tokenizer", None)
+        self.collator = PaddingCollator(
+            pad_token_id=getattr(tokenizer, "pad_token_id", None) or 0, return_tensors=return_tensors
+        )
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+        self._closed = False
+
+    @classmethod
+    def from_target_model(
+        cls,
+        target_model: str,
+        processor_config: Optional[Dict[str, Any]] = None,
+        labels: Optional[List[Any]] = None,
+        max_batch_size: int = 8,
+        max_wait: float = 0.005,
+        return_tensors: str = "np",
+        **encoder_kwargs,
+    ) -> "EncodingService":
+        """
+        Create a service with the encoder of a target model, whose processor is loaded once, before the first request.
+
+        Parameters
+        ----------
+        target_model : str
+            Target model, one of `TARGET_MODELS`.
+        processor_config : Dict[str, Any], optional (default=None)
+            Configuration for the processor of the target model.
+        labels : List[Any], optional (default=None)
+            Labels of the model. The documents are encoded without labels, so they are only needed by the features.
+        max_batch_size : int (default=8)
+            Maximum number of documents encoded together.
+        max_wait : float (default=0.005)
+            Maximum time in seconds a request waits for other requests to join its batch.
+        return_tensors : str (default="np")
+            Type of the returned arrays, "np" for numpy arrays or "pt" for torch tensors.
+        encoder_kwargs : Dict[str, Any]
+            Other arguments of the encoder, such as `ocr_backend`, `ocr_cache`, `fast_image_processing` or `stride`.
+
+        Returns
+        -------
+        EncodingService
+            The service, which starts its worker thread on the first request.
+
+        Raises
+        ------
+        KeyError
+            If the target model is not supported.
+        """
+        encoder = TARGET_MODELS[target_model](config=processor_config, labels=labels or [], **encoder_kwargs)
+        return cls(encoder, max_batch_size=max_batch_size, max_wait=max_wait, return_tensors=return_tensors)
+
+    def __enter__(self) -> "EncodingService":
+        """Use the service in a `with` block, which closes it on exit."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the service."""
+        self.close()
+
+    def submit(self, document: DocumentInput) -> Future:
+        """
+        Queue a document to be encoded in the next micro-batch.
+
+        Parameters
+        ----------
+        document : ImageDocument or PIL.Image.Image
+            Document to encode. An `ImageDocument` is only decoded when its batch is encoded.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future of the encoded tensors of the document, as returned by `encode`.
+
+        Raises
+        ------
+        RuntimeError
+            If the service is closed.
+        """
+        request = _Request(document)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The encoding service is closed.")
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="EncodingService", daemon=True)
+                self._worker.start()
+            self._queue.put(request)
+        return request.future
+
+    def encode(self, document: DocumentInput, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Encode a document, blocking until its micro-batch is encoded.
+
+        Parameters
+        ----------
+        document : ImageDocument or PIL.Image.Image
+            Document to encode.
+        timeout : float, optional (default=None)
+            Maximum time to wait in seconds. Wait as long as needed if None.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The encoded tensors of the document, with a first dimension of 1, or of the number of windows of the page
+            if the encoder splits the pages with a `stride`. The labels are left out.
+
+        Raises
+        ------
+        concurrent.futures.TimeoutError
+            If the document is not encoded within `timeout` seconds.
+        """
+        return self.submit(document).result(timeout)
+
+    async def encode_async(self, document: DocumentInput) -> Dict[str, Any]:
+        """
+        Encode a document without blocking the event loop.
+
+        Parameters
+        ----------
+        document : ImageDocument or PIL.Image.Image
+            Document to encode.
+
+        Returns
+        -------
+        Dict[str, Any]
+            The encoded tensors of the document, as returned by `encode`.
+        """
+        return await asyncio.wrap_future(self.submit(document))
+
+    def close(self):
+        """Encode the requests already queued, then stop the worker thread. No request can be submitted anymore."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            worker = self._worker
+            self._queue.put(None)
+        if worker is not None:
+            worker.join()
+
+    def _next_batch(self, first: _Request) -> List[Optional[_Request]]:
+        """Gather the requests arriving within `max_wait` of the first one, up to `max_batch_size` requests."""
+        batch: List[Optional[_Request]] = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                # Once the deadline has passed, the requests already queued still join the batch.
+                request = self._queue.get(block=timeout > 0, timeout=timeout if timeout > 0 else None)
+            except queue.Empty:
+                break
+            batch.append(request)
+            if request is None:
+                break
+        return batch
+
+    def _run(self):
+        """Encode the queued requests in micro-batches until the service is closed."""
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._next_batch(first)
+            requests = [request for request in batch if request is not None]
+            self._encode_requests([request for request in requests if request.future.set_running_or_notify_cancel()])
+            if len(requests) < len(batch):
+                return
+
+    def _encode_requests(self, requests: List[_Request]):
+        """Encode a batch of requests and resolve their futures, each request on its own if the batch fails."""
+        if not requests:
+            return
+        try:
+            results = self._encode_documents([request.document for request in requests])
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0].future.set_exception(e)
+                return
+            logger.warning(f"Encoding a batch of {len(requests)} documents failed, encoding them one by one: {e}")
+            for request in requests:
+                self._encode_requests([request])
+            return
+        for request, result in zip(requests, results):
+            request.future.set_result(result)
+
+    def _encode_documents(self, documents: List[DocumentInput]) -> List[Dict[str, Any]]:
+        """Encode documents with the encoder, and split its outputs into the tensors of each document."""
+        with ExitStack() as stack:
+            images = [stack.enter_context(_open_document(document)) for document in documents]
+            encoded = self.encoder._encode_batch({"image": images, "label": [[] for _ in documents]})
+
+        columns = [column for column in encoded.keys() if column not in ("labels", "document_id")]
+        # With a stride, each page may be split into several rows, which reference their page in the batch.
+        document_ids = np.asarray(encoded.get("document_id", range(len(documents))))
+        results = []
+        for index in range(len(documents)):
+            rows = [
+                {column: encoded[column][row] for column in columns} for row in np.flatnonzero(document_ids == index)
+            ]
+            results.append(self.collator(rows))
+        return results
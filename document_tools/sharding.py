@@ -0,0 +1,414 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""sharding.py splits a dataset into shards of balanced cost, for separate jobs or for the `num_proc` workers."""
+import hashlib
+import heapq
+import json
+import logging
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import Dataset, DatasetDict, concatenate_datasets, load_from_disk
+
+from .checkpoint import _write_json
+
+logger = logging.getLogger(__name__)
+
+SHARD_FILE_NAME = "shard.json"
+
+
+def _stored_sizes(column: pa.ChunkedArray) -> List[Optional[int]]:
+    """Size of the stored bytes of each image of an Arrow column, or None if the image is only stored as a path."""
+    if pa.types.is_struct(column.type):
+        column = pa.Table.from_arrays([column], names=["image"]).flatten().column("image.bytes")
+    if pa.types.is_binary(column.type) or pa.types.is_large_binary(column.type):
+        return pc.binary_length(column).to_pylist()
+    return [None] * len(column)
+
+
+def estimate_page_costs(dataset: Dataset, image_column: str, chunk_size: int = 1000) -> List[int]:
+    """
+    Estimate the cost of encoding each page of a dataset, from the size of its stored image.
+
+    The size of an encoded image grows with its resolution and with the amount of text on the page, which are what
+    makes OCR and the image processor slow. The sizes are read from the Arrow storage in chunks, without decoding the
+    images, and the images stored as paths are measured with the size of their file. The costs only depend on the
+    dataset, so every job computes the same ones.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Dataset to encode.
+    image_column : str
+        Name of the column containing the image.
+    chunk_size : int (default=1000)
+        Number of rows read at once.
+
+    Returns
+    -------
+    List[int]
+        Estimated cost of each row, in bytes, at least 1.
+    """
+    arrow_dataset = dataset.select_columns([image_column]).with_format("arrow")
+    costs: List[int] = []
+    for start in range(0, len(dataset), chunk_size):
+        column = arrow_dataset[start : start + chunk_size].column(image_column)
+        sizes = _stored_sizes(column)
+        if any(size is None for size in sizes):
+            values = column.to_pylist()
+            for row, value in enumerate(values):
+                path = value.get("path") if isinstance(value, dict) else value
+                if sizes[row] is None and isinstance(path, str) and os.path.isfile(path):
+                    sizes[row] = os.path.getsize(path)
+        costs.extend(max(size or 0, 1) for size in sizes)
+    return costs
+
+
+def assign_shards(costs: Sequence[float], num_shards: int, capacities: Optional[Sequence[int]] = None) -> List[int]:
+    """
+    Assign rows to shards so that the shards have about the same total cost, with the longest processing time rule.
+
+    The rows are taken from the most to the least costly, each one given to the shard with the lowest total cost so
+    far that is not full. Ties are broken by the index of the row and of the shard, so the assignment is deterministic.
+
+    Parameters
+    ----------
+    costs : Sequence[float]
+        Estimated cost of each row.
+    num_shards : int
+        Number of shards.
+    capacities : Sequence[int], optional (default=None)
+        Maximum number of rows of each shard, which must add up to at least the number of rows. If None, the shards
+        have no maximum number of rows.
+
+    Returns
+    -------
+    List[int]
+        Shard of each row.
+    """
+    loads = [(0.0, shard) for shard in range(num_shards) if capacities is None or capacities[shard] > 0]
+    sizes = [0] * num_shards
+    assignment = [0] * len(costs)
+    for row in sorted(range(len(costs)), key=lambda row: (-costs[row], row)):
+        load, shard = heapq.heappop(loads)
+        assignment[row] = shard
+        sizes[shard] += 1
+        if capacities is None or sizes[shard] < capacities[shard]:
+            heapq.heappush(loads, (load + costs[row], shard))
+    return assignment
+
+
+def _contiguous_sizes(num_rows: int, num_workers: int) -> List[int]:
+    """Count the rows of the contiguous chunks given to the workers of `datasets.map`, the first ones get the rest."""
+    size, rest = divmod(num_rows, num_workers)
+    return [size + (1 if worker < rest else 0) for worker in range(num_workers)]
+
+
+def _utilization(loads: Sequence[float]) -> float:
+    """Compute the mean load of the workers as a share of the largest one, which sets the wall time."""
+    return sum(loads) / (len(loads) * max(loads)) if loads and max(loads) > 0 else 1.0
+
+
+@dataclass
+class WorkerSchedule:
+    """
+    Order of the rows of a split that gives each `num_proc` worker about the same estimated cost.
+
+    Attributes
+    ----------
+    order : List[int]
+        Rows of the split in the order they are encoded: the rows of the first worker, then of the second one, and so
+        on, each worker taking its rows in their order in the split.
+    loads : List[float]
+        Estimated cost of the rows of each worker.
+    contiguous_loads : List[float]
+        Estimated cost of the rows of each worker with the contiguous chunks of `datasets.map`.
+    """
+
+    order: List[int]
+    loads: List[float]
+    contiguous_loads: List[float]
+
+    @property
+    def utilization(self) -> float:
+        """Estimated mean busy time of the workers as a share of the wall time."""
+        return _utilization(self.loads)
+
+    @property
+    def contiguous_utilization(self) -> float:
+        """Estimated mean busy time of the workers as a share of the wall time, with the contiguous chunks."""
+        return _utilization(self.contiguous_loads)
+
+
+def schedule_workers(costs: Sequence[float], num_workers: int) -> WorkerSchedule:
+    """
+    Order the rows of a split so that the contiguous chunks of `datasets.map` have about the same cost.
+
+    `datasets.map` gives each of its `num_proc` workers a contiguous chunk of the rows, with the same number of rows.
+    The rows are assigned to the workers with `assign_shards`, each worker holding as many rows as its chunk, then
+    ordered worker by worker, so that each chunk holds the rows of its worker.
+
+    Parameters
+    ----------
+    costs : Sequence[float]
+        Estimated cost of each row.
+    num_workers : int
+        Number of workers, capped to the number of rows as `datasets.map` does.
+
+    Returns
+    -------
+    WorkerSchedule
+        The order of the rows and the estimated load of each worker.
+    """
+    num_workers = max(min(num_workers, len(costs)), 1)
+    sizes = _contiguous_sizes(len(costs), num_workers)
+    assignment = assign_shards(costs, num_workers, capacities=sizes)
+    order = sorted(range(len(costs)), key=lambda row: (assignment[row], row))
+
+    loads = [0.0] * num_workers
+    for row, worker in enumerate(assignment):
+        loads[worker] += costs[row]
+    boundaries = np.cumsum([0] + sizes)
+    contiguous_loads = [float(sum(costs[start:end])) for start, end in zip(boundaries[:-1], boundaries[1:])]
+    return WorkerSchedule(order=order, loads=loads, contiguous_loads=contiguous_loads)
+
+
+class WorkerBalancing:
+    """
+    WorkerBalancing reorders each split so that the `num_proc` workers of `datasets.map` get about the same work.
+
+    The costs of the rows are estimated with `estimate_page_costs`, the rows are ordered with `schedule_workers`, and
+    the encoded rows are selected back in the order of the input dataset, through an indices mapping.
+    """
+
+    def __init__(self, num_proc: int):
+        """
+        Initialize the balancing.
+
+        Parameters
+        ----------
+        num_proc : int
+            Number of processes encoding the dataset.
+        """
+        self.num_proc = num_proc
+        self.schedules: Dict[str, WorkerSchedule] = {}
+
+    def reorder(self, dataset: DatasetDict, image_column: str) -> DatasetDict:
+        """
+        Order the rows of each split worker by worker.
+
+        Parameters
+        ----------
+        dataset : DatasetDict
+            Dataset to encode.
+        image_column : str
+            Name of the column containing the image.
+
+        Returns
+        -------
+        DatasetDict
+            The rows of each split in the order of their schedule.
+        """
+        reordered = DatasetDict()
+        for split, split_dataset in dataset.items():
+            schedule = schedule_workers(estimate_page_costs(split_dataset, image_column), self.num_proc)
+            self.schedules[split] = schedule
+            reordered[split] = split_dataset.select(schedule.order) if len(split_dataset) > 0 else split_dataset
+            logger.info(
+                f"Estimated utilization of the {len(schedule.loads)} workers encoding the {split} split: "
+                f"{schedule.utilization:.0%}, instead of {schedule.contiguous_utilization:.0%} with contiguous chunks."
+            )
+        return reordered
+
+    def restore(self, encoded: DatasetDict) -> DatasetDict:
+        """
+        Put the encoded rows of each split back in the order of the input dataset.
+
+        Parameters
+        ----------
+        encoded : DatasetDict
+            The reordered dataset, encoded with one row per input row.
+
+        Returns
+        -------
+        DatasetDict
+            The encoded dataset in the order of the input dataset.
+        """
+        restored = DatasetDict()
+        for split, split_encoded in encoded.items():
+            order = self.schedules[split].order
+            restored[split] = split_encoded.select(np.argsort(order)) if len(order) > 0 else split_encoded
+        return restored
+
+
+class ShardAssignment:
+    """
+    ShardAssignment selects the rows of a dataset encoded by one of `num_shards` jobs, and describes its output.
+
+    Each split is assigned with `assign_shards` on the costs of `estimate_page_costs`, so all the jobs agree on the
+    assignment without communicating. The rows of a shard keep their order. A `shard.json` file is written next to the
+    saved shard, with the rows of each split it holds, so that `merge_shards` puts them back in their order. The costs
+    of the rows of each split are hashed in `cost_hashes`, to tell the shards of different datasets apart.
+    """
+
+    def __init__(self, num_shards: int, shard_index: int):
+        """
+        Initialize the shard assignment.
+
+        Parameters
+        ----------
+        num_shards : int
+            Number of shards the dataset is split into.
+        shard_index : int
+            Index of the shard to encode, from 0 to `num_shards - 1`.
+        """
+        if num_shards < 1 or not 0 <= shard_index < num_shards:
+            raise ValueError(
+                f"`shard_index` must be between 0 and `num_shards` - 1, with a positive `num_shards`, not "
+                f"{shard_index} of {num_shards}."
+            )
+        self.num_shards = num_shards
+        self.shard_index = shard_index
+        self.rows: Dict[str, List[int]] = {}
+        self.num_rows: Dict[str, int] = {}
+        self.costs: Dict[str, int] = {}
+        self.cost_hashes: Dict[str, str] = {}
+
+    @property
+    def name(self) -> str:
+        """Name of the directory of the shard."""
+        return f"shard-{self.shard_index:05d}-of-{self.num_shards:05d}"
+
+    def select_rows(self, dataset: DatasetDict, image_column: str) -> DatasetDict:
+        """
+        Select the rows of each split assigned to the shard.
+
+        Parameters
+        ----------
+        dataset : DatasetDict
+            Whole dataset, the same for all the shards.
+        image_column : str
+            Name of the column containing the image.
+
+        Returns
+        -------
+        DatasetDict
+            The rows of the shard, in their order.
+
+        Raises
+        ------
+        ValueError
+            If the dataset is iterable, the costs of its rows can't be known before encoding it.
+        """
+        if not isinstance(dataset, DatasetDict):
+            raise ValueError("The shards are balanced over the whole dataset, an iterable dataset can't be sharded.")
+
+        selected = DatasetDict()
+        for split, split_dataset in dataset.items():
+            costs = estimate_page_costs(split_dataset, image_column)
+            assignment = assign_shards(costs, self.num_shards)
+            rows = [row for row, shard in enumerate(assignment) if shard == self.shard_index]
+            self.rows[split] = rows
+            self.num_rows[split] = len(split_dataset)
+            self.costs[split] = sum(costs[row] for row in rows)
+            self.cost_hashes[split] = hashlib.sha256(np.asarray(costs, dtype=np.int64).tobytes()).hexdigest()
+            selected[split] = split_dataset.select(rows)
+            logger.info(
+                f"Shard {self.shard_index + 1}/{self.num_shards} encodes {len(rows)} of {len(split_dataset)} rows "
+                f"of the {split} split, {self.costs[split] / max(sum(costs), 1):.1%} of their estimated cost."
+            )
+        return selected
+
+    def write_manifest(self, path: str, key: str):
+        """
+        Write the `shard.json` file describing the shard saved in a directory.
+
+        Parameters
+        ----------
+        path : str
+            Directory of the saved shard.
+        key : str
+            Fingerprint of the dataset and of the encoder configuration, which must be the same for all the shards
+            merged together.
+        """
+        manifest = {
+            "num_shards": self.num_shards,
+            "shard_index": self.shard_index,
+            "key": key,
+            "splits": {
+                split: {"num_rows": self.num_rows[split], "rows": rows, "cost": self.costs[split]}
+                for split, rows in self.rows.items()
+            },
+        }
+        _write_json(Path(path) / SHARD_FILE_NAME, manifest)
+
+
+def merge_shards(save_path: str) -> DatasetDict:
+    """
+    Merge the shards saved in a directory into one dataset, with the rows of each split in the order of the input.
+
+    The shards are memory-mapped from their Arrow files and concatenated, and the rows are put back in their order
+    with an indices mapping, so no data is copied. Use `save_to_disk` on the result to write a contiguous copy.
+
+    Parameters
+    ----------
+    save_path : str
+        Directory given as `save_path` to the `tokenize_dataset` calls of all the shards, which holds a `shard-*`
+        directory for each shard.
+
+    Returns
+    -------
+    DatasetDict
+        The encoded dataset.
+
+    Raises
+    ------
+    ValueError
+        If a shard is missing, or the shards come from different datasets or configurations.
+    """
+    manifests = {}
+    for manifest_path in sorted(Path(save_path).glob(f"shard-*/{SHARD_FILE_NAME}")):
+        manifests[manifest_path.parent] = json.loads(manifest_path.read_text())
+    if not manifests:
+        raise ValueError(f"There is no shard in {save_path}.")
+
+    first = next(iter(manifests.values()))
+    if any(
+        manifest["key"] != first["key"] or manifest["num_shards"] != first["num_shards"]
+        for manifest in manifests.values()
+    ):
+        raise ValueError(f"The shards in {save_path} were encoded from different datasets or configurations.")
+    missing = set(range(first["num_shards"])) - {manifest["shard_index"] for manifest in manifests.values()}
+    if missing or len(manifests) != first["num_shards"]:
+        raise ValueError(
+            f"The shards {sorted(missing)} of {first['num_shards']} are missing or duplicated in {save_path}."
+        )
+
+    shards = sorted(manifests, key=lambda path: manifests[path]["shard_index"])
+    merged = DatasetDict()
+    for split, split_manifest in first["splits"].items():
+        rows = [row for path in shards for row in manifests[path]["splits"][split]["rows"]]
+        if sorted(rows) != list(range(split_manifest["num_rows"])):
+            raise ValueError(f"The shards in {save_path} don't cover the rows of the {split} split exactly once.")
+        split_dataset = concatenate_datasets([load_from_disk(str(path / split)) for path in shards])
+        order = np.argsort(rows, kind="stable")
+        merged[split] = split_dataset if np.all(order[:-1] < order[1:]) else split_dataset.select(order)
+    return merged
@@ -14,49 +14,570 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """tokenize.py allows to automatically tokenize any dataset to prepare it for the training of a target model."""
-import copy
 import logging
-from typing import Any, Dict, Optional, Union
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union, overload
 
-from datasets import ClassLabel, Dataset, DatasetDict
+import numpy as np
+from datasets import ClassLabel, Dataset, DatasetDict, Features, Image, IterableDataset, IterableDatasetDict, Value
+from PIL import Image as PILImage
 
+from .autotune import find_batch_size
+from .checkpoint import ShardedOutput
+from .dedup import Deduplication
 from .encoders import TARGET_MODELS
-from .utils import _get_label_list
+from .encoders.ocr import DEFAULT_OCR_CACHE_SIZE, OCR_FEATURES, OCRBackend, OCRCache, OCRStage, PrecomputedOCR
+from .incremental import IncrementalEncoding, encoder_fingerprint
+from .instrumentation import EncodingStats, collect_stats
+from .sharding import ShardAssignment, WorkerBalancing
+from .utils import _get_label_list_from_dataset, _get_label_list_from_iterable
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BATCH_SIZE = 2
+DEFAULT_LABEL_DISCOVERY_ROWS = 10_000
 
+
+def _as_dataset_dict(
+    dataset: Union[Dataset, DatasetDict, IterableDataset, IterableDatasetDict]
+) -> Union[DatasetDict, IterableDatasetDict]:
+    """Wrap the splits of a dataset by reference in a new `DatasetDict` or `IterableDatasetDict`."""
+    # `map` never mutates its input, so there is no need to copy the Arrow data.
+    if isinstance(dataset, DatasetDict):
+        return DatasetDict(dataset)
+    elif isinstance(dataset, Dataset):
+        return DatasetDict({"train": dataset})
+    elif isinstance(dataset, IterableDatasetDict):
+        return IterableDatasetDict(dataset)
+    elif isinstance(dataset, IterableDataset):
+        return IterableDatasetDict({"train": dataset})
+    raise TypeError(
+        "The dataset has to be either a `Dataset`, a `DatasetDict`, an `IterableDataset` or an `IterableDatasetDict`. "
+        f"You provided: {type(dataset)}"
+    )
+
+
+def _get_labels(
+    dataset: Union[Dataset, IterableDataset], label_column: str, label_discovery_rows: Optional[int]
+) -> List[Any]:
+    """Get the labels from the `ClassLabel` feature of the label column, or discover them from its values."""
+    features = dataset.features
+    label_feature = getattr(features[label_column], "feature", None) if features is not None else None
+    if isinstance(label_feature, ClassLabel):
+        return label_feature.names
+    elif isinstance(dataset, IterableDataset):
+        return _get_label_list_from_iterable(dataset, label_column, max_rows=label_discovery_rows)
+    return _get_label_list_from_dataset(dataset, label_column)
+
+
+def _map(
+    dataset: Union[DatasetDict, IterableDatasetDict],
+    function: Callable,
+    features: Optional[Features],
+    remove_columns: List[str],
+    batched: bool,
+    batch_size: Optional[int],
+    cache_file_names: Optional[Dict[str, Optional[str]]],
+    keep_in_memory: bool,
+    num_proc: Optional[int],
+    writer_batch_size: Optional[int] = 1000,
+) -> Union[DatasetDict, IterableDatasetDict]:
+    """Map a function over all the splits, lazily for iterable datasets."""
+    if isinstance(dataset, IterableDatasetDict):
+        # Unlike `Dataset.map`, `IterableDataset.map` also removes the columns returned by the function, so the input
+        # columns replaced by an output column (such as the `image` column of LayoutLMv2) must be kept.
+        if features is not None:
+            remove_columns = [column for column in remove_columns if column not in features]
+        return IterableDatasetDict(
+            {
+                split: split_dataset.map(
+                    function,
+                    features=features,
+                    remove_columns=remove_columns,
+                    batched=batched,
+                    batch_size=batch_size if batch_size is not None else 1000,
+                )
+                for split, split_dataset in dataset.items()
+            }
+        )
+    return dataset.map(
+        function,
+        features=features,
+        remove_columns=remove_columns,
+        batched=batched,
+        batch_size=batch_size,
+        cache_file_names=cache_file_names,
+        keep_in_memory=keep_in_memory,
+        num_proc=num_proc,
+        writer_batch_size=writer_batch_size,
+    )
+
+
+def _measured_map(
+    stage: str,
+    stats: Optional[EncodingStats],
+    dataset: Union[DatasetDict, IterableDatasetDict],
+    function: Any,
+    **kwargs,
+) -> Union[DatasetDict, IterableDatasetDict]:
+    """
+    Map a function over all the splits with `_map`, collecting the stats of the function into `stats`.
+
+    The whole map is recorded as the `stage`, with the number of rows and the size of the Arrow files of its output. The
+    time of each worker of the map replaces the one of the previous maps of the `stage` in `stats.workers`.
+    Iterable datasets are mapped lazily, so their function records its stages directly into `stats` while iterated.
+    """
+    if stats is None:
+        return _map(dataset, function, **kwargs)
+    if isinstance(dataset, IterableDatasetDict):
+        function.stats = stats
+        return _map(dataset, function, **kwargs)
+
+    # Only the workers of this call are compared, not those of the previous maps of the stage.
+    stats.workers = {worker: seconds for worker, seconds in stats.workers.items() if not worker.startswith(f"{stage}/")}
+    cache_file_names = kwargs.pop("cache_file_names", None)
+    start = time.perf_counter()
+    mapped = DatasetDict()
+    for split, split_dataset in dataset.items():
+        # Each split is mapped by its own pool of workers, which are collected separately.
+        split_cache_file_names = {split: cache_file_names[split]} if cache_file_names is not None else None
+        with collect_stats(stats, stage, split) as process_stats:
+            function.stats = process_stats
+            try:
+                split_dataset = DatasetDict({split: split_dataset})
+                mapped[split] = _map(split_dataset, function, cache_file_names=split_cache_file_names, **kwargs)[split]
+            finally:
+                function.stats = None
+    nbytes = sum(os.path.getsize(file["filename"]) for files in mapped.cache_files.values() for file in files)
+    stats.record(stage, time.perf_counter() - start, items=sum(mapped.num_rows.values()), nbytes=nbytes)
+    utilization = stats.worker_utilization(stage)
+    if len(utilization) > 1:
+        logger.info(
+            f"Utilization of the workers of {stage}: "
+            f"{', '.join(f'{share:.0%}' for share in utilization.values())}, "
+            f"{sum(utilization.values()) / len(utilization):.0%} on average."
+        )
+    return mapped
+
+
+def _add_ocr_columns(
+    dataset: Union[DatasetDict, IterableDatasetDict],
+    ocr_stage: OCRStage,
+    stats: Optional[EncodingStats],
+    **map_kwargs,
+) -> Union[DatasetDict, IterableDatasetDict]:
+    """
+    Run the OCR stage over all the splits.
+
+    With a precomputed OCR backend, the encoders read the words and boxes from the dataset, so the stage is skipped.
+    """
+    first_split = next(iter(dataset.values()))
+    if ocr_stage.ocr_backend.columns is not None:
+        return dataset
+
+    ocr_features = first_split.features
+    if ocr_features is not None:
+        ocr_features = ocr_features.copy()
+        ocr_features.update(OCR_FEATURES)
+    return _measured_map("ocr_map", stats, dataset, ocr_stage, features=ocr_features, remove_columns=[], **map_kwargs)
+
+
+def _ocr_columns(encoder: Any, separate_ocr: bool) -> List[str]:
+    """Columns of the words and boxes tokenized by the encoder, which are removed from its output."""
+    if encoder.ocr_backend.columns is not None:
+        return list(encoder.ocr_backend.columns)
+    return list(OCR_FEATURES) if separate_ocr else []
+
+
+def _shared_image_size(encoders: List[Any]) -> Tuple[Optional[Tuple[int, int]], int]:
+    """Get the input image size and resampling filter of the encoders, if they all have the same."""
+    settings = set()
+    for encoder in encoders:
+        size = getattr(encoder._image_processor, "size", None)
+        if not isinstance(size, dict) or "width" not in size:
+            return None, PILImage.BILINEAR
+        settings.add(
+            ((size["width"], size["height"]), getattr(encoder._image_processor, "resample", PILImage.BILINEAR))
+        )
+    return settings.pop() if len(settings) == 1 else (None, PILImage.BILINEAR)
+
+
+def _tokenize_for_models(
+    dataset: Union[Dataset, DatasetDict, IterableDataset, IterableDatasetDict],
+    target_models: List[str],
+    arguments: Dict[str, Any],
+) -> Dict[str, Union[DatasetDict, IterableDatasetDict]]:
+    """
+    Tokenize a dataset for several target models, decoding the images and applying OCR once for all of them.
+
+    The labels are discovered once, then a shared OCR stage adds the words and boxes of each image and, if the models
+    have the same input size, replaces each image by its resized copy, which the image processors then use unchanged.
+    Each model tokenizes the shared stage with `tokenize_dataset`, as with `separate_ocr=True`, reading its words and
+    boxes with a `PrecomputedOCR` backend instead of applying OCR again. With `deduplicate`, the shared stage only
+    applies OCR on the unique pages. With `num_shards`, it only applies OCR on the rows of the shard, and each model
+    saves its shard in the `shard-*` directory of its own directory of `save_path`.
+    """
+    tmp_dataset = _as_dataset_dict(dataset)
+    first_split = next(iter(tmp_dataset.values()))
+    labels = arguments["labels"]
+    if labels is None:
+        labels = _get_labels(first_split, arguments["label_column"], arguments["label_discovery_rows"])
+
+    encoders = [
+        TARGET_MODELS[model](config=arguments["processor_config"], labels=labels, ocr_backend=arguments["ocr_backend"])
+        for model in target_models
+    ]
+    ocr_backend = encoders[0].ocr_backend
+    if any(encoder.ocr_backend.settings != ocr_backend.settings for encoder in encoders):
+        raise ValueError("The target models apply OCR with different settings, so they can't share their OCR stage.")
+    image_size, resample = _shared_image_size(encoders)
+    features = first_split.features
+    if features is None or not isinstance(features[arguments["image_column"]], Image):
+        image_size = None
+
+    ocr_cache_dir = arguments["ocr_cache_dir"]
+    ocr_stage = OCRStage(
+        ocr_backend,
+        image_column=arguments["image_column"],
+        ocr_cache=OCRCache(ocr_cache_dir, max_size=arguments["ocr_cache_size"]) if ocr_cache_dir is not None else None,
+        image_size=image_size,
+        resample=resample,
+    )
+    shard_assignment = None
+    if arguments["num_shards"] is not None:
+        shard_assignment = ShardAssignment(arguments["num_shards"], arguments["shard_index"])
+        tmp_dataset = shard_assignment.select_rows(tmp_dataset, arguments["image_column"])  # type: ignore
+    deduplication = None
+    if arguments["deduplicate"]:
+        deduplication = Deduplication(arguments["dedup_max_distance"], arguments["num_proc"], arguments["stats"])
+        tmp_dataset = deduplication.select_unique_rows(
+            tmp_dataset, arguments["image_column"], arguments["label_column"]
+        )
+    ocr_batch_size = arguments["ocr_batch_size"] or arguments["batch_size"]
+    shared_dataset = _add_ocr_columns(
+        tmp_dataset,
+        ocr_stage,
+        arguments["stats"],
+        batched=arguments["batched"],
+        batch_size=ocr_batch_size if not isinstance(ocr_batch_size, str) else DEFAULT_BATCH_SIZE,
+        cache_file_names=arguments["ocr_cache_file_names"],
+        keep_in_memory=arguments["keep_in_memory"],
+        num_proc=arguments["ocr_num_proc"],
+    )
+    if deduplication is not None:
+        # The duplicates get the words, boxes and image of the first row of their group, so that each model finds them
+        # again as exact duplicates and encodes them once too.
+        shared_dataset = deduplication.fan_out(shared_dataset)
+
+    encoded_datasets = {}
+    for target_model, encoder in zip(target_models, encoders):
+        model_arguments = {**arguments, "labels": labels, "separate_ocr": True, "ocr_cache_file_names": None}
+        model_arguments["ocr_backend"] = PrecomputedOCR(*OCR_FEATURES)
+        model_arguments.update(num_shards=None, shard_index=None)
+        if arguments["save_path"] is not None:
+            model_arguments["save_path"] = os.path.join(arguments["save_path"], target_model)
+            if shard_assignment is not None:
+                model_arguments["save_path"] = os.path.join(model_arguments["save_path"], shard_assignment.name)
+        if arguments["cache_file_names"] is not None:
+            model_arguments["cache_file_names"] = arguments["cache_file_names"].get(target_model)
+        shard_path = model_arguments["save_path"]
+        save_shard = shard_assignment is not None and arguments["output_shards"] is None
+        if save_shard:
+            # The shard is saved here, so that an error while saving it is raised instead of logged.
+            model_arguments.update(save_to_disk=False, save_path=None)
+        encoded_datasets[target_model] = tokenize_dataset(shared_dataset, target_model=target_model, **model_arguments)
+        if save_shard:
+            encoded_datasets[target_model].save_to_disk(shard_path)  # type: ignore
+        if shard_assignment is not None:
+            key = _shard_key(target_model, encoder, arguments, shard_assignment)
+            shard_assignment.write_manifest(shard_path, key)
+    return encoded_datasets  # type: ignore
+
+
+def _with_document_ids(dataset: Union[DatasetDict, IterableDatasetDict]) -> Union[DatasetDict, IterableDatasetDict]:
+    """Add the index of each row in its split as a `document_id` column, unless the dataset already has one."""
+    with_ids = {}
+    for split, split_dataset in dataset.items():
+        if split_dataset.column_names is not None and "document_id" in split_dataset.column_names:
+            with_ids[split] = split_dataset
+        elif isinstance(split_dataset, IterableDataset):
+            features = split_dataset.features.copy() if split_dataset.features is not None else None
+            if features is not None:
+                features["document_id"] = Value(dtype="int64")
+            with_ids[split] = split_dataset.map(
+                lambda batch, indices: {"document_id": indices}, with_indices=True, batched=True, features=features
+            )
+        else:
+            # Only the ids are held in memory, the other columns stay memory-mapped.
+            with_ids[split] = split_dataset.add_column("document_id", np.arange(len(split_dataset)))
+    return IterableDatasetDict(with_ids) if isinstance(dataset, IterableDatasetDict) else DatasetDict(with_ids)
+
+
+def _save_encoded(
+    encoded_dataset: Union[DatasetDict, IterableDatasetDict],
+    worker_balancing: Optional[WorkerBalancing],
+    deduplication: Optional[Deduplication],
+    incremental_encoding: Optional[IncrementalEncoding],
+    save_path: Optional[str],
+    raise_errors: bool = False,
+) -> Union[DatasetDict, IterableDatasetDict]:
+    """
+    Restore the order of the rows and fan out the duplicates, then merge the rows with the previous output or save them.
+
+    Errors while saving are logged, unless `raise_errors` is set, and except in the incremental mode, where the previous
+    output must not be lost.
+    """
+    if worker_balancing is not None:
+        encoded_dataset = worker_balancing.restore(encoded_dataset)  # type: ignore
+    if deduplication is not None:
+        encoded_dataset = deduplication.fan_out(encoded_dataset)  # type: ignore
+    if incremental_encoding is not None:
+        return incremental_encoding.merge_and_save(encoded_dataset)  # type: ignore
+    if save_path is not None and raise_errors:
+        encoded_dataset.save_to_disk(save_path)  # type: ignore
+    elif save_path is not None:
+        try:
+            encoded_dataset.save_to_disk(save_path)  # type: ignore
+        except Exception as e:
+            logger.error(e)
+    return encoded_dataset
+
+
+def _shard_key(target_model: str, encoder: Any, arguments: Dict[str, Any], shard_assignment: ShardAssignment) -> str:
+    """Fingerprint of the dataset and configuration of a shard, which must be the same for all the shards merged."""
+    return encoder_fingerprint(
+        splits=shard_assignment.cost_hashes,
+        target_model=target_model,
+        config=encoder.config,
+        labels=encoder.labels,
+        compact=arguments["compact_features"],
+        fast_image_processing=arguments["fast_image_processing"],
+        variable_length=arguments["variable_length"],
+        deduplicate=arguments["deduplicate"],
+        ocr_backend=encoder.ocr_backend.settings,
+        num_shards=arguments["num_shards"],
+    )
+
+
+def _check_arguments(
+    target_model: Optional[Union[str, List[str]]],
+    batch_size: Optional[Union[int, str]],
+    save_to_disk: bool,
+    save_path: Optional[str],
+    incremental: bool,
+    output_shards: Optional[int],
+    stride: Optional[int],
+    deduplicate: bool = False,
+    num_shards: Optional[int] = None,
+    shard_index: Optional[int] = None,
+    balance_workers: bool = False,
+):
+    """Check the arguments of `tokenize_dataset` that do not depend on the dataset."""
+    if not target_model:
+        raise ValueError("""You need to specify the target architecture you want to use to tokenize your dataset.""")
+    else:
+        try:
+            for model in target_model if isinstance(target_model, (list, tuple)) else [target_model]:
+                TARGET_MODELS[model]
+        except KeyError:
+            raise KeyError(
+                f"""
+                You specified a `target_model` that is not supported. Available models: {list(TARGET_MODELS.keys())}
+                If you think that new model should be available, please feel free to open a new issue on the project
+                repository: https://github.com/deeptools-ai/document-tools/issues
+            """
+            )
+
+    if isinstance(batch_size, str) and batch_size != "auto":
+        raise ValueError(f"`batch_size` must be an integer or 'auto', not {batch_size!r}.")
+
+    if save_to_disk and save_path is None:
+        raise ValueError(
+            """
+            You need to specify a path to save the dataset, because you chose to save it to disk. You can disable saving
+            to disk by setting `save_to_disk=False`.
+        """
+        )
+    elif not save_to_disk and save_path is not None:
+        logger.warning(
+            """
+            You have indicated a path to save the dataset, but have chosen not to save it to disk. You need to add
+            `save_to_disk=True` to the call to `tokenize_dataset` to save the dataset to disk.
+        """
+        )
+    else:
+        logger.info(
+            """
+        The dataset will not be saved to disk. If you want to save it to disk, add `save_to_disk=True` to the call to
+        `tokenize_dataset`.
+        """
+        )
+
+    if incremental and not save_to_disk:
+        raise ValueError("The incremental mode compares the dataset with its previous output, set `save_to_disk=True`.")
+    if incremental and isinstance(target_model, (list, tuple)):
+        raise ValueError(
+            "The shared OCR stage of several target models would apply OCR on all the rows, call `tokenize_dataset` "
+            "with `incremental=True` for each target model instead."
+        )
+    if output_shards is not None and (not save_to_disk or incremental):
+        raise ValueError("The sharded output mode requires `save_to_disk=True` and can't be used with `incremental`.")
+    if stride is not None and (stride < 0 or incremental):
+        raise ValueError(
+            "The `stride` of the windows must be a non-negative integer, and can't be used with `incremental`."
+        )
+    if deduplicate and (stride is not None or output_shards is not None):
+        raise ValueError("The deduplication can't be used with `stride` or `output_shards`.")
+    if (num_shards is None) != (shard_index is None):
+        raise ValueError("`num_shards` and `shard_index` must be given together.")
+    if num_shards is not None and (not save_to_disk or incremental or stride is not None):
+        raise ValueError(
+            "The shards are saved to disk, set `save_to_disk=True`. They can't use `incremental` or `stride`."
+        )
+    if balance_workers and (stride is not None or output_shards is not None):
+        raise ValueError("The balancing of the workers can't be used with `stride` or `output_shards`.")
+
+
+@overload
 def tokenize_dataset(
-    dataset: Union[Dataset, DatasetDict],
-    target_model: str = None,
+    dataset: Union[Dataset, DatasetDict, IterableDataset, IterableDatasetDict],
+    target_model: Optional[str] = ...,
+    image_column: str = ...,
+    label_column: str = ...,
+    batched: bool = ...,
+    batch_size: Optional[Union[int, str]] = ...,
+    cache_file_names: Optional[Dict[str, Optional[str]]] = ...,
+    keep_in_memory: bool = ...,
+    num_proc: Optional[int] = ...,
+    processor_config: Optional[Dict[str, Any]] = ...,
+    save_to_disk: bool = ...,
+    save_path: str = ...,
+    ocr_cache_dir: Optional[str] = ...,
+    ocr_cache_size: Optional[int] = ...,
+    separate_ocr: bool = ...,
+    ocr_batch_size: Optional[int] = ...,
+    ocr_num_proc: Optional[int] = ...,
+    ocr_cache_file_names: Optional[Dict[str, Optional[str]]] = ...,
+    compact_features: bool = ...,
+    labels: Optional[List[Any]] = ...,
+    label_discovery_rows: Optional[int] = ...,
+    max_rss: Optional[int] = ...,
+    stats: Optional[EncodingStats] = ...,
+    incremental: bool = ...,
+    output_shards: Optional[int] = ...,
+    fast_image_processing: bool = ...,
+    variable_length: bool = ...,
+    stride: Optional[int] = ...,
+    ocr_backend: Optional[OCRBackend] = ...,
+    deduplicate: bool = ...,
+    dedup_max_distance: Optional[int] = ...,
+    num_shards: Optional[int] = ...,
+    shard_index: Optional[int] = ...,
+    balance_workers: bool = ...,
+) -> Union[DatasetDict, IterableDatasetDict]:
+    ...
+
+
+@overload
+def tokenize_dataset(
+    dataset: Union[Dataset, DatasetDict, IterableDataset, IterableDatasetDict],
+    target_model: List[str],
+    image_column: str = ...,
+    label_column: str = ...,
+    batched: bool = ...,
+    batch_size: Optional[Union[int, str]] = ...,
+    cache_file_names: Optional[Dict[str, Optional[str]]] = ...,
+    keep_in_memory: bool = ...,
+    num_proc: Optional[int] = ...,
+    processor_config: Optional[Dict[str, Any]] = ...,
+    save_to_disk: bool = ...,
+    save_path: str = ...,
+    ocr_cache_dir: Optional[str] = ...,
+    ocr_cache_size: Optional[int] = ...,
+    separate_ocr: bool = ...,
+    ocr_batch_size: Optional[int] = ...,
+    ocr_num_proc: Optional[int] = ...,
+    ocr_cache_file_names: Optional[Dict[str, Optional[str]]] = ...,
+    compact_features: bool = ...,
+    labels: Optional[List[Any]] = ...,
+    label_discovery_rows: Optional[int] = ...,
+    max_rss: Optional[int] = ...,
+    stats: Optional[EncodingStats] = ...,
+    incremental: bool = ...,
+    output_shards: Optional[int] = ...,
+    fast_image_processing: bool = ...,
+    variable_length: bool = ...,
+    stride: Optional[int] = ...,
+    ocr_backend: Optional[OCRBackend] = ...,
+    deduplicate: bool = ...,
+    dedup_max_distance: Optional[int] = ...,
+    num_shards: Optional[int] = ...,
+    shard_index: Optional[int] = ...,
+    balance_workers: bool = ...,
+) -> Dict[str, Union[DatasetDict, IterableDatasetDict]]:
+    ...
+
+
+def tokenize_dataset(
+    dataset: Union[Dataset, DatasetDict, IterableDataset, IterableDatasetDict],
+    target_model: Optional[Union[str, List[str]]] = None,
     image_column: str = "image",
     label_column: str = "label",
     batched: bool = True,
-    batch_size: Optional[int] = 2,
+    batch_size: Optional[Union[int, str]] = DEFAULT_BATCH_SIZE,
     cache_file_names: Optional[Dict[str, Optional[str]]] = None,
     keep_in_memory: bool = False,
     num_proc: Optional[int] = None,
     processor_config: Optional[Dict[str, Any]] = None,
     save_to_disk: bool = False,
     save_path: str = None,
-) -> DatasetDict:
+    ocr_cache_dir: Optional[str] = None,
+    ocr_cache_size: Optional[int] = DEFAULT_OCR_CACHE_SIZE,
+    separate_ocr: bool = False,
+    ocr_batch_size: Optional[int] = None,
+    ocr_num_proc: Optional[int] = None,
+    ocr_cache_file_names: Optional[Dict[str, Optional[str]]] = None,
+    compact_features: bool = False,
+    labels: Optional[List[Any]] = None,
+    label_discovery_rows: Optional[int] = DEFAULT_LABEL_DISCOVERY_ROWS,
+    max_rss: Optional[int] = None,
+    stats: Optional[EncodingStats] = None,
+    incremental: bool = False,
+    output_shards: Optional[int] = None,
+    fast_image_processing: bool = False,
+    variable_length: bool = False,
+    stride: Optional[int] = None,
+    ocr_backend: Optional[OCRBackend] = None,
+    deduplicate: bool = False,
+    dedup_max_distance: Optional[int] = None,
+    num_shards: Optional[int] = None,
+    shard_index: Optional[int] = None,
+    balance_workers: bool = False,
+) -> Union[DatasetDict, IterableDatasetDict, Dict[str, Union[DatasetDict, IterableDatasetDict]]]:
     """
     Tokenize a dataset using a target model and return a new dataset with the encoded features and labels.
 
     Parameters
     ----------
-    dataset : Dataset or DatasetDict, required
-        Dataset to be tokenized.
-    target_model : str, optional (default=None)
-        Target model to use for tokenization.
+    dataset : Dataset, DatasetDict, IterableDataset or IterableDatasetDict, required
+        Dataset to be tokenized. Iterable datasets are encoded lazily, while they are iterated.
+    target_model : str or List[str], optional (default=None)
+        Target model to use for tokenization, or a list of target models. With a list, the images are decoded and OCR
+        is applied once for all the models, in a shared first stage that also shrinks the images to the input size of
+        the models if they all have the same. Each model then tokenizes the shared stage as with `separate_ocr=True`,
+        and is saved to `save_path/<target model>`. `cache_file_names` is then keyed by target model. A list can't be
+        used with `incremental`.
     image_column : str (default="image")
         Name of the column containing the image.
     label_column : str (default="label")
         Name of the column containing the label.
     batched : bool (default=True)
         Whether to use batched encoding.
-    batch_size : int, optional (default=2)
-        Batch size for batched encoding.
+    batch_size : int or "auto", optional (default=2)
+        Batch size for batched encoding. With "auto", the encoder is first run on batches of growing size taken from
+        the first rows of the first split, and the batch size (and the Arrow writer batch size) with the best
+        throughput within `max_rss` is used. The measurements are logged.
     cache_file_names : Dict[str, Optional[str]], optional (default=None)
         Dictionary containing the cache file names for each target model.
     keep_in_memory : bool (default=False)
@@ -69,92 +590,271 @@ def tokenize_dataset(
         Whether to save the dataset to disk or not.
     save_path : str (default=None)
         Path to save the dataset to disk if `save_to_disk` is True.
+    ocr_cache_dir : str, optional (default=None)
+        Directory of a persistent OCR cache. If provided, the OCR results are cached by image content and OCR settings,
+        so running again on the same images, even for another target model, skips OCR.
+    ocr_cache_size : int, optional (default=1GiB)
+        Maximum size in bytes of the OCR cache, the least recently used results are evicted above it.
+    separate_ocr : bool (default=False)
+        Whether to run OCR as a first stage of its own. The first stage writes the `words` and `boxes` of each image to
+        an intermediate dataset, then the second stage tokenizes them with the processor without applying OCR. Each
+        stage is cached by `datasets` on its own, so an interrupted run resumes from the last finished stage. To
+        tokenize `words` and `boxes` columns computed beforehand instead, use a `PrecomputedOCR` backend.
+    ocr_batch_size : int, optional (default=None)
+        Batch size of the OCR stage if `separate_ocr` is True. Defaults to `batch_size`, or 2 if it is "auto".
+    ocr_num_proc : int, optional (default=None)
+        Number of processes of the OCR stage if `separate_ocr` is True.
+    ocr_cache_file_names : Dict[str, Optional[str]], optional (default=None)
+        Dictionary containing the cache file names of the OCR stage for each split if `separate_ocr` is True.
+    compact_features : bool (default=False)
+        Whether to store the encoded features with the narrowest safe dtypes (uint8 images, int16 boxes, int32 ids and
+        int8 masks) instead of int64. Use `document_tools.collate.widen_batch` or the `torch` format to widen them
+        back when loading.
+    labels : List[Any], optional (default=None)
+        Labels of the dataset. If not provided, they are read from the `ClassLabel` feature of the label column or
+        discovered from the values of the label column of the first split.
+    label_discovery_rows : int, optional (default=10_000)
+        Maximum number of rows read to discover the labels of an iterable dataset. `None` reads the whole first split.
+    max_rss : int, optional (default=None)
+        Ceiling of the resident memory of all the encoding processes, in bytes, used when `batch_size="auto"`.
+    stats : EncodingStats, optional (default=None)
+        Stats filled with the wall time, item counts and bytes of each stage of the encoding, summed over all the
+        `num_proc` workers, and of each `datasets.map` call. A summary is logged at the end. If None, nothing is
+        measured. Iterable datasets record their stages while they are iterated.
+    incremental : bool (default=False)
+        Whether to only encode the rows added or modified since the previous run saved to `save_path`. A manifest of
+        the fingerprints of the rows (image bytes and label) and of the encoder configuration is saved with the
+        dataset. On the next run, the rows already encoded are reused from the previous output, and only the new rows
+        are encoded and saved, as a new part of `save_path`. The output is loaded with `load_incremental(save_path)`.
+        Requires `save_to_disk=True`, and errors while saving are raised. `cache_file_names` and
+        `ocr_cache_file_names` are ignored.
+    output_shards : int, optional (default=None)
+        Number of contiguous shards of each split to encode and write to `save_path` one after the other. The Arrow
+        files of each shard are written directly in `save_path` by the `num_proc` workers as soon as the shard is
+        encoded, and a progress file records the finished shards, so that an interrupted run with the same dataset and
+        configuration resumes from the last finished shard. Requires `save_to_disk=True`, errors while writing are
+        raised, and `cache_file_names` is ignored. The output is loaded with `datasets.load_from_disk`.
+    fast_image_processing : bool (default=False)
+        Whether to compute the pixel values of a whole batch at once instead of with the image processor. The images
+        are shrunk to the input size of the model before being converted to RGB, and the batch is rescaled and
+        normalized as a single array. With `separate_ocr=True`, the images are not decoded by `datasets` in the
+        encoding stage, so JPEG images are decoded directly at a reduced scale. The pixel values are close to, but
+        not exactly, the ones of the image processor. OCR still runs on the full resolution images.
+    variable_length : bool (default=False)
+        Whether to store each row with its own number of tokens instead of padding all of them to the maximum length,
+        with `Sequence` features for the ids, masks and boxes. This is much smaller on disk for documents with few
+        words. Use `document_tools.collate.PaddingCollator` to pad each batch to its longest row when loading, and
+        `document_tools.collate.LengthBucketSampler` to batch rows of similar lengths together.
+    stride : int, optional (default=None)
+        If set, the pages with more tokens than the maximum length are split into overlapping windows of the maximum
+        length instead of being truncated, with `stride` tokens repeated between consecutive windows. Each window is a
+        row with its own tokens and boxes, and the pixel values and label of its page. The `document_id` column of
+        each window is the index of its page in the split, or the value of the `document_id` column of the dataset if
+        there is one, and its `window` column is its index in the page. All the input columns are removed. Requires a
+        fast tokenizer, and can't be used with `incremental`.
+    ocr_backend : OCRBackend, optional (default=None)
+        Backend applying OCR on the batches of images, Tesseract with the OCR settings of the processor by default.
+        Use `TesseractOCR(num_proc=...)` to run Tesseract in a persistent pool of processes, `CallableOCR` to use
+        another engine, or `PrecomputedOCR` to tokenize the words and boxes of columns of the dataset without applying
+        OCR. The words and boxes columns of a precomputed backend are removed from the output.
+    deduplicate : bool (default=False)
+        Whether to encode the duplicate pages of each split only once. The exact hash of the stored bytes and the
+        perceptual hash of each image are computed in `num_proc` processes, the first row of each group of duplicates
+        with the same label is encoded, and its encoded row is given to all the rows of the group, in the order of the
+        dataset. The number of pages skipped is logged, and recorded in the `dedup_skipped` stage of `stats`. Can't be
+        used with iterable datasets, `stride` or `output_shards`.
+    dedup_max_distance : int, optional (default=None)
+        Maximum number of different bits, out of 256, between the perceptual hashes of near-duplicate pages when
+        `deduplicate` is True, for example 12 to find the pages re-encoded or rescaled. The pages whose hashes are that
+        close are only duplicates if no pixel of their thumbnails differs by more than `MAX_PIXEL_DIFFERENCE` levels of
+        grey. If None, only the pages whose images have identical bytes are duplicates.
+    num_shards : int, optional (default=None)
+        Number of jobs the dataset is split across, for example the tasks of a job array on several machines. Each job
+        encodes the rows of its shard and saves them in the `shard-{shard_index}-of-{num_shards}` directory of
+        `save_path`, with a `shard.json` file describing them. The rows are assigned so that the shards have about the
+        same estimated cost, from the size of the stored images, and all the jobs agree on the assignment. The shards
+        are combined with `merge_shards(save_path)`, which rejects the shards of different datasets. Requires
+        `save_to_disk=True`, errors while saving are raised and leave no `shard.json` file, and can't be used with
+        `incremental` or `stride`. The duplicates are only found within each shard.
+    shard_index : int, optional (default=None)
+        Index of the shard encoded by this call, from 0 to `num_shards - 1`.
+    balance_workers : bool (default=False)
+        Whether to give the `num_proc` workers rows of about the same total cost, instead of the contiguous chunks of
+        `datasets.map`, which have the same number of rows. The cost of each row is estimated from the size of its
+        stored image, the rows are assigned to the workers with the longest processing time rule, and the encoded rows
+        are put back in the order of the dataset. The estimated and measured utilization of the workers are logged,
+        and the time of each worker is kept in `stats.workers`. Can't be used with `stride` or `output_shards`.
 
     Returns
     -------
-    DatasetDict
-        Dataset with the encoded features and labels.
+    DatasetDict or IterableDatasetDict
+        Dataset with the encoded features and labels, an `IterableDatasetDict` if the input dataset is iterable. With
+        a list of target models, a dictionary of the encoded dataset of each target model.
 
     Raises
     ------
     ValueError
         If there is no target model for the dataset. Or if saving to disk is requested but the save path is not
-        provided.
+        provided, or the dataset is iterable. Or if the incremental or sharded output mode is requested without saving
+        to disk, or both are requested, or the incremental mode is requested for a list of target models. Or if `stride`
+        is negative or used with `incremental`. Or if `deduplicate` is used with `stride`, `output_shards` or an
+        iterable dataset. Or if `num_shards` and `shard_index` are not given together, are out of range, or are used
+        without saving to disk, with `incremental`, `stride` or an iterable dataset. Or if `balance_workers` is used
+        with `stride` or `output_shards`.
     KeyError
         If the target model is not supported.
     TypeError
-        If the dataset is not a Dataset or DatasetDict.
+        If the dataset is not a Dataset, DatasetDict, IterableDataset or IterableDatasetDict.
     """
-    if not target_model:
-        raise ValueError("""You need to specify the target architecture you want to use to tokenize your dataset.""")
-    else:
-        try:
-            TARGET_MODELS[target_model]
-        except KeyError:
-            raise KeyError(
-                f"""
-                You specified a `target_model` that is not supported. Available models: {list(TARGET_MODELS.keys())}
-                If you think that new model should be available, please feel free to open a new issue on the project
-                repository: https://github.com/deeptools-ai/document-tools/issues
-            """
-            )
+    arguments = {name: value for name, value in locals().items() if name not in ("dataset", "target_model")}
+    _check_arguments(
+        target_model,
+        batch_size,
+        save_to_disk,
+        save_path,
+        incremental,
+        output_shards,
+        stride,
+        deduplicate,
+        num_shards,
+        shard_index,
+        balance_workers,
+    )
+    if isinstance(target_model, (list, tuple)):
+        return _tokenize_for_models(dataset, list(target_model), arguments)
 
-    if save_to_disk and save_path is None:
-        raise ValueError(
-            """
-            You need to specify a path to save the dataset, because you chose to save it to disk. You can disable saving
-            to disk by setting `save_to_disk=False`.
-        """
-        )
-    elif not save_to_disk and save_path is not None:
-        logger.warning(
-            """
-            You have indicated a path to save the dataset, but have chosen not to save it to disk. You need to add
-            `save_to_disk=True` to the call to `tokenize_dataset` to save the dataset to disk.
-        """
-        )
-    else:
-        logger.info(
-            """
-        The dataset will not be saved to disk. If you want to save it to disk, add `save_to_disk=True` to the call to
-        `tokenize_dataset`.
-        """
+    tmp_dataset = _as_dataset_dict(dataset)
+    dataset_first_key = list(tmp_dataset.keys())[0]
+    if isinstance(tmp_dataset, IterableDatasetDict):
+        if save_to_disk:
+            raise ValueError("An iterable dataset is encoded lazily and can't be saved to disk while it is tokenized.")
+        if num_proc is not None or cache_file_names is not None or keep_in_memory:
+            logger.warning("`num_proc`, `cache_file_names` and `keep_in_memory` are ignored for iterable datasets.")
+
+    if labels is None:
+        labels = _get_labels(tmp_dataset[dataset_first_key], label_column, label_discovery_rows)
+
+    ocr_cache = OCRCache(ocr_cache_dir, max_size=ocr_cache_size) if ocr_cache_dir is not None else None
+    encoder = TARGET_MODELS[target_model](  # type: ignore
+        config=processor_config,
+        labels=labels,
+        ocr_cache=ocr_cache,
+        compact=compact_features,
+        fast_image_processing=fast_image_processing,
+        variable_length=variable_length,
+        stride=stride,
+        ocr_backend=ocr_backend,
+    )
+    features = encoder.features
+    remove_columns = [image_column, label_column]
+    encoder_batch_size = batch_size if isinstance(batch_size, int) or batch_size is None else DEFAULT_BATCH_SIZE
+    writer_batch_size = 1000
+
+    incremental_encoding = None
+    if incremental:
+        if cache_file_names is not None or ocr_cache_file_names is not None:
+            logger.warning("`cache_file_names` and `ocr_cache_file_names` are ignored in the incremental mode.")
+            cache_file_names = ocr_cache_file_names = None
+        encoder_key = encoder_fingerprint(
+            target_model=target_model,
+            config=encoder.config,
+            labels=labels,
+            compact=compact_features,
+            fast_image_processing=fast_image_processing,
+            image_column=image_column,
+            label_column=label_column,
+            ocr_backend=encoder.ocr_backend.settings,
         )
+        incremental_encoding = IncrementalEncoding(save_path, encoder_key)  # type: ignore
+        tmp_dataset = incremental_encoding.select_rows_to_encode(tmp_dataset, image_column, label_column)
 
-    dataset = copy.deepcopy(dataset)
-    if isinstance(dataset, DatasetDict):
-        tmp_dataset = dataset
-        dataset_first_key = list(tmp_dataset.keys())[0]
-    elif isinstance(dataset, Dataset):
-        tmp_dataset = DatasetDict()
-        dataset_first_key = "train"
-        tmp_dataset[dataset_first_key] = dataset
-    else:
-        raise TypeError(f"The dataset has to be either a `Dataset` or a `DatasetDict`. You provided: {type(dataset)}")
+    shard_assignment = ShardAssignment(num_shards, shard_index) if num_shards is not None else None  # type: ignore
+    if shard_assignment is not None:
+        tmp_dataset = shard_assignment.select_rows(tmp_dataset, image_column)  # type: ignore
+        save_path = os.path.join(save_path, shard_assignment.name)
 
-    if isinstance(tmp_dataset[dataset_first_key].features[label_column].feature, ClassLabel):
-        labels = tmp_dataset[dataset_first_key].features[label_column].feature.names
-    else:
-        labels = _get_label_list(tmp_dataset[dataset_first_key][label_column])
+    deduplication = Deduplication(dedup_max_distance, num_proc=num_proc, stats=stats) if deduplicate else None
+    if deduplication is not None:
+        tmp_dataset = deduplication.select_unique_rows(tmp_dataset, image_column, label_column)  # type: ignore
 
-    encoder = TARGET_MODELS[target_model](config=processor_config, labels=labels)
-    features = encoder.features
+    if stride is not None:
+        # The windows are rows of their own, so they need a reference to the page they come from, and none of the
+        # input columns can be kept.
+        tmp_dataset = _with_document_ids(tmp_dataset)
+        remove_columns = tmp_dataset[dataset_first_key].column_names or remove_columns + ["document_id"]
+
+    balance = balance_workers and num_proc is not None and num_proc > 1 and isinstance(tmp_dataset, DatasetDict)
+    worker_balancing = WorkerBalancing(num_proc) if balance else None  # type: ignore
+    if worker_balancing is not None:
+        tmp_dataset = worker_balancing.reorder(tmp_dataset, image_column)  # type: ignore
 
-    encoded_dataset = tmp_dataset.map(
-        encoder,
+    if separate_ocr:
+        tmp_dataset = _add_ocr_columns(
+            tmp_dataset,
+            OCRStage(encoder.ocr_backend, image_column=image_column, ocr_cache=ocr_cache),
+            stats,
+            batched=batched,
+            batch_size=ocr_batch_size if ocr_batch_size is not None else encoder_batch_size,
+            cache_file_names=ocr_cache_file_names,
+            keep_in_memory=keep_in_memory,
+            num_proc=ocr_num_proc,
+        )
+        split_features = tmp_dataset[dataset_first_key].features
+        if fast_image_processing and split_features is not None and isinstance(split_features[image_column], Image):
+            # The words are known, so the encoder only needs the images at the input size of the model.
+            tmp_dataset = tmp_dataset.cast_column(image_column, Image(decode=False))
+
+    remove_columns += [column for column in _ocr_columns(encoder, separate_ocr) if column not in remove_columns]
+
+    if batch_size == "auto" and not (incremental and tmp_dataset[dataset_first_key].num_rows == 0):
+        tuning = find_batch_size(encoder, tmp_dataset[dataset_first_key], max_rss=max_rss, num_proc=num_proc)
+        encoder_batch_size, writer_batch_size = tuning.batch_size, tuning.writer_batch_size
+
+    map_kwargs = dict(
         features=features,
-        remove_columns=[image_column, label_column],
+        remove_columns=remove_columns,
         batched=batched,
-        batch_size=batch_size,
-        cache_file_names=cache_file_names,
+        batch_size=encoder_batch_size,
         keep_in_memory=keep_in_memory,
         num_proc=num_proc,
+        writer_batch_size=writer_batch_size,
     )
+    if output_shards is not None:
+        output_key = encoder_fingerprint(
+            target_model=target_model,
+            config=encoder.config,
+            compact=compact_features,
+            fast_image_processing=fast_image_processing,
+            labels=encoder.labels,
+            output_shards=output_shards,
+            stride=stride,
+            ocr_backend=encoder.ocr_backend.settings,
+            splits={split: split_dataset._fingerprint for split, split_dataset in tmp_dataset.items()},
+        )
+        encoded_dataset = ShardedOutput(save_path, output_shards, output_key).encode(
+            tmp_dataset,
+            lambda shard, shard_file_names: _measured_map(
+                "encode_map", stats, shard, encoder, cache_file_names=shard_file_names, **map_kwargs
+            ),
+            features,
+        )
+    else:
+        encoded_dataset = _measured_map(
+            "encode_map", stats, tmp_dataset, encoder, cache_file_names=cache_file_names, **map_kwargs
+        )
 
-    if save_to_disk:
-        try:
-            encoded_dataset.save_to_disk(save_path)  # type: ignore
-        except Exception as e:
-            logger.error(e)
+    encoded_dataset = _save_encoded(
+        encoded_dataset,
+        worker_balancing,
+        deduplication,
+        incremental_encoding,
+        save_path if save_to_disk and output_shards is None else None,
+        raise_errors=shard_assignment is not None,
+    )
+    if shard_assignment is not None:
+        key = _shard_key(target_model, encoder, arguments, shard_assignment)  # type: ignore
+        shard_assignment.write_manifest(save_path, key)  # type: ignore
 
+    if stats is not None and isinstance(encoded_dataset, DatasetDict):
+        logger.info(f"Encoding stats: {stats.summary()}")
     return encoded_dataset
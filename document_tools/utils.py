@@ -14,7 +14,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """utils.py group all utils functions in one file."""
-from typing import List, Set
+import sys
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Deque, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from datasets import Dataset, IterableDataset
 
 
 def _get_label_list(labels: List[List[int]]) -> List[int]:
@@ -43,3 +51,161 @@ def _get_label_list(labels: List[List[int]]) -> List[int]:
     label_list.sort()
 
     return label_list
+
+
+def _get_label_list_from_dataset(dataset: Dataset, label_column: str, chunk_size: int = 100_000) -> List[Any]:
+    """
+    Get the list of all dataset labels by reading the label column in Arrow chunks.
+
+    The column is never materialized as Python lists: each chunk is flattened down to its values and reduced with
+    `pyarrow.compute.unique`, so the memory used only depends on `chunk_size` and on the number of distinct labels.
+
+    Parameters
+    ----------
+    dataset : Dataset
+        Dataset containing the label column.
+    label_column : str
+        Name of the column containing the labels, either a column of labels or of lists of labels.
+    chunk_size : int (default=100_000)
+        Number of rows read at once.
+
+    Returns
+    -------
+    List[Any]
+        List of labels without duplicates and sorted.
+    """
+    if not isinstance(dataset, Dataset):
+        raise TypeError(f"The dataset must be a `Dataset`, not {type(dataset)}")
+    if chunk_size < 1:
+        raise ValueError(f"`chunk_size` must be a positive integer, not {chunk_size}")
+
+    arrow_dataset = dataset.with_format("arrow", columns=[label_column])
+    unique_labels: Set[Any] = set()
+
+    for start in range(0, len(arrow_dataset), chunk_size):
+        column = arrow_dataset[start : start + chunk_size].column(label_column)
+        for chunk in column.chunks:
+            while pa.types.is_list(chunk.type) or pa.types.is_large_list(chunk.type):
+                chunk = chunk.flatten()
+            unique_labels.update(pc.unique(chunk.drop_null()).to_pylist())
+
+    label_list = list(unique_labels)
+    label_list.sort()
+
+    return label_list
+
+
+def _get_label_list_from_iterable(
+    dataset: IterableDataset, label_column: str, max_rows: Optional[int] = None
+) -> List[Any]:
+    """
+    Get the list of the labels found in the first rows of an iterable dataset.
+
+    Parameters
+    ----------
+    dataset : IterableDataset
+        Iterable dataset containing the label column. It is iterated from its beginning, so it must be re-iterable.
+    label_column : str
+        Name of the column containing the labels, either a column of labels or of lists of labels.
+    max_rows : int, optional (default=None)
+        Maximum number of rows read. If None, the whole dataset is read.
+
+    Returns
+    -------
+    List[Any]
+        List of labels without duplicates and sorted.
+    """
+    if not isinstance(dataset, IterableDataset):
+        raise TypeError(f"The dataset must be an `IterableDataset`, not {type(dataset)}")
+
+    # Only the labels are read, so that the images are not decoded.
+    labels = dataset.select_columns([label_column])
+    rows = labels.take(max_rows) if max_rows is not None else labels
+    unique_labels: Set[Any] = set()
+
+    for row in rows:
+        label = row[label_column]
+        if isinstance(label, list):
+            unique_labels.update(label)
+        elif label is not None:
+            unique_labels.add(label)
+
+    label_list = list(unique_labels)
+    label_list.sort()
+
+    return label_list
+
+
+def _current_rss() -> int:
+    """
+    Get the resident set size of the current process.
+
+    Returns
+    -------
+    int
+        Current resident memory in bytes on Linux. On other platforms, where it can't be read without extra
+        dependencies, the peak resident memory is returned instead, and 0 on the platforms without the `resource`
+        module, such as Windows.
+    """
+    try:
+        import resource
+    except ImportError:
+        return 0
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _call_measuring_rss(function: Callable, *args: Any, interval: float = 0.005) -> Tuple[Any, int]:
+    """
+    Call a function while sampling the resident memory of the process in a thread.
+
+    Unlike `tracemalloc`, the resident memory includes the buffers allocated outside of the Python heap, such as the
+    images of Pillow and the allocations of the tokenizers, and sampling it does not slow the function down.
+
+    Returns
+    -------
+    Tuple[Any, int]
+        The result of the function, and the growth of the resident memory at its peak during the call, in bytes.
+    """
+    before = _current_rss()
+    peak = [before]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            peak[0] = max(peak[0], _current_rss())
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        result = function(*args)
+    finally:
+        done.set()
+        sampler.join()
+    return result, max(peak[0], _current_rss()) - before
+
+
+def _ordered_imap(
+    executor: Executor, function: Callable, arguments: Iterable[Sequence[Any]], max_pending: int
+) -> Iterator[Any]:
+    """
+    Apply a function to each tuple of arguments in an executor, yielding the results in order.
+
+    At most `max_pending` calls are submitted ahead of the result being consumed, so the memory used by the results
+    waiting to be consumed is bounded. The calls still pending when the generator is closed are cancelled.
+    """
+    pending: Deque[Future] = deque()
+    try:
+        for args in arguments:
+            pending.append(executor.submit(function, *args))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,55 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from types import SimpleNamespace
+from typing import Dict, List
+
+import pytest
+from datasets import Features, Sequence, Value
+
+from document_tools import TARGET_MODELS
+from document_tools.encoders.encoders import BaseEncoder
+
+
+class LightweightEncoder(BaseEncoder):
+    """Encoder that does not need any processor, used to test the dataset plumbing of `tokenize_dataset`."""
+
+    calls = 0
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.features = Features(
+            {"input_ids": Sequence(feature=Value(dtype="int64")), "labels": Sequence(feature=Value(dtype="int64"))}
+        )
+        self.processor = SimpleNamespace(image_processor=SimpleNamespace(ocr_lang=None, tesseract_config=""))
+
+    def __call__(self, batch: Dict[str, List]):
+        LightweightEncoder.calls += 1
+        with self._measure("tokenization", len(batch["label"])):
+            if "words" in batch:
+                input_ids = [[len(words)] for words in batch["words"]]
+            else:
+                input_ids = [[len(image)] for image in batch["image"]]
+        if self.stats is not None:
+            self.stats.flush()
+        return {"input_ids": input_ids, "labels": batch["label"]}
+
+
+@pytest.fixture
+def lightweight_target_model(monkeypatch):
+    """Register the lightweight encoder as the `layoutlmv2` target model."""
+    monkeypatch.setitem(TARGET_MODELS, "layoutlmv2", LightweightEncoder)
+    monkeypatch.setattr(LightweightEncoder, "calls", 0)
+    return "layoutlmv2"
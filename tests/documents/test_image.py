@@ -13,10 +13,12 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import pickle
 from pathlib import Path
 from typing import List
 
 import pytest
+from PIL import Image
 
 from document_tools.documents import ImageDocument
 
@@ -80,3 +82,63 @@ def test_image_document_eq(correct_paths: List[str]):
         document1 = ImageDocument(path)
         document2 = ImageDocument(path)
         assert document1 == document2
+
+
+@pytest.fixture
+def image_path(tmp_path: Path) -> Path:
+    path = tmp_path / "scan.png"
+    Image.new("RGB", (40, 30), "red").save(path)
+    return path
+
+
+def test_image_document_load_is_lazy(image_path: Path):
+    """
+    Test that loading an image document only reads the header of the file.
+    """
+    document = ImageDocument(image_path).load()
+    assert document.size == (40, 30)
+    assert document.format == "PNG"
+    assert repr(document) == "ImageDocument(file='scan.png', extension='png')"
+    assert document == ImageDocument(image_path)
+    assert document.to_dict() == {"file": "scan.png", "extension": "png"}
+
+
+def test_image_document_size_loads_header(image_path: Path):
+    """
+    Test that the size is read from the header when the document was not loaded.
+    """
+    assert ImageDocument(image_path).size == (40, 30)
+
+
+def test_image_document_open_image(image_path: Path):
+    """
+    Test that the pixels are decoded when needed, and released after use.
+    """
+    document = ImageDocument(image_path).load()
+    with document.open_image() as image:
+        assert image.getpixel((0, 0)) == (255, 0, 0)
+    with pytest.raises(ValueError):
+        image.getpixel((0, 0))
+
+
+def test_image_document_pickle(image_path: Path):
+    """
+    Test that a loaded document can be pickled, with its header.
+    """
+    document = pickle.loads(pickle.dumps(ImageDocument(image_path).load()))
+    assert document._size == (40, 30)
+    with document.open_image() as image:
+        assert image.size == (40, 30)
+
+
+def test_image_document_load_errors(tmp_path: Path):
+    """
+    Test that empty files and files that are not images can't be loaded.
+    """
+    (tmp_path / "empty.png").touch()
+    with pytest.raises(ValueError):
+        ImageDocument(tmp_path / "empty.png").load()
+
+    (tmp_path / "text.png").write_text("not an image")
+    with pytest.raises(Image.UnidentifiedImageError):
+        ImageDocument(tmp_path / "text.png").load()
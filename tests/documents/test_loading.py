@@ -0,0 +1,147 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pytest
+from PIL import Image
+
+from document_tools.documents import ImageDocument, LoadedDocument, PDFDocument, load_documents, loading
+
+
+class SlowFilesystem:
+    """Stand-in for a network volume, where reading a file takes `latency` seconds, counting the concurrent reads."""
+
+    def __init__(self, latency: float, latencies: Optional[Dict[str, float]] = None):
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.reading = 0
+        self.max_reading = 0
+
+    async def read(self, path: Path) -> bytes:
+        self.reading += 1
+        self.max_reading = max(self.max_reading, self.reading)
+        try:
+            await asyncio.sleep(self.latencies.get(path.name, self.latency))
+            return path.read_bytes()
+        finally:
+            self.reading -= 1
+
+
+def _collect(*args, **kwargs) -> List[LoadedDocument]:
+    async def collect():
+        return [loaded async for loaded in load_documents(*args, **kwargs)]
+
+    return asyncio.run(collect())
+
+
+@pytest.fixture
+def image_paths(tmp_path: Path) -> List[Path]:
+    paths = []
+    for index in range(12):
+        path = tmp_path / f"page-{index}.png"
+        Image.new("L", (40 + index, 30), "white").save(path)
+        paths.append(path)
+    return paths
+
+
+def test_reads_overlap(image_paths: List[Path]):
+    """Test that the files are read concurrently, at most `max_concurrency` at a time."""
+    filesystem = SlowFilesystem(latency=0.1)
+    start = time.perf_counter()
+    loaded = _collect(image_paths, max_concurrency=4, reader=filesystem.read)
+    assert time.perf_counter() - start < 0.1 * len(image_paths) / 2
+    assert filesystem.max_reading == 4
+
+    assert sorted(document.document.file for document in loaded) == sorted(path.name for path in image_paths)
+    assert all(isinstance(document.document, ImageDocument) for document in loaded)
+    assert all(len(document.pages) == 1 and document.pages[0].mode == "RGB" for document in loaded)
+
+
+def test_documents_are_yielded_as_they_finish(image_paths: List[Path]):
+    """Test that a slow file does not hold back the documents read after it."""
+    filesystem = SlowFilesystem(latency=0.01, latencies={"page-0.png": 0.3})
+    loaded = _collect(image_paths, max_concurrency=4, reader=filesystem.read, size=(8, 8))
+    assert loaded[-1].document.file == "page-0.png"
+    assert all(document.pages[0].size == (8, 8) for document in loaded)
+
+
+def test_pools_are_shut_down_off_the_loop(monkeypatch, image_paths: List[Path]):
+    """Test that the pools are shut down outside of the thread of the event loop, even when the consumer stops early."""
+    shutdown_threads = []
+
+    class RecordingPool(ThreadPoolExecutor):
+        def shutdown(self, *args, **kwargs):
+            shutdown_threads.append(threading.current_thread())
+            super().shutdown(*args, **kwargs)
+
+    async def first_document():
+        documents = load_documents(image_paths, max_concurrency=2)
+        try:
+            return await documents.__anext__()
+        finally:
+            await documents.aclose()
+
+    monkeypatch.setattr(loading, "ThreadPoolExecutor", RecordingPool)
+    assert asyncio.run(first_document()) is not None
+    assert len(shutdown_threads) == 1 and shutdown_threads[0] is not threading.main_thread()
+
+
+def test_unreadable_documents_are_skipped(caplog, tmp_path: Path, image_paths: List[Path]):
+    """Test that files that can't be read or decoded are skipped with a warning, in a pool of processes."""
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    loaded = _collect([broken, tmp_path / "missing.png", image_paths[0]], num_proc=2)
+    assert [document.document.file for document in loaded] == ["page-0.png"]
+    assert len([record for record in caplog.records if record.levelname == "WARNING"]) == 2
+
+    with pytest.raises(ValueError):
+        _collect(image_paths, max_concurrency=0)
+
+
+def test_pdf_pages(tmp_path: Path):
+    """Test that all the pages of a pdf document are rendered from its bytes."""
+    pdfium = pytest.importorskip("pypdfium2")
+    pdf = pdfium.PdfDocument.new()
+    for width, height in [(612, 792), (144, 144)]:
+        pdf.new_page(width, height)
+    path = tmp_path / "document.pdf"
+    pdf.save(str(path))
+    pdf.close()
+
+    (loaded,) = _collect([str(path)], dpi=36)
+    assert loaded.document == PDFDocument(path)
+    assert [page.size for page in loaded.pages] == [(306, 396), (72, 72)]
+
+
+def test_pdf_pages_in_groups(monkeypatch, tmp_path: Path):
+    """Test that the pages of a long pdf document are rendered and yielded in groups, in order."""
+    pdfium = pytest.importorskip("pypdfium2")
+    pdf = pdfium.PdfDocument.new()
+    for width in range(72, 72 + 5 * 36, 36):
+        pdf.new_page(width, 72)
+    path = tmp_path / "document.pdf"
+    pdf.save(str(path))
+    pdf.close()
+
+    monkeypatch.setattr(loading, "PDF_PAGES_PER_TASK", 2)
+    loaded = _collect([str(path)], dpi=36)
+    assert [document.first_page for document in loaded] == [0, 2, 4]
+    assert [page.size for document in loaded for page in document.pages] == [(w, 36) for w in range(36, 126, 18)]
@@ -63,3 +63,75 @@ def test_pdf_document_eq(correct_paths: List[str]):
         document1 = PDFDocument(path)
         document2 = PDFDocument(path)
         assert document1 == document2
+
+
+def test_pdf_document_load(tmp_path: Path):
+    """
+    Test that loading a pdf document reads its header.
+    """
+    path = tmp_path / "file.pdf"
+    path.write_bytes(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n1 0 obj\n<<>>\nendobj\n")
+    document = PDFDocument(path).load()
+    assert document.version == "1.7"
+    assert document == PDFDocument(path)
+    assert document.to_dict() == {"file": "file.pdf", "extension": "pdf"}
+
+
+def test_pdf_document_load_errors(tmp_path: Path):
+    """
+    Test that files without a pdf header can't be loaded.
+    """
+    path = tmp_path / "file.pdf"
+    path.write_bytes(b"GIF89a")
+    with pytest.raises(ValueError):
+        PDFDocument(path).load()
+
+
+@pytest.fixture
+def pdf_path(tmp_path: Path) -> Path:
+    """Pdf document of three pages of different sizes, in points."""
+    pdfium = pytest.importorskip("pypdfium2")
+    pdf = pdfium.PdfDocument.new()
+    for width, height in [(612, 792), (792, 612), (144, 144)]:
+        pdf.new_page(width, height)
+    path = tmp_path / "document.pdf"
+    pdf.save(str(path))
+    pdf.close()
+    return path
+
+
+def test_pdf_document_pages(pdf_path: Path):
+    """
+    Test that the pages are rendered one at a time, at the requested resolution or size.
+    """
+    document = PDFDocument(pdf_path)
+    assert document.num_pages == 3
+    assert [page.size for page in document.pages()] == [(1700, 2200), (2200, 1700), (400, 400)]
+    assert [page.size for page in document.pages(dpi=36, pages=[1])] == [(396, 306)]
+
+    pages = list(document.pages(size=(224, 224)))
+    assert [page.size for page in pages] == [(224, 224)] * 3
+    assert all(page.mode == "RGB" for page in pages)
+    assert pages[0].getpixel((0, 0)) == (255, 255, 255)
+
+
+def test_pdf_document_pages_in_processes(pdf_path: Path):
+    """
+    Test that the pages rendered by a pool of processes are yielded in order.
+    """
+    pages = PDFDocument(pdf_path).pages(dpi=36, num_proc=2)
+    assert [page.size for page in pages] == [(306, 396), (396, 306), (72, 72)]
+
+
+def test_pdf_document_to_iterable_dataset(pdf_path: Path):
+    """
+    Test that the pages are streamed as a dataset that can be tokenized.
+    """
+    dataset = PDFDocument(pdf_path).to_iterable_dataset(label=2, size=(224, 224))
+    assert dataset.features is not None
+    assert dataset.features["label"].feature.dtype == "int64"
+    assert dataset.features["page"].dtype == "int64"
+    rows = list(dataset)
+    assert [row["page"] for row in rows] == [0, 1, 2]
+    assert [row["label"] for row in rows] == [[2]] * 3
+    assert all(row["image"].size == (224, 224) for row in rows)
@@ -0,0 +1,86 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import pytest
+from datasets import Dataset
+from PIL import Image
+
+from document_tools.autotune import find_batch_size
+from document_tools.utils import _current_rss
+
+
+def overhead_encoder(batch: Dict[str, List[Any]]) -> Dict[str, Any]:
+    """Encoder with a fixed cost per call, so that larger batches have a better throughput."""
+    time.sleep(0.01)
+    return {"input_ids": [np.zeros(512, dtype=np.int64) for _ in batch["image"]]}
+
+
+@pytest.fixture
+def dataset():
+    return Dataset.from_dict({"image": [b"page"] * 40, "label": [[0]] * 40})
+
+
+def test_find_batch_size_prefers_throughput(dataset: Dataset):
+    """Test that the batch size with the best throughput is chosen among the sizes that fit in the dataset."""
+    tuning = find_batch_size(overhead_encoder, dataset, batch_sizes=(1, 4, 16, 64))
+    assert tuning.batch_size == 16
+    assert sorted(tuning.pages_per_second) == [1, 4, 16]
+    assert tuning.row_size == 512 * 8
+    assert tuning.writer_batch_size % tuning.batch_size == 0
+    assert tuning.writer_batch_size * tuning.row_size <= 64 * 1024**2
+
+
+def test_find_batch_size_respects_memory_ceiling(dataset: Dataset):
+    """Test that the batch sizes exceeding the memory ceiling are not chosen."""
+    tuning = find_batch_size(overhead_encoder, dataset, batch_sizes=(1, 4, 16), max_rss=1)
+    assert tuning.batch_size == 1
+    assert list(tuning.pages_per_second) == [1]
+
+
+def test_find_batch_size_measures_native_memory(dataset: Dataset):
+    """Test that the memory allocated outside of the Python heap, such as image buffers, counts in the ceiling."""
+
+    def image_encoder(batch: Dict[str, List[Any]]) -> Dict[str, Any]:
+        images = [Image.new("RGB", (2048, 2048), "white") for _ in batch["image"]]
+        time.sleep(0.05)
+        return {"input_ids": [np.zeros(8, dtype=np.int64) for _ in images]}
+
+    tuning = find_batch_size(image_encoder, dataset, batch_sizes=(1, 4), max_rss=_current_rss() + 32 * 1024**2)
+    assert list(tuning.pages_per_second) == [1]
+
+
+def test_current_rss_without_resource(monkeypatch):
+    """Test that the memory reads as 0 on the platforms without the `resource` module, instead of failing."""
+    monkeypatch.setitem(sys.modules, "resource", None)
+    assert _current_rss() == 0
+
+
+def test_find_batch_size_with_iterable_dataset(dataset: Dataset):
+    """Test that the first rows of an iterable dataset are used for the measurements."""
+    tuning = find_batch_size(overhead_encoder, dataset.to_iterable_dataset(), batch_sizes=(2, 8))
+    assert tuning.batch_size == 8
+
+
+def test_find_batch_size_wrong_input(dataset: Dataset):
+    """Test that invalid batch sizes and empty datasets raise an error."""
+    with pytest.raises(ValueError):
+        find_batch_size(overhead_encoder, dataset, batch_sizes=(0, 2))
+    with pytest.raises(ValueError):
+        find_batch_size(overhead_encoder, dataset.select([]))
@@ -13,12 +13,52 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import io
+import pickle
+from types import SimpleNamespace
 from typing import List
 
 import numpy as np
 import pytest
+from datasets import Sequence, Value
+from PIL import Image
+from transformers import BatchEncoding
 
-from document_tools.encoders.encoders import BaseEncoder
+from document_tools.encoders import TARGET_MODELS, TesseractOCR
+from document_tools.encoders.encoders import COMPACT_DTYPES, BaseEncoder, _get_processor, clear_processor_cache
+from document_tools.instrumentation import EncodingStats
+
+
+class CountingProcessor:
+    """Processor counting how many times it is loaded."""
+
+    loads = 0
+
+    def __init__(self, model: str, **config):
+        self.model = model
+        self.config = config
+
+    @classmethod
+    def from_pretrained(cls, model: str, **config):
+        cls.loads += 1
+        return cls(model, **config)
+
+
+class CountingEncoder(BaseEncoder):
+    processor_class = CountingProcessor  # type: ignore
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.default_model = "counting-model"
+        self.processor = self._load_processor()
+
+
+@pytest.fixture()
+def counting_processor():
+    clear_processor_cache()
+    CountingProcessor.loads = 0
+    yield CountingProcessor
+    clear_processor_cache()
 
 
 @pytest.fixture()
@@ -31,9 +71,207 @@ def test_base_encoder(get_labels: List[int]):
     assert encoder.labels == get_labels
     assert encoder.config == {"padding": "max_length", "truncation": True}
     assert encoder.features is None
+    assert encoder.processor is None
 
 
 def test_base_encoder_call(get_labels: List[int]):
     encoder = BaseEncoder(labels=get_labels)
     with pytest.raises(NotImplementedError):
         encoder({"image": [np.zeros((1, 1, 1, 1))]})
+
+
+def test_processor_registry(counting_processor):
+    """Test that processors are loaded once per model and configuration."""
+    first = _get_processor(counting_processor, "model", {"padding": "max_length"})
+    assert _get_processor(counting_processor, "model", {"padding": "max_length"}) is first
+    assert _get_processor(counting_processor, "other-model", {"padding": "max_length"}) is not first
+    assert _get_processor(counting_processor, "model", {"padding": False}) is not first
+    assert counting_processor.loads == 3
+
+    clear_processor_cache()
+    assert _get_processor(counting_processor, "model", {"padding": "max_length"}) is not first
+    assert counting_processor.loads == 4
+
+
+def test_encoders_share_processor(get_labels: List[int], counting_processor):
+    """Test that encoders with the same configuration share their processor, even after being pickled."""
+    encoder = CountingEncoder(labels=get_labels)
+    assert CountingEncoder(labels=get_labels).processor is encoder.processor
+
+    assert encoder.__getstate__()["processor"] is None
+    assert pickle.loads(pickle.dumps(encoder)).processor is encoder.processor
+    assert counting_processor.loads == 1
+
+
+def test_base_encoder_load_processor(get_labels: List[int]):
+    """Test that the base encoder has no processor to load."""
+    with pytest.raises(NotImplementedError):
+        BaseEncoder(labels=get_labels)._load_processor()
+
+
+def _storage_dtype(feature) -> str:
+    return feature.feature.dtype if isinstance(feature, Sequence) else feature.dtype
+
+
+def test_compact_features(get_labels: List[int], counting_processor, monkeypatch):
+    """Test that the encoders declare narrow dtypes for their integer features in compact mode."""
+    for encoder_class in TARGET_MODELS.values():
+        monkeypatch.setattr(encoder_class, "processor_class", counting_processor)
+        default_features = encoder_class(labels=get_labels).features
+        compact_features = encoder_class(labels=get_labels, compact=True).features
+        assert default_features is not None and compact_features is not None
+
+        for column in ("image", "input_ids", "attention_mask", "token_type_ids", "bbox"):
+            if column in compact_features:
+                assert _storage_dtype(default_features[column]) == "int64"
+                assert _storage_dtype(compact_features[column]) == COMPACT_DTYPES[column]
+        if "pixel_values" in compact_features:
+            assert _storage_dtype(compact_features["pixel_values"]) == "float32"
+
+
+class StubImageProcessor:
+    """Image processor returning one array per image."""
+
+    apply_ocr = True
+    ocr_lang = None
+    tesseract_config = ""
+
+    def __call__(self, images):
+        assert not self.apply_ocr
+        return {"pixel_values": [np.zeros((3, 2, 2), dtype=np.float32) for _ in images]}
+
+
+def test_encode_batch_records_stages(get_labels: List[int], monkeypatch):
+    """Test that each stage of the encoding is measured, with OCR run outside of the image processor."""
+    monkeypatch.setattr(
+        "document_tools.encoders.encoders.ocr_images",
+        lambda images, settings, cache: ([["word"]] * len(images), [[[0, 0, 1, 1]]] * len(images)),
+    )
+    stats = EncodingStats()
+    encoder = BaseEncoder(labels=get_labels, stats=stats)
+    encoder.processor = SimpleNamespace(
+        image_processor=StubImageProcessor(),
+        tokenizer=lambda text, boxes, **kwargs: {"input_ids": [[len(words)] for words in text]},
+    )
+
+    images = [Image.new("L", (4, 4)), Image.new("L", (4, 4))]
+    encoded = encoder._encode_batch({"image": images, "label": [[1], [2]]})
+    assert encoded["input_ids"] == [[1], [1]]
+    assert len(encoded["image"]) == 2
+    assert encoded["labels"] == [[1], [2]]
+    assert set(stats.stages) == {"convert", "ocr", "image_processing", "tokenization"}
+    assert all(stage.items == 2 for stage in stats.stages.values())
+    assert stats.stages["convert"].bytes == 2 * 4 * 4
+    assert stats.stages["ocr"].bytes == stats.stages["image_processing"].bytes == 2 * 4 * 4 * 3
+    assert encoder.processor.image_processor.apply_ocr
+
+    assert encoder.__getstate__()["stats"] is None
+
+
+def test_encode_batch_fast_image_processing(get_labels: List[int]):
+    """Test that the fast path computes the pixel values of undecoded images without converting them at full size."""
+    stats = EncodingStats()
+    encoder = BaseEncoder(labels=get_labels, stats=stats, fast_image_processing=True)
+    encoder.processor = SimpleNamespace(
+        image_processor=SimpleNamespace(size={"height": 2, "width": 2}, resample=Image.BILINEAR, apply_ocr=True),
+        tokenizer=lambda text, boxes, **kwargs: {"input_ids": [[len(words)] for words in text]},
+    )
+
+    output = io.BytesIO()
+    Image.new("RGB", (8, 8), "white").save(output, format="PNG")
+    batch = {
+        "image": [Image.new("L", (4, 4)), {"bytes": output.getvalue(), "path": None}],
+        "words": [["word"], []],
+        "boxes": [[[0, 0, 1, 1]], []],
+        "label": [[1], [2]],
+    }
+    encoded = encoder._encode_batch(batch)
+    assert encoded["input_ids"] == [[1], [0]]
+    assert encoded["image"].shape == (2, 3, 2, 2)
+    assert encoded["image"].dtype == np.uint8
+    assert encoded["image"][1].min() == 255
+    assert set(stats.stages) == {"image_processing", "tokenization"}
+    assert stats.stages["image_processing"].bytes == 4 * 4 + len(output.getvalue())
+
+
+def test_default_ocr_backend_is_cached(get_labels: List[int]):
+    """Test that the default Tesseract backend is built once, with the OCR settings of the processor."""
+    encoder = BaseEncoder(labels=get_labels)
+    encoder.processor = SimpleNamespace(image_processor=SimpleNamespace(ocr_lang="fra", tesseract_config=""))
+    backend = encoder.ocr_backend
+    assert isinstance(backend, TesseractOCR)
+    assert backend.ocr_lang == "fra" and backend.tesseract_config is None
+    assert encoder.ocr_backend is backend
+    assert encoder.__getstate__()["_default_ocr_backend"] is None
+
+
+def test_variable_length_features(get_labels: List[int], counting_processor, monkeypatch):
+    """Test that the encoders store the tokens without padding in variable length mode."""
+    for encoder_class in TARGET_MODELS.values():
+        monkeypatch.setattr(encoder_class, "processor_class", counting_processor)
+        encoder = encoder_class(labels=get_labels, variable_length=True)
+
+        assert encoder._tokenizer_kwargs["padding"] is False
+        assert encoder._tokenizer_kwargs["truncation"] is True
+        assert encoder.features is not None
+        assert encoder.features["bbox"] == Sequence(Sequence(Value(dtype="int64"), length=4))
+        assert encoder_class(labels=get_labels)._tokenizer_kwargs["padding"] == "max_length"
+
+
+def test_encode_batch_splits_windows(get_labels: List[int]):
+    """Test that the windows of the tokenizer get the pixel values, label and document id of their page."""
+
+    def tokenizer(text, boxes, **kwargs):
+        assert kwargs["return_overflowing_tokens"] and kwargs["stride"] == 1 and kwargs["truncation"]
+        pages = [page for page, words in enumerate(text) for _ in range(max(len(words) - 1, 1))]
+        return BatchEncoding({"input_ids": [[page] for page in pages], "overflow_to_sample_mapping": pages})
+
+    encoder = BaseEncoder(labels=get_labels, stride=1)
+    encoder.processor = SimpleNamespace(image_processor=StubImageProcessor(), tokenizer=tokenizer)
+    encoded = encoder._encode_batch(
+        {
+            "image": [Image.new("L", (4, 4))] * 3,
+            "words": [["a", "b", "c"], ["d"], ["e", "f"]],
+            "boxes": [[[0, 0, 1, 1]] * 3, [[0, 0, 1, 1]], [[0, 0, 1, 1]] * 2],
+            "label": [[1], [2], [3]],
+            "document_id": [7, 8, 9],
+        }
+    )
+    assert encoded["input_ids"] == [[0], [0], [1], [2]]
+    assert encoded["labels"] == [[1], [1], [2], [3]]
+    assert encoded["document_id"].tolist() == [7, 7, 8, 9]
+    assert encoded["window"].tolist() == [0, 1, 0, 0]
+    assert encoded["image"].shape == (4, 3, 2, 2)
+    assert "overflow_to_sample_mapping" not in encoded
+
+
+def test_unknown_labels(counting_processor, monkeypatch):
+    """Test that a label unknown to the encoder is reported before the labels are encoded."""
+    monkeypatch.setattr(TARGET_MODELS["layoutlmv2"], "processor_class", counting_processor)
+    encoder = TARGET_MODELS["layoutlmv2"](labels=["invoice", "receipt"])
+    encoder._check_labels([["invoice"], [1]])
+    with pytest.raises(ValueError, match="labels="):
+        encoder._check_labels([["invoice"], ["letter"]])
+
+
+class SingleCallProcessor:
+    """Processor applying OCR itself, recording the keyword arguments of its calls."""
+
+    def __init__(self):
+        self.image_processor = StubImageProcessor()
+        self.calls: List[dict] = []
+
+    def __call__(self, images, **kwargs):
+        self.calls.append(kwargs)
+        return BatchEncoding({"input_ids": [[1]] * len(images)})
+
+
+def test_encode_without_stats_calls_the_processor_once(get_labels: List[int]):
+    """Test that without stats the processor encodes the images in one call, with the padding of the configuration."""
+    encoder = BaseEncoder(labels=get_labels, config={"padding": "max_length", "truncation": True, "max_length": 8})
+    encoder.processor = SingleCallProcessor()
+
+    encoded = encoder._encode_batch({"image": [Image.new("L", (4, 4))], "label": [[1]]})
+    assert encoded["input_ids"] == [[1]]
+    assert encoded["labels"] == [[1]]
+    assert encoder.processor.calls == [{"padding": "max_length", "truncation": True, "max_length": 8}]
@@ -0,0 +1,94 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from dataclasses import asdict
+
+import pytest
+from PIL import Image
+
+from document_tools import bench
+
+
+def test_generate_documents_is_deterministic():
+    """Test that the same seed generates the same documents."""
+    first = bench.generate_documents(2, page_size=(120, 80), words_per_page=5, seed=1)
+    second = bench.generate_documents(2, page_size=(120, 80), words_per_page=5, seed=1)
+    assert first.column_names == ["image", "label"]
+    assert first[0]["image"].size == (120, 80)
+    assert first[0]["image"].tobytes() == second[0]["image"].tobytes()
+    assert first["label"] == second["label"]
+
+
+def test_synthetic_ocr():
+    """Test that the OCR stand-in is deterministic and returns more words for denser pages."""
+    sparse, dense = bench.generate_documents(2, page_size=(400, 400), words_per_page=5)["image"]
+    denser = bench.generate_documents(1, page_size=(400, 400), words_per_page=200)["image"][0]
+
+    words, boxes = bench.synthetic_ocr(sparse)
+    assert (words, boxes) == bench.synthetic_ocr(sparse.copy())
+    assert len(words) == len(boxes)
+    assert all(0 <= coordinate <= 1000 for box in boxes for coordinate in box)
+    assert len(bench.synthetic_ocr(denser)[0]) > len(words)
+    assert bench.synthetic_ocr(Image.new("RGB", (10, 10), "white")) == ([], [])
+
+
+def test_run_configuration(lightweight_target_model: str):
+    """Test that a configuration is measured with the OCR stand-in."""
+    config = bench.BenchmarkConfig(target_model=lightweight_target_model, batch_size=2, num_proc=None, num_pages=4)
+    result = bench.run_configuration(config)
+    assert result.config == config
+    assert result.seconds > 0
+    assert result.pages_per_second == 4 / result.seconds
+    assert result.peak_rss > 0
+    assert result.bytes_written > 0
+    assert result.stages["ocr"]["items"] == 4
+    assert result.stages["encode_map"]["items"] == 4
+
+
+def test_run_benchmark_reports_failed_configurations():
+    """Test that a configuration whose process fails raises an error instead of waiting for its result forever."""
+    config = bench.BenchmarkConfig(target_model="unknown-model", batch_size=2, num_proc=None, num_pages=1)
+    with pytest.raises(RuntimeError, match="exit code 1"):
+        bench.run_benchmark([config])
+
+
+def test_main_prints_json(monkeypatch, capsys, tmp_path, lightweight_target_model: str):
+    """Test that the command line runs the whole grid and prints the results as JSON."""
+    monkeypatch.setattr(
+        bench, "run_benchmark", lambda configs: [asdict(bench.run_configuration(config)) for config in configs]
+    )
+    output = tmp_path / "results.json"
+    bench.main(
+        [
+            "--target-models",
+            lightweight_target_model,
+            "--batch-sizes",
+            "1",
+            "4",
+            "--num-pages",
+            "4",
+            "--page-size",
+            "200",
+            "300",
+            "--output",
+            str(output),
+        ]
+    )
+    report = json.loads(capsys.readouterr().out)
+    assert report == json.loads(output.read_text())
+    assert "datasets" in report["environment"]
+    assert [result["config"]["batch_size"] for result in report["results"]] == [1, 4]
+    assert all(result["config"]["page_size"] == [200, 300] for result in report["results"])
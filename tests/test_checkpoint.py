@@ -0,0 +1,127 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+from pathlib import Path
+
+import pytest
+from datasets import Dataset, load_from_disk
+
+from document_tools import tokenize_dataset
+from document_tools.checkpoint import PROGRESS_FILE_NAME, SHARDS_DIR_NAME, ShardedOutput
+
+from .conftest import LightweightEncoder
+
+
+@pytest.fixture
+def dataset_on_disk(tmp_path: Path) -> Dataset:
+    """Dataset loaded from disk, whose fingerprint is the same in every run."""
+    images = [b"a" * length for length in range(1, 11)]
+    Dataset.from_dict({"image": images, "label": [[0]] * 10}).save_to_disk(str(tmp_path / "input"))
+    return load_from_disk(str(tmp_path / "input"))
+
+
+def _tokenize(dataset: Dataset, target_model: str, save_path: Path, **kwargs):
+    return tokenize_dataset(
+        dataset,
+        target_model=target_model,
+        batch_size=1,
+        labels=[0],
+        save_to_disk=True,
+        save_path=str(save_path),
+        output_shards=4,
+        **kwargs,
+    )
+
+
+def test_sharded_output(tmp_path: Path, dataset_on_disk: Dataset, lightweight_target_model: str):
+    """Test that each shard is written to the output, which can be loaded with `load_from_disk`."""
+    save_path = tmp_path / "encoded"
+    encoded = _tokenize(dataset_on_disk, lightweight_target_model, save_path, num_proc=2)
+
+    expected = [[length] for length in range(1, 11)]
+    assert encoded["train"]["input_ids"] == expected
+    assert load_from_disk(str(save_path))["train"]["input_ids"] == expected
+    progress = json.loads((save_path / PROGRESS_FILE_NAME).read_text())
+    assert sorted(progress["shards"]["train"]) == [0, 1, 2, 3]
+    assert progress["complete"]
+    assert not (save_path / SHARDS_DIR_NAME).exists()
+
+    calls = LightweightEncoder.calls
+    assert _tokenize(dataset_on_disk, lightweight_target_model, save_path)["train"]["input_ids"] == expected
+    assert LightweightEncoder.calls == calls
+
+
+def test_sharded_output_resumes(monkeypatch, tmp_path: Path, dataset_on_disk: Dataset, lightweight_target_model: str):
+    """Test that an interrupted run resumes from the last finished shard."""
+    original_call = LightweightEncoder.__call__
+
+    def crashing_call(self, batch):
+        if len(batch["image"][0]) == 7:
+            raise RuntimeError("Interrupted")
+        return original_call(self, batch)
+
+    save_path = tmp_path / "encoded"
+    monkeypatch.setattr(LightweightEncoder, "__call__", crashing_call)
+    with pytest.raises(RuntimeError):
+        _tokenize(dataset_on_disk, lightweight_target_model, save_path)
+    assert LightweightEncoder.calls == 6
+
+    monkeypatch.setattr(LightweightEncoder, "__call__", original_call)
+    encoded = _tokenize(dataset_on_disk, lightweight_target_model, save_path)
+    assert LightweightEncoder.calls == 6 + 4
+    assert encoded["train"]["input_ids"] == [[length] for length in range(1, 11)]
+
+
+def test_sharded_output_with_another_dataset(tmp_path: Path, dataset_on_disk: Dataset, lightweight_target_model: str):
+    """Test that the shards of another dataset are not resumed."""
+    save_path = tmp_path / "encoded"
+    _tokenize(dataset_on_disk, lightweight_target_model, save_path)
+    encoded = _tokenize(dataset_on_disk.select(range(3)), lightweight_target_model, save_path)
+    assert encoded["train"]["input_ids"] == [[1], [2], [3]]
+    assert LightweightEncoder.calls == 13
+
+
+def test_sharded_output_with_other_labels(tmp_path: Path, dataset_on_disk: Dataset, lightweight_target_model: str):
+    """Test that the shards encoded with other labels are not resumed."""
+    save_path = tmp_path / "encoded"
+    _tokenize(dataset_on_disk, lightweight_target_model, save_path)
+    calls = LightweightEncoder.calls
+    tokenize_dataset(
+        dataset_on_disk,
+        target_model=lightweight_target_model,
+        batch_size=1,
+        labels=[0, 1],
+        save_to_disk=True,
+        save_path=str(save_path),
+        output_shards=4,
+    )
+    assert LightweightEncoder.calls == calls + 10
+
+
+def test_sharded_output_raises_write_errors(tmp_path: Path, dataset_on_disk: Dataset, lightweight_target_model: str):
+    """Test that an error while writing the output is raised."""
+    save_path = tmp_path / "file"
+    save_path.write_text("not a directory")
+    with pytest.raises(OSError):
+        _tokenize(dataset_on_disk, lightweight_target_model, save_path)
+
+
+def test_sharded_output_arguments(tmp_path: Path, dataset_on_disk: Dataset, lightweight_target_model: str):
+    """Test that the sharded output needs to save to disk, and a positive number of shards."""
+    with pytest.raises(ValueError):
+        tokenize_dataset(dataset_on_disk, target_model=lightweight_target_model, output_shards=2)
+    with pytest.raises(ValueError):
+        ShardedOutput(str(tmp_path), 0, "key")
@@ -0,0 +1,132 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+import pytest
+from datasets import Array2D, Array3D, Dataset, Features, Sequence, Value
+
+from document_tools.collate import LengthBucketSampler, PaddingCollator, sequence_lengths, widen_batch
+
+
+@pytest.fixture
+def variable_length_dataset() -> Dataset:
+    """Dataset encoded with variable length rows and compact dtypes."""
+    features = Features(
+        {
+            "input_ids": Sequence(Value(dtype="int32")),
+            "attention_mask": Sequence(Value(dtype="int8")),
+            "bbox": Sequence(Sequence(Value(dtype="int16"), length=4)),
+            "pixel_values": Array3D(dtype="float32", shape=(3, 2, 2)),
+            "labels": Sequence(Value(dtype="int32")),
+        }
+    )
+    lengths = [3, 1, 5, 0]
+    rows = {
+        "input_ids": [list(range(2, 2 + length)) for length in lengths],
+        "attention_mask": [[1] * length for length in lengths],
+        "bbox": [[[index, index, 10, 10] for index in range(length)] for length in lengths],
+        "pixel_values": [np.ones((3, 2, 2), dtype=np.float32)] * len(lengths),
+        "labels": [[index] for index in range(len(lengths))],
+    }
+    return Dataset.from_dict(rows, features=features)
+
+
+def test_widen_batch_with_compact_dataset():
+    """Test that a batch loaded from a dataset with compact dtypes is widened to int64."""
+    features = Features(
+        {
+            "image": Array3D(dtype="uint8", shape=(3, 2, 2)),
+            "input_ids": Sequence(Value(dtype="int32")),
+            "attention_mask": Sequence(Value(dtype="int8")),
+            "bbox": Array2D(dtype="int16", shape=(2, 4)),
+            "pixel_values": Array3D(dtype="float32", shape=(3, 2, 2)),
+        }
+    )
+    rows = {
+        "image": [np.full((3, 2, 2), 255, dtype=np.uint8)] * 2,
+        "input_ids": [[250_000, 1], [3]],
+        "attention_mask": [[1, 1], [1]],
+        "bbox": [[[0, 0, 1000, 1000]] * 2] * 2,
+        "pixel_values": [np.zeros((3, 2, 2), dtype=np.float32)] * 2,
+    }
+    batch = Dataset.from_dict(rows, features=features).with_format("numpy")[:2]
+    widened = widen_batch(batch)
+
+    assert widened["image"].dtype == np.int64 and widened["image"].max() == 255
+    assert widened["bbox"].dtype == np.int64 and widened["bbox"].max() == 1000
+    assert [ids.dtype for ids in widened["input_ids"]] == [np.int64, np.int64]
+    assert widened["input_ids"][0].tolist() == [250_000, 1]
+    assert [mask.dtype for mask in widened["attention_mask"]] == [np.int64, np.int64]
+    assert widened["pixel_values"].dtype == np.float32
+
+
+def test_widen_batch_leaves_other_values():
+    """Test that the values that are not integer arrays are left untouched."""
+    batch = {"words": ["hello"], "scores": np.array([0.5], dtype=np.float16), "ids": [np.array([1], dtype=np.int8)]}
+    widened = widen_batch(batch)
+    assert widened["words"] == ["hello"]
+    assert widened["scores"].dtype == np.float16
+    assert widened["ids"][0].dtype == np.int64
+
+
+@pytest.mark.parametrize("as_lists", [False, True])
+def test_padding_collator(variable_length_dataset: Dataset, as_lists: bool):
+    """Test that the rows are padded on the right to the longest row of the batch, from arrays or lists."""
+    rows = list(variable_length_dataset.with_format("numpy"))
+    if as_lists:
+        rows = [{column: np.asarray(value).tolist() for column, value in row.items()} for row in rows]
+    batch = PaddingCollator(pad_token_id=1)(rows[:2])
+
+    assert batch["input_ids"].tolist() == [[2, 3, 4], [2, 1, 1]]
+    assert batch["attention_mask"].tolist() == [[1, 1, 1], [1, 0, 0]]
+    assert batch["bbox"].shape == (2, 3, 4)
+    assert batch["bbox"][1].tolist() == [[0, 0, 10, 10], [0, 0, 0, 0], [0, 0, 0, 0]]
+    assert batch["pixel_values"].shape == (2, 3, 2, 2)
+    assert batch["labels"].tolist() == [[0], [1]]
+    assert all(batch[column].dtype == np.int64 for column in ("input_ids", "attention_mask", "bbox", "labels"))
+
+    batch = PaddingCollator(pad_to_multiple_of=4)(rows)
+    assert batch["input_ids"].shape == (4, 8)
+    assert batch["bbox"][3].tolist() == [[0, 0, 0, 0]] * 8
+
+
+def test_sequence_lengths(variable_length_dataset: Dataset):
+    """Test that the lengths are read in the order of the rows, after a selection."""
+    assert sequence_lengths(variable_length_dataset).tolist() == [3, 1, 5, 0]
+    assert sequence_lengths(variable_length_dataset.select([2, 0]), chunk_size=1).tolist() == [5, 3]
+
+
+def test_length_bucket_sampler():
+    """Test that each row is sampled once per epoch, in batches of rows of close lengths."""
+    lengths = np.random.default_rng(0).integers(1, 512, size=103)
+    sampler = LengthBucketSampler(lengths, batch_size=4, bucket_size=5)
+    batches = list(sampler)
+
+    assert len(batches) == len(sampler) == 26
+    assert sorted(index for batch in batches for index in batch) == list(range(103))
+    assert all(lengths[batch].tolist() == sorted(lengths[batch].tolist()) for batch in batches)
+    padding = sum(len(batch) * lengths[batch].max() - lengths[batch].sum() for batch in batches)
+    assert padding < sum(len(batch) * 511 for batch in batches) / 10
+
+    assert list(sampler) == batches
+    sampler.set_epoch(1)
+    assert list(sampler) != batches
+
+    sampler = LengthBucketSampler(lengths, batch_size=4, bucket_size=5, drop_last=True)
+    assert len(list(sampler)) == len(sampler) == 25
+    assert all(len(batch) == 4 for batch in sampler)
+
+    with pytest.raises(ValueError):
+        LengthBucketSampler(lengths, batch_size=0)
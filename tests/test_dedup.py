@@ -0,0 +1,133 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import random
+
+import pytest
+from datasets import Dataset, DatasetDict, Features, Image, Sequence, Value
+from PIL import Image as PILImage
+from PIL import ImageDraw
+
+from document_tools.bench import generate_documents
+from document_tools.dedup import (
+    NEAR_DUPLICATE_DISTANCE,
+    Deduplication,
+    PerceptualIndex,
+    find_duplicates,
+    perceptual_hash,
+)
+from document_tools.instrumentation import EncodingStats
+
+
+def _distance(first: int, second: int) -> int:
+    return bin(first ^ second).count("1")
+
+
+def _jpeg(image: PILImage.Image) -> PILImage.Image:
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=75)
+    return PILImage.open(io.BytesIO(output.getvalue()))
+
+
+def test_perceptual_hash():
+    """Test that a re-encoded page is a near duplicate of the original, and that different pages are not."""
+    pages = generate_documents(4)["image"]
+    hashes = [perceptual_hash(page) for page in pages]
+    assert all(
+        _distance(perceptual_hash(_jpeg(page)), value) <= NEAR_DUPLICATE_DISTANCE for page, value in zip(pages, hashes)
+    )
+    assert all(_distance(hashes[0], value) > 2 * NEAR_DUPLICATE_DISTANCE for value in hashes[1:])
+
+
+def test_perceptual_index_matches_brute_force():
+    """Test that the index finds the same near duplicates as comparing all the hashes."""
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(256) for _ in range(50)]
+    index = PerceptualIndex(max_distance=8)
+    for row, value in enumerate(hashes):
+        index.add(value, row)
+    assert len(index) == 50
+
+    for _ in range(200):
+        value = rng.choice(hashes)
+        for bit in rng.sample(range(256), rng.randrange(0, 12)):
+            value ^= 1 << bit
+        expected = [row for row, other in enumerate(hashes) if _distance(value, other) <= 8]
+        assert index.find(value) == (expected[0] if expected else None)
+
+    with pytest.raises(ValueError):
+        PerceptualIndex(max_distance=256)
+
+
+def test_find_duplicates():
+    """Test that the exact and near duplicates with the same label point to their first row."""
+    exact_hashes = ["a", "b", "a", "c", "a", "d"]
+    perceptual_hashes = ["f0", "ff", "f0", "f1", "f0", None]
+    labels = [[0], [0], [0], [0], [1], [0]]
+    assert find_duplicates(exact_hashes, perceptual_hashes, labels, max_distance=1) == [0, 1, 0, 0, 4, 5]
+    assert find_duplicates(exact_hashes, perceptual_hashes, labels) == [0, 1, 0, 3, 4, 5]
+
+    def confirm(row, previous_row):
+        return (row, previous_row) != (3, 0)
+
+    representatives = find_duplicates(exact_hashes, perceptual_hashes, labels, max_distance=1, confirm=confirm)
+    assert representatives == [0, 1, 0, 3, 4, 5]
+
+
+def test_deduplication_fans_out_the_unique_rows():
+    """Test that only the unique pages are selected, and that the duplicates get the row of their first page."""
+    pages = generate_documents(2)["image"]
+    images = [pages[0], pages[1], _jpeg(pages[0]), pages[0], pages[1]]
+    features = Features({"image": Image(), "label": Sequence(Value(dtype="int64"))})
+    dataset = DatasetDict(
+        {"train": Dataset.from_dict({"image": images, "label": [[0], [0], [0], [0], [1]]}, features=features)}
+    )
+    stats = EncodingStats()
+    deduplication = Deduplication(max_distance=NEAR_DUPLICATE_DISTANCE, stats=stats)
+    unique = deduplication.select_unique_rows(dataset, "image", "label")
+    assert len(unique["train"]) == 3
+    assert deduplication.num_skipped == 2
+    assert stats.summary()["dedup_skipped"]["items"] == 2
+
+    encoded = DatasetDict({"train": Dataset.from_dict({"row": [0, 1, 4]})})
+    assert deduplication.fan_out(encoded)["train"]["row"] == [0, 1, 0, 0, 4]
+
+    with pytest.raises(ValueError):
+        deduplication.select_unique_rows(dataset["train"], "image", "label")
+
+
+def test_filled_forms_are_not_near_duplicates():
+    """Test that a form filled from a template is not merged with it, even though their perceptual hashes are close."""
+    template = generate_documents(1)["image"][0]
+    filled = template.copy()
+    ImageDraw.Draw(filled).text((100, 100), "Jonathan Smith 12/04", fill="black")
+    assert _distance(perceptual_hash(template), perceptual_hash(filled)) <= NEAR_DUPLICATE_DISTANCE
+
+    features = Features({"image": Image(), "label": Sequence(Value(dtype="int64"))})
+    dataset = DatasetDict(
+        {
+            "train": Dataset.from_dict(
+                {"image": [template, filled, _jpeg(template)], "label": [[0]] * 3}, features=features
+            )
+        }
+    )
+    exact = Deduplication()
+    exact.select_unique_rows(dataset, "image", "label")
+    assert exact.representatives["train"] == [0, 1, 2]
+
+    near = Deduplication(max_distance=NEAR_DUPLICATE_DISTANCE)
+    near.select_unique_rows(dataset, "image", "label")
+    assert near.representatives["train"] == [0, 1, 0]
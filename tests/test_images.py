@@ -0,0 +1,78 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+from transformers import LayoutLMv2ImageProcessor, LayoutLMv3ImageProcessor
+
+from document_tools.encoders.images import batch_pixel_values, reduce_image
+
+
+def _image(width: int, height: int, mode: str = "RGB") -> Image.Image:
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels).convert(mode)
+
+
+def _jpeg_bytes(image: Image.Image) -> bytes:
+    output = io.BytesIO()
+    image.save(output, format="JPEG")
+    return output.getvalue()
+
+
+@pytest.mark.parametrize(
+    "image_processor, flip_channel_order",
+    [(LayoutLMv2ImageProcessor(apply_ocr=False), True), (LayoutLMv3ImageProcessor(apply_ocr=False), False)],
+)
+def test_batch_pixel_values_matches_image_processor(image_processor, flip_channel_order: bool):
+    """
+    Test that the pixel values are the ones of the image processor when the images are not reduced.
+    """
+    images = [_image(300, 400), _image(224, 224), _image(400, 300, mode="L"), _image(300, 300, mode="P")]
+    expected = np.stack(image_processor(images=[image.convert("RGB") for image in images])["pixel_values"])
+
+    pixel_values = batch_pixel_values(images, image_processor, flip_channel_order)
+    assert pixel_values.shape == expected.shape == (4, 3, 224, 224)
+    assert pixel_values.dtype == expected.dtype
+    np.testing.assert_allclose(pixel_values, expected, atol=1e-6)
+
+
+def test_batch_pixel_values_reduces_large_images():
+    """
+    Test that large images, decoded or not, are reduced to pixel values close to the ones of the image processor.
+    """
+    image_processor = LayoutLMv3ImageProcessor(apply_ocr=False)
+    scan = Image.fromarray(np.kron(np.asarray(_image(85, 110)), np.ones((30, 30, 1), dtype=np.uint8)))
+    expected = np.stack(image_processor(images=[scan])["pixel_values"])
+
+    encoded = {"bytes": _jpeg_bytes(scan), "path": None}
+    pixel_values = batch_pixel_values([scan, encoded], image_processor)
+    assert pixel_values.shape == (2, 3, 224, 224)
+    assert np.abs(pixel_values - expected).mean() < 0.05
+
+
+def test_reduce_image_drafts_jpeg():
+    """
+    Test that JPEG images that are not decoded yet are decoded at a reduced scale.
+    """
+    image = Image.open(io.BytesIO(_jpeg_bytes(_image(2000, 2000))))
+    reduced = reduce_image(image, (224, 224))
+
+    assert reduced.size == (224, 224)
+    assert reduced.mode == "RGB"
+    assert image.size == (500, 500)
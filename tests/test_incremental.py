@@ -0,0 +1,113 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pathlib import Path
+from typing import List
+
+import pytest
+from datasets import Dataset, DatasetDict, load_from_disk
+
+from document_tools import tokenize_dataset
+from document_tools.incremental import MANIFEST_FILE_NAME, load_incremental, plan_split, row_fingerprints
+
+from .conftest import LightweightEncoder
+
+
+def _dataset(images: List[bytes], labels: List[int]) -> DatasetDict:
+    return DatasetDict({"train": Dataset.from_dict({"image": images, "label": [[label] for label in labels]})})
+
+
+def _tokenize(dataset: DatasetDict, target_model: str, save_path: Path, **kwargs) -> DatasetDict:
+    return tokenize_dataset(
+        dataset,
+        target_model=target_model,
+        batch_size=1,
+        labels=[0, 1],
+        save_to_disk=True,
+        save_path=str(save_path),
+        incremental=True,
+        **kwargs,
+    )
+
+
+def test_plan_split():
+    """Test that the rows are matched by fingerprint, and that the merged rows keep the order of the input."""
+    plan = plan_split(["c", "x", "a", "y"], ["a", "b", "c"])
+    assert plan.new_rows == [1, 3]
+    assert plan.reused_rows == [2, 0]
+    assert plan.order == [0, 2, 1, 3]
+
+
+def test_row_fingerprints():
+    """Test that the fingerprints change with the image and with the label."""
+    dataset = _dataset([b"a", b"a", b"b", b"a"], [0, 0, 0, 1])["train"]
+    fingerprints = row_fingerprints(dataset, "image", "label", chunk_size=3)
+    assert fingerprints[0] == fingerprints[1]
+    assert len(set(fingerprints)) == 3
+
+
+def test_incremental_encoding(tmp_path: Path, lightweight_target_model: str):
+    """Test that only the added and modified rows are encoded, and merged with the rows encoded by the previous run."""
+    save_path = tmp_path / "encoded"
+    _tokenize(_dataset([b"a", b"bb", b"ccc"], [0, 1, 0]), lightweight_target_model, save_path)
+    assert LightweightEncoder.calls == 3
+    assert (save_path / MANIFEST_FILE_NAME).is_file()
+
+    encoded = _tokenize(_dataset([b"a", b"bb", b"ccc"], [0, 1, 0]), lightweight_target_model, save_path)
+    assert LightweightEncoder.calls == 3
+    assert encoded["train"]["input_ids"] == [[1], [2], [3]]
+
+    assert sorted(path.name for path in save_path.glob("part-*")) == ["part-00000"]
+
+    encoded = _tokenize(_dataset([b"ccc", b"bbbb", b"a", b"eeeee"], [0, 1, 0, 1]), lightweight_target_model, save_path)
+    assert LightweightEncoder.calls == 5
+    assert encoded["train"]["input_ids"] == [[3], [4], [1], [5]]
+    assert encoded["train"]["labels"] == [[0], [1], [0], [1]]
+    # Only the new rows are written, next to the rows of the first run which stay in place.
+    assert load_from_disk(str(save_path / "part-00001"))["train"]["input_ids"] == [[4], [5]]
+    assert load_incremental(str(save_path))["train"]["input_ids"] == [[3], [4], [1], [5]]
+
+    # Once most of the stored rows are unused, the used rows are compacted into the new part.
+    encoded = _tokenize(_dataset([b"eeeee", b"ffffff"], [1, 0]), lightweight_target_model, save_path)
+    assert LightweightEncoder.calls == 6
+    assert encoded["train"]["input_ids"] == [[5], [6]]
+    assert sorted(path.name for path in save_path.glob("part-*")) == ["part-00002"]
+    assert load_incremental(str(save_path))["train"]["input_ids"] == [[5], [6]]
+
+
+def test_incremental_encoding_keeps_the_previous_output(tmp_path: Path, lightweight_target_model: str):
+    """Test that a part left by an interrupted run is not used, and is removed by the next run."""
+    save_path = tmp_path / "encoded"
+    _tokenize(_dataset([b"a", b"bb"], [0, 1]), lightweight_target_model, save_path)
+    (save_path / "part-00001.tmp").mkdir()
+    assert load_incremental(str(save_path))["train"]["input_ids"] == [[1], [2]]
+
+    encoded = _tokenize(_dataset([b"a", b"bb", b"ccc"], [0, 1, 0]), lightweight_target_model, save_path)
+    assert encoded["train"]["input_ids"] == [[1], [2], [3]]
+    assert sorted(path.name for path in save_path.glob("part-*")) == ["part-00000", "part-00002"]
+
+
+def test_incremental_encoding_with_new_configuration(tmp_path: Path, lightweight_target_model: str):
+    """Test that all the rows are encoded again when the encoder configuration changes."""
+    save_path = tmp_path / "encoded"
+    _tokenize(_dataset([b"a", b"bb"], [0, 1]), lightweight_target_model, save_path)
+    _tokenize(_dataset([b"a", b"bb"], [0, 1]), lightweight_target_model, save_path, processor_config={"x": 1})
+    assert LightweightEncoder.calls == 4
+
+
+def test_incremental_encoding_requires_saving(lightweight_target_model: str):
+    """Test that the incremental mode can't be used without saving to disk."""
+    with pytest.raises(ValueError):
+        tokenize_dataset(_dataset([b"a"], [0]), target_model=lightweight_target_model, incremental=True)
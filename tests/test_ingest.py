@@ -0,0 +1,128 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from document_tools import ingest_directory
+from document_tools.ingest import find_documents
+
+
+@pytest.fixture
+def documents_directory(tmp_path: Path) -> Path:
+    """Directory of images in two label folders, with a file that isn't a document and a corrupt image."""
+    directory = tmp_path / "documents"
+    for label, color in [("invoice", "red"), ("letter", "blue")]:
+        (directory / label).mkdir(parents=True)
+        Image.new("RGB", (400, 200), color).save(directory / label / "large.jpg")
+        Image.new("RGB", (20, 10), color).save(directory / label / "small.PNG")
+    (directory / "letter" / "notes.txt").write_text("not a document")
+    (directory / "letter" / "corrupt.png").write_bytes(b"not an image")
+    return directory
+
+
+def test_find_documents(documents_directory: Path):
+    """
+    Test that the documents are found recursively, by extension, in a stable order.
+    """
+    paths = find_documents(documents_directory)
+    assert [path.relative_to(documents_directory).as_posix() for path in paths] == [
+        "invoice/large.jpg",
+        "invoice/small.PNG",
+        "letter/corrupt.png",
+        "letter/large.jpg",
+        "letter/small.PNG",
+    ]
+
+
+def test_ingest_directory(documents_directory: Path, tmp_path: Path):
+    """
+    Test that the images are shrunk and labelled by folder, and that the corrupt image is skipped.
+    """
+    dataset = ingest_directory(documents_directory, cache_file_name=str(tmp_path / "ingest.arrow"), max_size=(100, 100))
+
+    assert dataset.column_names == ["image", "label"]
+    assert dataset.features["label"].feature.names == ["invoice", "letter"]
+    assert dataset["label"] == [[0], [0], [1], [1]]
+    assert [image.size for image in dataset["image"]] == [(100, 50), (20, 10), (100, 50), (20, 10)]
+    assert dataset[0]["image"].format == "JPEG"
+
+    small = documents_directory / "invoice" / "small.PNG"
+    assert dataset.with_format("arrow")[1]["image"][0]["bytes"].as_py() == small.read_bytes()
+
+
+def test_ingest_directory_in_processes(documents_directory: Path, tmp_path: Path):
+    """
+    Test that the pages are written in the same order when they are decoded in a pool of processes.
+    """
+    sequential = ingest_directory(documents_directory, cache_file_name=str(tmp_path / "sequential.arrow"))
+    parallel = ingest_directory(documents_directory, cache_file_name=str(tmp_path / "parallel.arrow"), num_proc=2)
+
+    assert parallel["label"] == sequential["label"]
+    assert parallel.with_format("arrow")["image"] == sequential.with_format("arrow")["image"]
+
+
+def test_ingest_directory_cache(documents_directory: Path, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """
+    Test that the default cache file is reused, and replaced when a document changes.
+    """
+    monkeypatch.setattr("datasets.config.HF_DATASETS_CACHE", str(tmp_path / "cache"))
+    dataset = ingest_directory(documents_directory, label_fn=lambda path: path.suffix.lower())
+    assert dataset.features["label"].feature.names == [".jpg", ".png"]
+    assert ingest_directory(documents_directory, label_fn=lambda path: path.suffix.lower()).cache_files == (
+        dataset.cache_files
+    )
+
+    Image.new("RGB", (30, 30), "green").save(documents_directory / "invoice" / "new.png")
+    updated = ingest_directory(documents_directory, label_fn=lambda path: path.suffix.lower())
+    assert updated.cache_files != dataset.cache_files
+    assert len(updated) == len(dataset) + 1
+
+
+def test_ingest_directory_pdf(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, caplog: pytest.LogCaptureFixture):
+    """
+    Test that each page of the pdf documents is rendered at the resolution of OCR then shrunk, with the document opened
+    once, and that a corrupt pdf document is skipped.
+    """
+    pdfium = pytest.importorskip("pypdfium2")
+    (tmp_path / "report").mkdir()
+    pdf = pdfium.PdfDocument.new()
+    for width, height in [(612, 792), (144, 144)]:
+        pdf.new_page(width, height)
+    pdf.save(str(tmp_path / "report" / "document.pdf"))
+    pdf.close()
+    (tmp_path / "report" / "corrupt.pdf").write_bytes(b"not a pdf")
+
+    opened = []
+    pdf_document = pdfium.PdfDocument
+
+    def counting_pdf_document(path):
+        opened.append(path)
+        return pdf_document(path)
+
+    monkeypatch.setattr(pdfium, "PdfDocument", counting_pdf_document)
+    dataset = ingest_directory(tmp_path / "report", cache_file_name=str(tmp_path / "ingest.arrow"), max_size=(300, 300))
+
+    assert dataset["label"] == [[0], [0]]
+    assert [image.size for image in dataset["image"]] == [(232, 300), (300, 300)]
+    assert sorted(Path(path).name for path in opened) == ["corrupt.pdf", "document.pdf"]
+    assert "Skipping" in caplog.text and "corrupt.pdf" in caplog.text
+
+    in_processes = ingest_directory(
+        tmp_path / "report", cache_file_name=str(tmp_path / "processes.arrow"), max_size=(300, 300), num_proc=2
+    )
+    assert [image.size for image in in_processes["image"]] == [(232, 300), (300, 300)]
@@ -0,0 +1,109 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import pickle
+
+from document_tools.instrumentation import STATS_DIR_ENV, EncodingStats, StageStats, collect_stats
+
+
+def test_record_and_summary():
+    """Test that the measurements of a stage are summed, and summarized with their throughput and share."""
+    stats = EncodingStats()
+    stats.record("ocr", 3.0, items=6)
+    stats.record("ocr", 1.0, items=2)
+    stats.record("tokenization", 4.0, items=8, nbytes=100)
+    stats.record("encode_map", 10.0, items=8)
+
+    assert stats.stages["ocr"] == StageStats(seconds=4.0, items=8, bytes=0, calls=2)
+    summary = stats.summary()
+    assert summary["ocr"]["items_per_second"] == 2.0
+    assert summary["ocr"]["share"] == 0.5
+    assert summary["tokenization"]["bytes"] == 100
+    assert "share" not in summary["encode_map"]
+
+
+def test_measure():
+    """Test that a block is measured, even when it raises."""
+    stats = EncodingStats()
+    with stats.measure("convert", items=2):
+        pass
+    try:
+        with stats.measure("convert", items=2):
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert stats.stages["convert"].calls == 2
+    assert stats.stages["convert"].items == 4
+    assert stats.stages["convert"].seconds >= 0
+
+
+def test_collect_stats():
+    """Test that the stats flushed by each worker are merged, and that the environment is restored."""
+    stats = EncodingStats()
+    with collect_stats(stats) as process_stats:
+        assert process_stats is not None
+        process_stats.record("ocr", 1.0, items=1)
+        process_stats.flush()
+        process_stats.record("ocr", 1.0, items=1)
+        process_stats.flush()
+
+        worker_stats = EncodingStats.from_environment()
+        assert worker_stats is not None
+        worker_stats.record("ocr", 2.0, items=3)
+        worker_stats.flush()
+
+    assert stats.stages["ocr"] == StageStats(seconds=4.0, items=5, bytes=0, calls=3)
+    assert STATS_DIR_ENV not in os.environ
+    assert EncodingStats.from_environment() is None
+
+
+def test_worker_utilization(monkeypatch):
+    """Test that the time of each worker process of a map stage is compared with the busiest one of its split."""
+    stats = EncodingStats()
+    for split, times in (("train", {1: [1.0], 2: [2.0, 2.0]}), ("test", {1: [3.0], 3: [6.0]})):
+        with collect_stats(stats, "encode_map", split):
+            for pid, seconds in [(pid, seconds) for pid, all_seconds in times.items() for seconds in all_seconds]:
+                monkeypatch.setattr(os, "getpid", lambda: pid)
+                worker_stats = EncodingStats.from_environment()
+                assert worker_stats is not None
+                worker_stats.record("tokenization", seconds)
+                worker_stats.record("convert", seconds)
+                worker_stats.flush()
+
+    assert stats.worker_utilization("encode_map") == {
+        "encode_map/train/1": 0.25,
+        "encode_map/train/2": 1.0,
+        "encode_map/test/1": 0.5,
+        "encode_map/test/3": 1.0,
+    }
+    assert stats.worker_utilization("ocr_map") == {}
+
+
+def test_collect_without_stats():
+    """Test that nothing is collected without stats."""
+    with collect_stats(None) as process_stats:
+        assert process_stats is None
+    assert STATS_DIR_ENV not in os.environ
+
+
+def test_pickled_stats_do_not_flush():
+    """Test that unpickled stats keep their stages but are not written to the directory of the parent process."""
+    with collect_stats(EncodingStats()) as process_stats:
+        assert process_stats is not None
+        process_stats.record("ocr", 1.0)
+        unpickled = pickle.loads(pickle.dumps(process_stats))
+    assert unpickled.stages == process_stats.stages
+    assert unpickled._stats_dir is None
@@ -0,0 +1,206 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List, Optional
+
+import pytest
+from PIL import Image
+
+from document_tools.encoders import OCRCache
+from document_tools.encoders import ocr as ocr_module
+from document_tools.encoders.encoders import BaseEncoder
+from document_tools.encoders.ocr import CallableOCR, OCRStage, PrecomputedOCR, TesseractOCR, ocr_images
+
+
+@pytest.fixture
+def images():
+    return [Image.new("RGB", (32, 16), color) for color in ("white", "black", "red")]
+
+
+@pytest.fixture
+def counting_tesseract(monkeypatch):
+    """Replace Tesseract by a deterministic OCR counting its calls."""
+    calls: List[Image.Image] = []
+
+    def fake_tesseract(image, ocr_lang=None, tesseract_config=None):
+        calls.append(image)
+        return [f"{image.getpixel((0, 0))}"], [[0, 0, 1000, 1000]]
+
+    monkeypatch.setattr(ocr_module, "apply_tesseract", fake_tesseract)
+    return calls
+
+
+def _encoder_with_cache(cache: Optional[OCRCache], ocr_lang=None) -> BaseEncoder:
+    encoder = BaseEncoder(labels=[0], ocr_cache=cache)
+    encoder.processor = SimpleNamespace(image_processor=SimpleNamespace(ocr_lang=ocr_lang, tesseract_config=""))
+    return encoder
+
+
+def test_ocr_cache_get_and_set(tmp_path: Path):
+    """Test that the cached results are returned and persisted on disk."""
+    cache = OCRCache(tmp_path)
+    assert cache.get("missing") is None
+    cache.set("key", ["hello", "world"], [[1, 2, 3, 4], [5, 6, 7, 8]])
+    assert cache.get("key") == (["hello", "world"], [[1, 2, 3, 4], [5, 6, 7, 8]])
+    assert len(cache) == 1
+
+    reopened = OCRCache(tmp_path)
+    assert reopened.get("key") == (["hello", "world"], [[1, 2, 3, 4], [5, 6, 7, 8]])
+
+
+def test_ocr_cache_key(images: List[Image.Image]):
+    """Test that the key depends on the image content and on the OCR settings."""
+    settings = {"ocr_lang": None, "tesseract_config": None}
+    assert OCRCache.key(images[0], settings) == OCRCache.key(images[0].copy(), settings)
+    assert OCRCache.key(images[0], settings) != OCRCache.key(images[1], settings)
+    assert OCRCache.key(images[0], settings) != OCRCache.key(images[0], {**settings, "ocr_lang": "fra"})
+
+
+def test_ocr_cache_lru_eviction(tmp_path: Path):
+    """Test that the least recently used results are evicted when the cache is too large."""
+    entry_size = len('[["word"], [[0, 0, 0, 0]]]')
+    cache = OCRCache(tmp_path, max_size=2 * entry_size)
+    cache.set("first", ["word"], [[0, 0, 0, 0]])
+    cache.set("second", ["word"], [[0, 0, 0, 0]])
+    cache.get("first")
+    cache.set("third", ["word"], [[0, 0, 0, 0]])
+
+    assert cache.get("second") is None
+    assert cache.get("first") is not None
+    assert cache.get("third") is not None
+    assert cache.size == 2 * entry_size
+
+
+def test_ocr_cache_evicts_in_batches(monkeypatch, tmp_path: Path):
+    """Test that the oldest entries are evicted a batch at a time until a large result fits."""
+    monkeypatch.setattr(ocr_module, "EVICTION_BATCH_SIZE", 2)
+    entry_size = len('[["word"], [[0, 0, 0, 0]]]')
+    cache = OCRCache(tmp_path, max_size=10 * entry_size)
+    for index in range(10):
+        cache.set(str(index), ["word"], [[0, 0, 0, 0]])
+    cache.get("0")
+    cache.set("large", ["word" * 10], [[0, 0, 0, 0]])
+
+    assert cache.size <= 10 * entry_size
+    assert cache.get("0") is not None
+    assert [cache.get(str(index)) is None for index in range(1, 10)] == [True] * 3 + [False] * 6
+
+
+def test_ocr_cache_wrong_size(tmp_path: Path):
+    """Test that the cache refuses a size that is not positive."""
+    with pytest.raises(ValueError):
+        OCRCache(tmp_path, max_size=0)
+
+
+def test_ocr_cache_pickle(tmp_path: Path):
+    """Test that the cache can be pickled to be sent to `num_proc` workers."""
+    cache = OCRCache(tmp_path)
+    cache.set("key", ["word"], [[0, 0, 0, 0]])
+    assert pickle.loads(pickle.dumps(cache)).get("key") == (["word"], [[0, 0, 0, 0]])
+
+
+def test_encoder_ocr_uses_cache(tmp_path: Path, images: List[Image.Image], counting_tesseract: List[Image.Image]):
+    """Test that a second run over the same images, with another encoder, does not apply OCR again."""
+    encoder = _encoder_with_cache(OCRCache(tmp_path))
+    words, boxes = ocr_images(images, encoder.ocr_settings, encoder.ocr_cache)
+    assert len(counting_tesseract) == 3
+
+    encoder = _encoder_with_cache(OCRCache(tmp_path))
+    assert ocr_images(images, encoder.ocr_settings, encoder.ocr_cache) == (words, boxes)
+    assert len(counting_tesseract) == 3
+
+    encoder = _encoder_with_cache(OCRCache(tmp_path), ocr_lang="fra")
+    ocr_images(images, encoder.ocr_settings, encoder.ocr_cache)
+    assert len(counting_tesseract) == 6
+
+
+def test_ocr_stage(tmp_path: Path, images: List[Image.Image], counting_tesseract: List[Image.Image]):
+    """Test that the OCR stage returns the words and boxes columns, and uses the OCR cache."""
+    ocr_stage = OCRStage(
+        {"ocr_lang": None, "tesseract_config": None}, image_column="page", ocr_cache=OCRCache(tmp_path)
+    )
+    output = ocr_stage({"page": images})
+    assert output == {
+        "words": [["(255, 255, 255)"], ["(0, 0, 0)"], ["(255, 0, 0)"]],
+        "boxes": [[[0, 0, 1000, 1000]]] * 3,
+    }
+
+    pickle.loads(pickle.dumps(ocr_stage))({"page": images})
+    assert len(counting_tesseract) == 3
+
+
+def test_ocr_images_batches_cache_misses(tmp_path: Path, images: List[Image.Image]):
+    """Test that the images missed by the cache are sent to the backend in a single batch, in order."""
+    batches: List[int] = []
+
+    def batched_ocr(batch):
+        batches.append(len(batch))
+        return [[f"{image.getpixel((0, 0))}"] for image in batch], [[[0, 0, 1, 1]]] * len(batch)
+
+    backend = CallableOCR(batched_ocr, name="batched", batched=True)
+    cache = OCRCache(tmp_path)
+    assert ocr_images(images[1:], backend, cache)[0] == [["(0, 0, 0)"], ["(255, 0, 0)"]]
+    words, boxes = ocr_images(images, backend, cache)
+    assert words == [["(255, 255, 255)"], ["(0, 0, 0)"], ["(255, 0, 0)"]]
+    assert boxes == [[[0, 0, 1, 1]]] * 3
+    assert batches == [2, 1]
+
+    ocr_images(images, CallableOCR(batched_ocr, name="another engine", batched=True), cache)
+    assert batches == [2, 1, 3]
+
+
+def test_tesseract_backend(images: List[Image.Image], counting_tesseract: List[Image.Image]):
+    """Test that the default backend of the encoders is Tesseract with the OCR settings of the processor."""
+    encoder = _encoder_with_cache(None, ocr_lang="fra")
+    assert isinstance(encoder.ocr_backend, TesseractOCR)
+    assert encoder.ocr_backend.settings == encoder.ocr_settings == {"ocr_lang": "fra", "tesseract_config": None}
+    assert encoder.ocr_backend(images)[0] == [["(255, 255, 255)"], ["(0, 0, 0)"], ["(255, 0, 0)"]]
+    assert len(counting_tesseract) == 3
+
+    with TesseractOCR(num_proc=2) as backend:
+        backend._pool = ProcessPoolExecutor(1)
+        assert pickle.loads(pickle.dumps(backend))._pool is None
+    assert backend._pool is None
+
+
+def test_tesseract_backend_in_daemonic_process(
+    images: List[Image.Image], counting_tesseract: List[Image.Image], monkeypatch
+):
+    """Test that the backend applies Tesseract serially in daemonic processes, which can't start a pool."""
+    monkeypatch.setattr(ocr_module.multiprocessing, "current_process", lambda: SimpleNamespace(daemon=True))
+    backend = TesseractOCR(num_proc=2)
+    assert backend(images)[0] == [["(255, 255, 255)"], ["(0, 0, 0)"], ["(255, 0, 0)"]]
+    assert len(counting_tesseract) == 3
+    assert backend._pool is None
+
+
+def test_precomputed_backend(images: List[Image.Image], counting_tesseract: List[Image.Image]):
+    """Test that the encoders tokenize the words and boxes of the columns of a precomputed backend."""
+    encoder = BaseEncoder(labels=[0], ocr_backend=PrecomputedOCR("text", "layout"))
+    encoder.processor = SimpleNamespace(
+        image_processor=SimpleNamespace(size={"height": 2, "width": 2}, resample=Image.BILINEAR),
+        tokenizer=lambda text, boxes, **kwargs: {"input_ids": [[len(words)] for words in text]},
+    )
+    encoder.fast_image_processing = True
+    batch = {"image": images, "label": [[0]] * 3, "text": [["a"], ["b", "c"], []], "layout": [[[0, 0, 1, 1]]] * 3}
+    assert encoder._encode_batch(batch)["input_ids"] == [[1], [2], [0]]
+    assert len(counting_tesseract) == 0
+
+    with pytest.raises(ValueError):
+        encoder._encode_batch({"image": images, "label": [[0]] * 3})
@@ -0,0 +1,128 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+import threading
+from pathlib import Path
+from types import SimpleNamespace
+from typing import List
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from document_tools.documents import ImageDocument
+from document_tools.encoders import CallableOCR
+from document_tools.encoders.encoders import BaseEncoder
+from document_tools.serving import EncodingService
+
+
+class RecordingTokenizer:
+    """Tokenizer returning one token per word, recording the size of each batch and waiting to be released."""
+
+    pad_token_id = 1
+
+    def __init__(self):
+        self.batch_sizes: List[int] = []
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, text, boxes, **kwargs):
+        self.entered.set()
+        self.release.wait()
+        self.batch_sizes.append(len(text))
+        return {"input_ids": [[7] * len(words) for words in text], "bbox": boxes}
+
+
+def _pixel_ocr(image: Image.Image):
+    """OCR recognizing one word per 8 pixels of width, and failing on black images."""
+    if image.getpixel((0, 0)) == (0, 0, 0):
+        raise ValueError("unreadable")
+    num_words = image.width // 8
+    return ["word"] * num_words, [[0, 0, 1, 1]] * num_words
+
+
+@pytest.fixture
+def encoder() -> BaseEncoder:
+    encoder = BaseEncoder(labels=[], ocr_backend=CallableOCR(_pixel_ocr, name="pixel"))
+    encoder.processor = SimpleNamespace(
+        image_processor=SimpleNamespace(size={"height": 2, "width": 2}, resample=Image.BILINEAR),
+        tokenizer=RecordingTokenizer(),
+    )
+    encoder.fast_image_processing = True
+    return encoder
+
+
+def test_concurrent_requests_are_batched(encoder: BaseEncoder):
+    """Test that the requests queued while a batch is encoded are encoded together, each with its own tensors."""
+    service = EncodingService(encoder, max_batch_size=4, max_wait=0)
+    tokenizer = encoder.processor.tokenizer
+    tokenizer.release.clear()
+    futures = [service.submit(Image.new("RGB", (8, 8), "white"))]
+    assert tokenizer.entered.wait(10)
+    futures += [service.submit(Image.new("RGB", (8 * (index + 1), 8), "white")) for index in range(1, 5)]
+    tokenizer.release.set()
+
+    results = [future.result(timeout=10) for future in futures]
+    service.close()
+    assert tokenizer.batch_sizes == [1, 4]
+    assert [result["input_ids"].shape for result in results] == [(1, index + 1) for index in range(5)]
+    assert results[2]["bbox"].shape == (1, 3, 4)
+    assert results[0]["image"].shape == (1, 3, 2, 2)
+    assert "labels" not in results[0]
+
+
+def test_encode_and_encode_async(encoder: BaseEncoder, tmp_path: Path):
+    """Test that the sync and async APIs encode image documents and PIL images."""
+    path = tmp_path / "page.png"
+    Image.new("RGB", (16, 8), "white").save(path)
+
+    with EncodingService(encoder, max_batch_size=8, max_wait=0.2) as service:
+        assert service.encode(ImageDocument(path), timeout=10)["input_ids"].tolist() == [[7, 7]]
+
+        async def encode_all():
+            images = [Image.new("RGB", (8 * (index + 1), 8), "white") for index in range(3)]
+            return await asyncio.gather(*(service.encode_async(image) for image in images))
+
+        results = asyncio.run(encode_all())
+    assert [result["input_ids"].shape[1] for result in results] == [1, 2, 3]
+    assert encoder.processor.tokenizer.batch_sizes == [1, 3]
+
+    with pytest.raises(RuntimeError):
+        service.encode(Image.new("RGB", (8, 8), "white"))
+
+
+def test_failing_document_does_not_fail_its_batch(encoder: BaseEncoder):
+    """Test that the error of a document is raised to its caller only, the other documents of its batch are encoded."""
+    service = EncodingService(encoder, max_batch_size=4, max_wait=0)
+    tokenizer = encoder.processor.tokenizer
+    tokenizer.release.clear()
+    blocking = service.submit(Image.new("RGB", (8, 8), "white"))
+    assert tokenizer.entered.wait(10)
+    futures = [service.submit(Image.new("RGB", (8, 8), color)) for color in ("white", "black", "white")]
+    tokenizer.release.set()
+
+    blocking.result(timeout=10)
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=10)
+    assert np.array_equal(futures[0].result(timeout=10)["input_ids"], [[7]])
+    assert np.array_equal(futures[2].result(timeout=10)["input_ids"], [[7]])
+    service.close()
+
+    with pytest.raises(ValueError):
+        EncodingService(encoder, max_batch_size=0)
+    with pytest.raises(TypeError):
+        EncodingService(encoder).encode("page.png", timeout=10)
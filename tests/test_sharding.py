@@ -0,0 +1,149 @@
+# coding=utf-8
+#
+# Copyright The deeptools.ai team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import multiprocessing
+import shutil
+from pathlib import Path
+from typing import List
+
+import pytest
+from datasets import Dataset, DatasetDict, Features, Image
+
+from document_tools import EncodingStats, merge_shards, tokenize_dataset
+from document_tools.sharding import SHARD_FILE_NAME, assign_shards, estimate_page_costs, schedule_workers
+
+SIZES = [50, 3, 20, 20, 7, 41, 1, 12, 30, 9]
+
+
+def _dataset(sizes: List[int] = SIZES) -> DatasetDict:
+    images = [bytes(size) for size in sizes]
+    return DatasetDict({"train": Dataset.from_dict({"image": images, "label": [[i % 2] for i in range(len(sizes))]})})
+
+
+def _encode_shard(save_path: str, shard_index: int, sizes: List[int] = SIZES):
+    tokenize_dataset(
+        _dataset(sizes),
+        target_model="layoutlmv2",
+        labels=[0, 1],
+        save_to_disk=True,
+        save_path=save_path,
+        num_shards=3,
+        shard_index=shard_index,
+    )
+
+
+def test_assign_shards():
+    """Test that the shards have about the same cost, and that the assignment is deterministic."""
+    assignment = assign_shards(SIZES, 3)
+    loads = [sum(cost for cost, shard in zip(SIZES, assignment) if shard == index) for index in range(3)]
+    assert max(loads) - min(loads) <= 3
+    assert assign_shards(SIZES, 3) == assignment
+    assert assign_shards([1, 1, 1, 1], 2) == [0, 1, 0, 1]
+    assert assign_shards([5, 4, 3, 2], 2, capacities=[3, 1]) == [0, 1, 0, 0]
+
+
+def test_schedule_workers():
+    """Test that each contiguous chunk of the order holds rows of about the same cost as the other chunks."""
+    schedule = schedule_workers([100, 100, 100, 1, 1, 1, 1, 1, 1], 3)
+    assert schedule.contiguous_loads == [300, 3, 3]
+    assert schedule.loads == [102, 102, 102]
+    assert schedule.utilization == 1.0
+    assert schedule.contiguous_utilization < 0.4
+    assert [len({0, 1, 2} & set(schedule.order[start : start + 3])) for start in (0, 3, 6)] == [1, 1, 1]
+    assert sorted(schedule.order) == list(range(9))
+    assert schedule_workers([1, 2], 4).loads == [2, 1]
+
+
+def test_estimate_page_costs(tmp_path: Path):
+    """Test that the costs are the sizes of the stored images, or of their files."""
+    (tmp_path / "page.png").write_bytes(bytes(30))
+    images = [{"bytes": bytes(10), "path": None}, {"bytes": None, "path": str(tmp_path / "page.png")}]
+    dataset = Dataset.from_dict({"image": images}, features=Features({"image": Image()}))
+    assert estimate_page_costs(dataset, "image", chunk_size=1) == [10, 30]
+    assert estimate_page_costs(Dataset.from_dict({"image": [b"", b"ab"]}), "image") == [1, 2]
+
+
+def test_shards_are_encoded_in_processes_and_merged(tmp_path: Path, lightweight_target_model: str):
+    """Test that the shards encoded by separate processes merge into the rows of the dataset, in their order."""
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_encode_shard, args=(str(tmp_path), index)) for index in range(3)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+
+    manifests = [json.loads(path.read_text()) for path in sorted(tmp_path.glob(f"shard-*/{SHARD_FILE_NAME}"))]
+    assert [manifest["shard_index"] for manifest in manifests] == [0, 1, 2]
+    assert sum(manifest["splits"]["train"]["cost"] for manifest in manifests) == sum(SIZES)
+
+    merged = merge_shards(str(tmp_path))
+    assert merged["train"]["input_ids"] == [[size] for size in SIZES]
+    assert merged["train"]["labels"] == [[i % 2] for i in range(len(SIZES))]
+
+    shutil.rmtree(tmp_path / "shard-00002-of-00003")
+    with pytest.raises(ValueError):
+        merge_shards(str(tmp_path))
+
+    # A shard of another dataset with as many rows is not merged with the others.
+    _encode_shard(str(tmp_path), 2, sizes=SIZES[::-1])
+    with pytest.raises(ValueError, match="different datasets"):
+        merge_shards(str(tmp_path))
+
+
+def test_shard_save_errors_are_raised(monkeypatch, tmp_path: Path, lightweight_target_model: str):
+    """Test that a shard that can't be saved raises, and has no `shard.json` file to be merged with the others."""
+
+    def failing_save(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(DatasetDict, "save_to_disk", failing_save)
+    with pytest.raises(OSError, match="No space left"):
+        _encode_shard(str(tmp_path), 0)
+    assert not list(tmp_path.glob(f"**/{SHARD_FILE_NAME}"))
+
+
+def test_shard_arguments(lightweight_target_model: str):
+    """Test that a shard needs both its index and the number of shards, and is saved to disk."""
+    with pytest.raises(ValueError):
+        tokenize_dataset(_dataset(), target_model="layoutlmv2", save_to_disk=True, save_path="path", num_shards=2)
+    with pytest.raises(ValueError):
+        tokenize_dataset(_dataset(), target_model="layoutlmv2", num_shards=2, shard_index=0)
+    with pytest.raises(ValueError):
+        tokenize_dataset(
+            _dataset(), target_model="layoutlmv2", save_to_disk=True, save_path="path", num_shards=2, shard_index=2
+        )
+
+
+def test_balanced_workers_keep_the_order(lightweight_target_model: str):
+    """Test that the rows encoded by balanced workers come back in their order, and that each worker is measured."""
+    stats = EncodingStats()
+    encoded = tokenize_dataset(
+        _dataset(), target_model="layoutlmv2", labels=[0, 1], num_proc=2, balance_workers=True, stats=stats
+    )
+    assert encoded["train"]["input_ids"] == [[size] for size in SIZES]
+    assert len(stats.worker_utilization("encode_map")) == 2
+    assert max(stats.worker_utilization("encode_map").values()) == 1.0
+    assert all(worker.startswith("encode_map/train/") for worker in stats.worker_utilization("encode_map"))
+
+    # The workers of another call replace those of the previous one instead of being added to them.
+    tokenize_dataset(
+        _dataset(), target_model="layoutlmv2", labels=[0, 1], num_proc=2, balance_workers=True, stats=stats
+    )
+    assert len(stats.worker_utilization("encode_map")) == 2
+
+    with pytest.raises(ValueError):
+        tokenize_dataset(_dataset(), target_model="layoutlmv2", num_proc=2, balance_workers=True, stride=16)
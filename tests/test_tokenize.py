@@ -13,14 +13,35 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Any, List
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import pandas as pd
 import pytest
-from datasets import DatasetDict, load_dataset
-
-from document_tools import TARGET_MODELS, tokenize_dataset
+from datasets import (
+    Dataset,
+    DatasetDict,
+    Features,
+    Image,
+    IterableDataset,
+    IterableDatasetDict,
+    Sequence,
+    Value,
+    load_dataset,
+    load_from_disk,
+)
+from PIL import Image as PILImage
+
+from document_tools import TARGET_MODELS, EncodingStats, tokenize_dataset
+from document_tools.bench import generate_documents
+from document_tools.encoders import CallableOCR, PrecomputedOCR
+from document_tools.encoders import ocr as ocr_module
+from document_tools.utils import _current_rss
+
+from .conftest import LightweightEncoder
 
 
 @pytest.fixture
@@ -36,6 +57,38 @@ def incorrect_dataset_format():
     ]
 
 
+def _build_dataset_on_disk(path: Path, num_rows: int, row_size: int) -> Dataset:
+    """Build a memory-mapped dataset of `num_rows` rows of `row_size` random bytes each."""
+    rng = np.random.default_rng(0)
+    dataset = Dataset.from_dict(
+        {"image": [rng.bytes(row_size) for _ in range(num_rows)], "label": [[i % 3] for i in range(num_rows)]}
+    )
+    dataset.save_to_disk(str(path))
+    return load_from_disk(str(path))
+
+
+@pytest.fixture
+def image_dataset():
+    """Return a small dataset of PIL images."""
+    images = [PILImage.new("RGB", (8 * (i + 1), 8), "white") for i in range(4)]
+    features = Features({"image": Image(), "label": Sequence(Value(dtype="int64"))})
+    return Dataset.from_dict({"image": images, "label": [[i % 2] for i in range(4)]}, features=features)
+
+
+@pytest.fixture
+def counting_tesseract(monkeypatch):
+    """Replace Tesseract by a deterministic OCR returning one word per 8 pixels of width, and count its calls."""
+    calls = []
+
+    def fake_tesseract(image, ocr_lang=None, tesseract_config=None):
+        calls.append(image.size)
+        num_words = image.size[0] // 8
+        return ["word"] * num_words, [[0, 0, 10, 10]] * num_words
+
+    monkeypatch.setattr(ocr_module, "apply_tesseract", fake_tesseract)
+    return calls
+
+
 @pytest.fixture
 def dataset_for_testing():
     """Return a dataset for testing."""
@@ -190,3 +243,336 @@ def test_layout_xlm(dataset_for_testing: DatasetDict):
     assert len(tmp_train["labels"][0]) == 1
     assert tmp_train["labels"][1] == [6]
     assert len(tmp_train["labels"][1]) == 1
+
+
+def test_input_dataset_is_not_copied(monkeypatch, lightweight_target_model: str):
+    """Test that the splits handed to `map` are the input datasets themselves and that the input is not mutated."""
+    dataset_dict = DatasetDict({"train": Dataset.from_dict({"image": [b"a", b"bb"], "label": [[0], [1]]})})
+    mapped_splits = {}
+    original_map = DatasetDict.map
+
+    def spy_map(self, *args, **kwargs):
+        mapped_splits.update(self)
+        return original_map(self, *args, **kwargs)
+
+    monkeypatch.setattr(DatasetDict, "map", spy_map)
+    encoded = tokenize_dataset(dataset_dict, target_model=lightweight_target_model)
+
+    assert mapped_splits["train"] is dataset_dict["train"]
+    assert list(dataset_dict.keys()) == ["train"]
+    assert dataset_dict["train"].column_names == ["image", "label"]
+    assert encoded["train"]["input_ids"] == [[1], [2]]
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="RSS is read from /proc")
+def test_memory_does_not_grow_with_dataset_size_before_map(monkeypatch, tmp_path: Path, lightweight_target_model: str):
+    """Test that the resident memory used before `map` starts does not depend on the size of the dataset."""
+    rss_growth = {}
+    original_map = DatasetDict.map
+
+    def measuring_map(self, *args, **kwargs):
+        rss_growth[len(self["train"])] = _current_rss() - rss_before
+        return original_map(self, *args, **kwargs)
+
+    monkeypatch.setattr(DatasetDict, "map", measuring_map)
+    row_size = 256 * 1024
+    for num_rows in (4, 512):
+        dataset = _build_dataset_on_disk(tmp_path / str(num_rows), num_rows, row_size)
+        rss_before = _current_rss()
+        tokenize_dataset(DatasetDict({"train": dataset}), target_model=lightweight_target_model, keep_in_memory=True)
+
+    # The large dataset weighs 128MB, copying it would show up far above this margin.
+    assert rss_growth[512] - rss_growth[4] < 16 * 1024 * 1024
+
+
+def test_separate_ocr_stage(
+    tmp_path: Path, image_dataset: Dataset, counting_tesseract: List[Any], lightweight_target_model: str
+):
+    """Test that the OCR stage feeds the words to the encoder, and that it is cached on its own."""
+    ocr_cache_file_names: Dict[str, Optional[str]] = {"train": str(tmp_path / "ocr.arrow")}
+    encoded = tokenize_dataset(
+        image_dataset,
+        target_model=lightweight_target_model,
+        separate_ocr=True,
+        ocr_batch_size=3,
+        ocr_cache_file_names=ocr_cache_file_names,
+    )
+    assert encoded["train"]["input_ids"] == [[1], [2], [3], [4]]
+    assert encoded["train"].column_names == ["input_ids", "labels"]
+    assert len(counting_tesseract) == 4
+    assert (tmp_path / "ocr.arrow").exists()
+
+    tokenize_dataset(
+        image_dataset,
+        target_model=lightweight_target_model,
+        separate_ocr=True,
+        ocr_batch_size=3,
+        ocr_cache_file_names=ocr_cache_file_names,
+    )
+    assert len(counting_tesseract) == 4
+
+    # Columns of the dataset that happen to be named like the OCR results don't replace the OCR stage.
+    stale_dataset = image_dataset.add_column("words", [["stale"]] * 4).add_column("boxes", [[[0, 0, 1, 1]]] * 4)
+    encoded = tokenize_dataset(stale_dataset, target_model=lightweight_target_model, separate_ocr=True)
+    assert encoded["train"]["input_ids"] == [[1], [2], [3], [4]]
+    assert len(counting_tesseract) == 8
+
+
+def test_iterable_dataset_is_encoded_lazily(lightweight_target_model: str):
+    """Test that iterable datasets are encoded while they are iterated, with labels discovered in a bounded pre-pass."""
+    dataset = Dataset.from_dict({"image": [b"a", b"bb", b"ccc"], "label": [[0], [2], [5]]}).to_iterable_dataset()
+    encoded = tokenize_dataset(dataset, target_model=lightweight_target_model, label_discovery_rows=2)
+
+    assert isinstance(encoded, IterableDatasetDict)
+    assert LightweightEncoder.calls == 0
+    assert list(encoded["train"]) == [
+        {"input_ids": [1], "labels": [0]},
+        {"input_ids": [2], "labels": [2]},
+        {"input_ids": [3], "labels": [5]},
+    ]
+    assert LightweightEncoder.calls == 2
+
+
+def test_iterable_dataset_with_labels(monkeypatch, lightweight_target_model: str):
+    """Test that the labels supplied up front are used without reading the dataset."""
+
+    def rows():
+        raise AssertionError("The dataset must not be read before being encoded.")
+        yield
+
+    captured = {}
+    original_init = LightweightEncoder.__init__
+
+    def capturing_init(self, **kwargs):
+        captured.update(kwargs)
+        original_init(self, **kwargs)
+
+    monkeypatch.setattr(LightweightEncoder, "__init__", capturing_init)
+    dataset = IterableDataset.from_generator(rows)
+    tokenize_dataset(IterableDatasetDict({"test": dataset}), target_model=lightweight_target_model, labels=[0, 1])
+    assert captured["labels"] == [0, 1]
+
+
+def test_iterable_dataset_cannot_be_saved(lightweight_target_model: str):
+    """Test that saving an iterable dataset to disk raises an error."""
+    dataset = Dataset.from_dict({"image": [b"a"], "label": [[0]]}).to_iterable_dataset()
+    with pytest.raises(ValueError):
+        tokenize_dataset(dataset, target_model=lightweight_target_model, save_to_disk=True, save_path="path")
+
+
+def test_auto_batch_size(monkeypatch, caplog, lightweight_target_model: str):
+    """Test that the automatic batch size is measured, logged and used to encode the dataset."""
+    dataset = Dataset.from_dict({"image": [b"a"] * 100, "label": [[0]] * 100})
+    map_arguments = {}
+    original_map = DatasetDict.map
+
+    def spy_map(self, *args, **kwargs):
+        map_arguments.update(kwargs)
+        return original_map(self, *args, **kwargs)
+
+    monkeypatch.setattr(DatasetDict, "map", spy_map)
+    with caplog.at_level("INFO"):
+        encoded = tokenize_dataset(dataset, target_model=lightweight_target_model, batch_size="auto")
+
+    assert len(encoded["train"]) == 100
+    assert map_arguments["batch_size"] in (1, 2, 4, 8, 16, 32, 64)
+    assert map_arguments["writer_batch_size"] % map_arguments["batch_size"] == 0
+    assert "Chose a batch size of" in caplog.text
+
+
+def test_wrong_batch_size(lightweight_target_model: str):
+    """Test that the function raises an error when the batch size is a string other than 'auto'."""
+    dataset = Dataset.from_dict({"image": [b"a"], "label": [[0]]})
+    with pytest.raises(ValueError):
+        tokenize_dataset(dataset, target_model=lightweight_target_model, batch_size="fast")
+
+
+def test_stats_are_collected_from_workers(tmp_path: Path, caplog, lightweight_target_model: str):
+    """Test that the stats of the encoders of all the workers are gathered, with the stats of the map itself."""
+    dataset = Dataset.from_dict({"image": [b"a"] * 10, "label": [[0]] * 10})
+    stats = EncodingStats()
+    with caplog.at_level("INFO"):
+        tokenize_dataset(
+            dataset,
+            target_model=lightweight_target_model,
+            num_proc=2,
+            cache_file_names={"train": str(tmp_path / "encoded.arrow")},
+            stats=stats,
+        )
+
+    assert stats.stages["tokenization"].items == 10
+    assert stats.stages["tokenization"].calls == 6  # two shards of 5 rows, in batches of 2
+    assert stats.stages["encode_map"].items == 10
+    assert stats.stages["encode_map"].bytes > 0
+    assert "Encoding stats" in caplog.text
+
+
+def test_stats_do_not_change_the_cache(tmp_path: Path, lightweight_target_model: str):
+    """Test that measuring the encoding reuses the results cached by a run without stats."""
+    dataset = Dataset.from_dict({"image": [b"a"] * 4, "label": [[0]] * 4})
+    cache_file_names: Dict[str, Optional[str]] = {"train": str(tmp_path / "encoded.arrow")}
+    tokenize_dataset(dataset, target_model=lightweight_target_model, cache_file_names=cache_file_names)
+    calls = LightweightEncoder.calls
+
+    stats = EncodingStats()
+    tokenize_dataset(dataset, target_model=lightweight_target_model, cache_file_names=cache_file_names, stats=stats)
+    assert LightweightEncoder.calls == calls
+    assert "tokenization" not in stats.stages
+
+
+class WindowingEncoder(LightweightEncoder):
+    """Lightweight encoder emitting one window per byte of each image, with the back-reference to its page."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._add_window_features()
+
+    def __call__(self, batch):
+        pages = [page for page, image in enumerate(batch["image"]) for _ in image]
+        return {
+            "input_ids": [[len(batch["image"][page])] for page in pages],
+            "labels": [batch["label"][page] for page in pages],
+            "document_id": [batch["document_id"][page] for page in pages],
+            "window": [pages[:index].count(page) for index, page in enumerate(pages)],
+        }
+
+
+def test_windows_reference_their_page(monkeypatch):
+    """Test that the windows of each page reference its index in the split, and that all input columns are removed."""
+    monkeypatch.setitem(TARGET_MODELS, "layoutlmv2", WindowingEncoder)
+    dataset = Dataset.from_dict({"image": [b"a", b"bb", b"ccc"], "label": [[0], [1], [2]], "page": [1, 2, 3]})
+
+    encoded = tokenize_dataset(dataset, target_model="layoutlmv2", stride=0, batch_size=2)["train"]
+    assert encoded.column_names == ["input_ids", "labels", "document_id", "window"]
+    assert encoded["document_id"] == [0, 1, 1, 2, 2, 2]
+    assert encoded["window"] == [0, 0, 1, 0, 1, 2]
+    assert encoded["labels"] == [[0], [1], [1], [2], [2], [2]]
+
+    with_ids = dataset.add_column("document_id", [10, 20, 30])
+    encoded = tokenize_dataset(with_ids.to_iterable_dataset(), target_model="layoutlmv2", stride=0, labels=[0, 1, 2])
+    assert [row["document_id"] for row in encoded["train"]] == [10, 20, 20, 30, 30, 30]
+
+    encoded = tokenize_dataset(dataset.to_iterable_dataset(), target_model="layoutlmv2", stride=0, labels=[0, 1, 2])
+    assert [row["document_id"] for row in encoded["train"]] == [0, 1, 1, 2, 2, 2]
+
+    with pytest.raises(ValueError):
+        tokenize_dataset(dataset, target_model="layoutlmv2", stride=-1)
+
+
+class SizedEncoder(LightweightEncoder):
+    """Lightweight encoder with the input image size of its image processor, recording the size of its images."""
+
+    sizes: List[Any] = []
+    ocr_lang: Optional[str] = None
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.processor = SimpleNamespace(
+            image_processor=SimpleNamespace(
+                ocr_lang=self.ocr_lang, tesseract_config="", size={"height": 2, "width": 4}, resample=PILImage.BILINEAR
+            )
+        )
+
+    def __call__(self, batch):
+        SizedEncoder.sizes.extend(image.size for image in batch["image"])
+        return super().__call__(batch)
+
+
+def test_multiple_target_models_share_ocr(
+    monkeypatch, tmp_path: Path, image_dataset: Dataset, counting_tesseract: List[Any]
+):
+    """Test that OCR runs once on the full images for all the target models, which receive the resized images."""
+    monkeypatch.setitem(TARGET_MODELS, "layoutlmv2", SizedEncoder)
+    monkeypatch.setitem(TARGET_MODELS, "layoutlmv3", SizedEncoder)
+    monkeypatch.setattr(SizedEncoder, "sizes", [])
+
+    encoded = tokenize_dataset(
+        image_dataset, target_model=["layoutlmv2", "layoutlmv3"], save_to_disk=True, save_path=str(tmp_path)
+    )
+    assert list(encoded) == ["layoutlmv2", "layoutlmv3"]
+    for target_model in encoded:
+        assert encoded[target_model]["train"]["input_ids"] == [[1], [2], [3], [4]]
+        assert encoded[target_model]["train"].column_names == ["input_ids", "labels"]
+        assert load_from_disk(str(tmp_path / target_model))["train"]["labels"] == [[0], [1], [0], [1]]
+    assert counting_tesseract == [(8, 8), (16, 8), (24, 8), (32, 8)]
+    assert SizedEncoder.sizes == [(4, 2)] * 8
+
+    class OtherLanguageEncoder(SizedEncoder):
+        ocr_lang = "fra"
+
+    monkeypatch.setitem(TARGET_MODELS, "layoutxlm", OtherLanguageEncoder)
+    with pytest.raises(ValueError):
+        tokenize_dataset(image_dataset, target_model=["layoutlmv2", "layoutxlm"])
+    with pytest.raises(KeyError):
+        tokenize_dataset(image_dataset, target_model=["layoutlmv2", "layoutlmv4"])
+    with pytest.raises(ValueError, match="incremental"):
+        tokenize_dataset(
+            image_dataset,
+            target_model=["layoutlmv2", "layoutlmv3"],
+            save_to_disk=True,
+            save_path=str(tmp_path),
+            incremental=True,
+        )
+
+
+def test_multiple_target_models_raise_shard_save_errors(
+    monkeypatch, tmp_path: Path, image_dataset: Dataset, counting_tesseract: List[Any]
+):
+    """Test that the shard of a target model that can't be saved raises, and has no `shard.json` file."""
+    monkeypatch.setitem(TARGET_MODELS, "layoutlmv2", SizedEncoder)
+    monkeypatch.setitem(TARGET_MODELS, "layoutlmv3", SizedEncoder)
+
+    def failing_save(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(DatasetDict, "save_to_disk", failing_save)
+    with pytest.raises(OSError, match="No space left"):
+        tokenize_dataset(
+            image_dataset,
+            target_model=["layoutlmv2", "layoutlmv3"],
+            save_to_disk=True,
+            save_path=str(tmp_path),
+            num_shards=2,
+            shard_index=0,
+        )
+    assert not list(tmp_path.glob("**/shard.json"))
+
+
+def test_ocr_backend(image_dataset: Dataset, counting_tesseract: List[Any], lightweight_target_model: str):
+    """Test that the OCR stage runs the given backend, and that a precomputed backend skips it."""
+    backend = CallableOCR(
+        lambda images: ([["word"] * 2 for _ in images], [[[0, 0, 1, 1]] * 2 for _ in images]), batched=True
+    )
+    encoded = tokenize_dataset(
+        image_dataset, target_model=lightweight_target_model, separate_ocr=True, ocr_backend=backend
+    )
+    assert encoded["train"]["input_ids"] == [[2]] * 4
+
+    dataset = image_dataset.add_column("words", [["word"]] * 4).add_column("boxes", [[[0, 0, 1, 1]]] * 4)
+    encoded = tokenize_dataset(dataset, target_model=lightweight_target_model, ocr_backend=PrecomputedOCR())
+    assert encoded["train"]["input_ids"] == [[1]] * 4
+    assert encoded["train"].column_names == ["input_ids", "labels"]
+    assert counting_tesseract == []
+
+
+def test_deduplicate(counting_tesseract: List[Any], lightweight_target_model: str):
+    """Test that the duplicate pages with the same label are encoded once, and get the encoded row of their page."""
+    first, second = [
+        generate_documents(1, page_size=size, seed=seed)["image"][0]
+        for size, seed in [((136, 128), 0), ((272, 128), 1)]
+    ]
+    features = Features({"image": Image(), "label": Sequence(Value(dtype="int64"))})
+    dataset = Dataset.from_dict(
+        {"image": [first, second, first, second], "label": [[0], [0], [0], [1]]}, features=features
+    )
+    stats = EncodingStats()
+    encoded = tokenize_dataset(
+        dataset, target_model=lightweight_target_model, separate_ocr=True, deduplicate=True, stats=stats
+    )
+    assert encoded["train"]["input_ids"] == [[17], [34], [17], [34]]
+    assert encoded["train"]["labels"] == [[0], [0], [0], [1]]
+    assert len(counting_tesseract) == 3
+    assert stats.summary()["dedup_skipped"]["items"] == 1
+
+    with pytest.raises(ValueError):
+        tokenize_dataset(dataset, target_model=lightweight_target_model, deduplicate=True, stride=16)
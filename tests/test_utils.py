@@ -18,8 +18,9 @@ from typing import Any, List
 import numpy as np
 import pandas as pd
 import pytest
+from datasets import ClassLabel, Dataset, Features, Image, Sequence, Value
 
-from document_tools.utils import _get_label_list
+from document_tools.utils import _get_label_list, _get_label_list_from_dataset, _get_label_list_from_iterable
 
 
 @pytest.fixture()
@@ -54,3 +55,52 @@ def test_get_label_list_wrong_input(list_of_wrong_labels: List[Any]):
     for label_list in list_of_wrong_labels:
         with pytest.raises(TypeError):
             _get_label_list(label_list)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 100_000])
+def test_get_label_list_from_dataset(list_of_labels_with_duplicate_integers: List[List[int]], chunk_size: int):
+    """Test that the chunked label discovery returns the same labels as `_get_label_list`."""
+    dataset = Dataset.from_dict({"label": list_of_labels_with_duplicate_integers})
+    label_list = _get_label_list_from_dataset(dataset, "label", chunk_size=chunk_size)
+    assert label_list == _get_label_list(list_of_labels_with_duplicate_integers)
+
+
+def test_get_label_list_from_dataset_with_indices_and_empty_rows():
+    """Test that only the selected rows are read and that empty label lists are ignored."""
+    dataset = Dataset.from_dict({"label": [[7, 8], [], [1], [9]]}).select([1, 2])
+    assert _get_label_list_from_dataset(dataset, "label") == [1]
+
+
+def test_get_label_list_from_dataset_with_class_labels():
+    """Test that class label columns return the integer ids."""
+    features = Features({"label": Sequence(ClassLabel(names=["bill", "invoice", "receipt"]))})
+    dataset = Dataset.from_dict({"label": [[2], [0, 2]]}, features=features)
+    assert _get_label_list_from_dataset(dataset, "label") == [0, 2]
+
+
+def test_get_label_list_from_dataset_wrong_input(list_of_labels_with_duplicate_integers: List[List[int]]):
+    """Test that the function raises an error when the input is not a dataset or the chunk size is invalid."""
+    with pytest.raises(TypeError):
+        _get_label_list_from_dataset(list_of_labels_with_duplicate_integers, "label")  # type: ignore
+    with pytest.raises(ValueError):
+        _get_label_list_from_dataset(Dataset.from_dict({"label": [[1]]}), "label", chunk_size=0)
+
+
+def test_get_label_list_from_iterable(list_of_labels_with_duplicate_integers: List[List[int]]):
+    """Test that the labels of an iterable dataset are discovered from its first rows."""
+    dataset = Dataset.from_dict({"label": list_of_labels_with_duplicate_integers + [[9]]}).to_iterable_dataset()
+    assert _get_label_list_from_iterable(dataset, "label") == [1, 2, 3, 4, 5, 9]
+    assert _get_label_list_from_iterable(dataset, "label", max_rows=2) == [1, 2, 3, 4, 5]
+
+    scalar_dataset = Dataset.from_dict({"label": ["b", "a", "b"]}).to_iterable_dataset()
+    assert _get_label_list_from_iterable(scalar_dataset, "label") == ["a", "b"]
+
+    # The images are not decoded, so a missing file does not matter.
+    features = Features({"image": Image(), "label": Sequence(Value(dtype="int64"))})
+    image_dataset = Dataset.from_dict(
+        {"image": [{"bytes": None, "path": "missing.png"}], "label": [[7]]}, features=features
+    ).to_iterable_dataset()
+    assert _get_label_list_from_iterable(image_dataset, "label") == [7]
+
+    with pytest.raises(TypeError):
+        _get_label_list_from_iterable(list_of_labels_with_duplicate_integers, "label")  # type: ignore